@@ -1,6 +1,7 @@
 #############################################################################
 # FASTA functions -- used by fasta_nd_furious.py
-# FASTA readers are still located in CORE.
+# FASTA readers are in seqparse. Operations that work on one sequence at a time
+# stream the records from seqparse.fastaStream instead of reading whole files.
 # Gregg Thomas
 # August 2017
 #############################################################################
@@ -27,16 +28,16 @@ def countPos(fasta_files, disp_file=0):
 	total_files, total_seq, total_pos = 0,0,0;
 	fa_skip = [];
 	for fasta_file in fasta_files:
-		seqs, skip = seq.fastaReader(fasta_file);
+		records, skip = seq.fastaStream(fasta_file);
 		if skip:
 			fa_skip.append(fasta_file);
 			continue;
 		total_files += 1;
-		for title in seqs:
+		for title, sequence in records:
 			total_seq += 1;
 			if disp_file == 1:
-				print(title + "\t" + len(seqs[title]));
-			total_pos += len(seqs[title]);
+				print(title + "\t" + str(len(sequence)));
+			total_pos += len(sequence);
 
 	print("\n" + core.getTime() + " Done!");
 	print("-----");
@@ -285,16 +286,16 @@ def combine(fasta_files, outfilename):
 	outfile = open(outfilename, "w");
 	for fasta_file in fasta_files:
 		print("Loading file", fasta_file + "...");
-		seqs, skip = core.fastaReader(fasta_file);
+		records, skip = seq.fastaStream(fasta_file);
 		if skip:
 			fa_skip.append(fasta_file);
 			continue;
 		total_files += 1;
-		for title in seqs:
+		for title, sequence in records:
 			total_seq += 1;
-			total_pos += len(seqs[title]);
+			total_pos += len(sequence);
 			outfile.write(title + "\n");
-			outfile.write(seqs[title] + "\n");
+			outfile.write(sequence + "\n");
 	outfile.close();
 	print("\n" + core.getTime() + " Done!");
 	print("-----");
@@ -316,11 +317,11 @@ def split(fasta_files, header_delim, outdir):
 		os.system("mkdir " + outdir);
 
 	total_seq = 0;
-	seqs, skip = seq.fastaReader(fasta_file);
+	records, skip = seq.fastaStream(fasta_file);
 	if skip:
 		sys.exit(core.errorOut(6, "Something went wrong when reading your input file! Does it have the .fa extension? Is it a properly formatted FASTA file?"))
 
-	for title in seqs:
+	for title, sequence in records:
 		total_seq += 1;
 		if not header_delim:
 			outfilename = os.path.join(outdir, title[1:] + ".fa");
@@ -328,7 +329,7 @@ def split(fasta_files, header_delim, outdir):
 			outfilename = os.path.join(outdir, title[1:title.index(header_delim)] + ".fa");
 		outfile = open(outfilename , "w");
 		outfile.write(title + "\n");
-		outfile.write(seqs[title]);
+		outfile.write(sequence);
 		outfile.close();
 
 	print("\n" + core.getTime() + " Done!");
@@ -343,14 +344,14 @@ def trim(fasta_files, header_delim, file_flag, out_dest):
 	fa_skip = [];
 	header_skip = [];
 	for fasta_file in fasta_files:
-		seqs, skip = seq.fastaReader(fasta_file);
+		records, skip = seq.fastaStream(fasta_file);
 		if skip:
 			fa_skip.append(fasta_file);
 			continue;
 
 		outfilename = getOutFile(fasta_file, file_flag, out_dest, "trim");
 		outfile = open(outfilename, "w");
-		for title in seqs:
+		for title, sequence in records:
 			new_title = title;
 			if header_delim not in title:
 				if fasta_file not in header_skip:
@@ -358,7 +359,7 @@ def trim(fasta_files, header_delim, file_flag, out_dest):
 			else:
 				new_title = title[:title.index(header_delim)];
 			outfile.write(new_title + "\n");
-			outfile.write(seqs[title] + "\n");
+			outfile.write(sequence + "\n");
 		outfile.close();
 
 	print("\n" + core.getTime() + " Done!");
@@ -396,7 +397,7 @@ def relabel(fasta_files, ropt, header_delim, new_labels, file_flag, out_dest):
 	fa_skip = [];
 	label_skip = [];
 	for fasta_file in fasta_files:
-		seqs, skip = core.fastaReader(fasta_file);
+		records, skip = seq.fastaStream(fasta_file);
 		if skip:
 			fa_skip.append(fasta_file);
 			continue;
@@ -404,7 +405,7 @@ def relabel(fasta_files, ropt, header_delim, new_labels, file_flag, out_dest):
 		total_files += 1;
 		outfilename = getOutFile(fasta_file, file_flag, out_dest, "relab");
 		outfile = open(outfilename, "w");
-		for title in seqs:
+		for title, sequence in records:
 			if not sep_labels:
 				new_title = seq.relabelHeader(title, new_label, header_delim, ropt);
 				outfile.write(new_title + "\n");
@@ -420,7 +421,7 @@ def relabel(fasta_files, ropt, header_delim, new_labels, file_flag, out_dest):
 						break;
 				if label_found == False:
 					label_skip.append((fasta_file, title));
-			outfile.write(seqs[title] + "\n");
+			outfile.write(sequence + "\n");
 		outfile.close();
 
 	print("\n" + core.getTime() + " Done!");
@@ -443,7 +444,7 @@ def removeSeq(fasta_files, labels, file_flag, out_dest):
 	total_files, total_seq, total_seq_rm = 0,0,0;
 	fa_skip = [];
 	for fasta_file in fasta_files:
-		seqs, skip = core.fastaReader(fasta_file);
+		records, skip = seq.fastaStream(fasta_file);
 		if skip:
 			fa_skip.append(fasta_file);
 			continue;
@@ -451,13 +452,13 @@ def removeSeq(fasta_files, labels, file_flag, out_dest):
 		total_files += 1;
 		outfilename = getOutFile(fasta_file, file_flag, out_dest, "rmseq");
 		outfile = open(outfilename, "w");
-		for title in seqs:
+		for title, sequence in records:
 			total_seq += 1;
 			if any(label in title for label in labels):
 				total_seq_rm += 1;
 				continue;
 			outfile.write(title + "\n");
-			outfile.write(seqs[title] + "\n");
+			outfile.write(sequence + "\n");
 		outfile.close();
 
 	print("\n" + core.getTime() + " Done!");
@@ -477,7 +478,7 @@ def removeStarts(fasta_files, seqtype, file_flag, out_dest):
 	total_files, total_seq, total_start_rm = 0,0,0;
 	fa_skip = [];
 	for fasta_file in fasta_files:
-		seqs, skip = core.fastaReader(fasta_file);
+		records, skip = seq.fastaStream(fasta_file);
 		if skip:
 			fa_skip.append(fasta_file);
 			continue;
@@ -485,17 +486,16 @@ def removeStarts(fasta_files, seqtype, file_flag, out_dest):
 		total_files += 1;
 		outfilename = getOutFile(fasta_file, file_flag, out_dest, "rmstart");
 		outfile = open(outfilename, "w");
-		for title in seqs:
-			seq = seqs[title];
+		for title, sequence in records:
 			total_seq += 1;
-			if seqtype[0] == 'p' and seq[0].upper() == "M":
+			if seqtype[0] == 'p' and sequence[:1].upper() == "M":
 				total_start_rm += 1;
-				seq = seq[1:];
-			elif seqtype[0] == 'c' and seq[:3].upper() == "ATG":
+				sequence = sequence[1:];
+			elif seqtype[0] == 'c' and sequence[:3].upper() == "ATG":
 				total_start_rm += 1;
-				seq = seq[3:];
+				sequence = sequence[3:];
 			outfile.write(title + "\n");
-			outfile.write(seq + "\n");
+			outfile.write(sequence + "\n");
 		outfile.close();
 
 	print("\n" + core.getTime() + " Done!");
@@ -516,7 +516,7 @@ def removeStops(fasta_files, seqtype, file_flag, out_dest):
 	total_files, total_seq, total_stop_rm = 0,0,0;
 	fa_skip = [];
 	for fasta_file in fasta_files:
-		seqs, skip = core.fastaReader(fasta_file);
+		records, skip = seq.fastaStream(fasta_file);
 		if skip:
 			fa_skip.append(fasta_file);
 			continue;
@@ -524,14 +524,13 @@ def removeStops(fasta_files, seqtype, file_flag, out_dest):
 		total_files += 1;
 		outfilename = getOutFile(fasta_file, file_flag, out_dest, "rmstop");
 		outfile = open(outfilename, "w");
-		for title in seqs:
-			seq = seqs[title];
+		for title, sequence in records:
 			total_seq += 1;
-			if seq[-3:] in stop_codons:
-				seq = seq[:-3];
+			if sequence[-3:] in stop_codons:
+				sequence = sequence[:-3];
 				total_stop_rm += 1;
 			outfile.write(title + "\n");
-			outfile.write(seq + "\n");
+			outfile.write(sequence + "\n");
 		outfile.close();
 
 	print("\n" + core.getTime() + " Done!");
@@ -554,7 +553,7 @@ def replaceBase(fasta_files, replacements, file_flag, out_dest):
 	total_files, total_seq, total_pos, total_repl = 0,0,0,0;
 	fa_skip = [];
 	for fasta_file in fasta_files:
-		seqs, skip = core.fastaReader(fasta_file);
+		records, skip = seq.fastaStream(fasta_file);
 		if skip:
 			fa_skip.append(fasta_file);
 			continue;
@@ -565,15 +564,15 @@ def replaceBase(fasta_files, replacements, file_flag, out_dest):
 		else:
 			outfilename = getOutFile(fasta_file, file_flag, out_dest, "repl." + ".".join(replacements));
 		outfile = open(outfilename, "w");
-		for title in seqs:
-			seq = seqs[title].upper();
+		for title, sequence in records:
+			sequence = sequence.upper();
 			total_seq += 1;
-			total_pos += len(seq);
+			total_pos += len(sequence);
 			for replacement in replacements:
-				total_repl += seq.count(replacement[0]);
-				seq = seq.replace(replacement[0],replacement[1]);
+				total_repl += sequence.count(replacement[0]);
+				sequence = sequence.replace(replacement[0],replacement[1]);
 			outfile.write(title + "\n");
-			outfile.write(seq + "\n");
+			outfile.write(sequence + "\n");
 		outfile.close();
 
 	print("\n" + core.getTime() + " Done!");
@@ -596,23 +595,23 @@ def extractSeqs(fasta_files, titles, delim, file_flag, out_dest):
 		total_files, total_seq = 0,0;
 		fa_skip, ext = [], [];
 		for fasta_file in fasta_files:
-			seqs, skip = core.fastaReader(fasta_file, "ind");
+			records, skip = seq.fastaStream(fasta_file);
 			if skip:
 				fa_skip.append(fasta_file);
 				continue;
 
 			total_files += 1;
-			for title in seqs:
+			for title, sequence in records:
+				total_seq += 1;
 				if delim:
 					t = title[1:title.index(delim)];
 				else:
 					t = title[1:];
 
 				if t in titles:
-					seq = core.fastaGetInd(fasta_file, seqs[title])[1];
 					ext.append(t);
 					outfile.write(">" + t + "\n");
-					outfile.write(seq + "\n");
+					outfile.write(sequence + "\n");
 
 	print("\n" + core.getTime() + " Done!");
 	print("-----");
@@ -231,25 +231,134 @@ def yabt(codon_seq):
 ##########################################################################################################################################################
 #FASTA
 
+FASTA_EXTS = [".fa", ".fas", ".faa", ".fna", ".fasta"];
+# The file extensions read as FASTA by fastaReader and fastaStream, which can also have .gz or .bz2 after them
+
+FASTA_BLOCK_SIZE = 8 * 1024 * 1024;
+# The number of bytes iter_fasta reads at a time
+
+SEQ_WHITESPACE = b" \t\r\n\x0b\x0c";
+# Characters removed from sequences by iter_fasta
+
+def isFasta(i_name):
+# Checks if a file name ends with one of the FASTA extensions, compressed or not.
+    for comp_ext in [".gz", ".bz2"]:
+        if i_name.endswith(comp_ext):
+            i_name = i_name[:-len(comp_ext)];
+            break;
+    return any(i_name.endswith(ext) for ext in FASTA_EXTS);
+
+#############################################################################
+
+def openSeqFile(filename):
+# Opens a sequence file to read bytes from, whether it is gzipped, bzipped or not.
+    compression = core.detectCompression(filename);
+    if compression == "gz":
+        import gzip
+        return gzip.open(filename, "rb");
+    elif compression == "bz2":
+        import bz2
+        return bz2.open(filename, "rb");
+    return open(filename, "rb");
+
+#############################################################################
+
+def fastaRecord(pieces):
+# Takes the pieces of bytes of one FASTA record after its ">" and returns its header and sequence as strings.
+# The header is everything up to the first newline, and the sequence is everything after it with whitespace removed.
+    if len(pieces) == 1:
+        newline = pieces[0].find(b"\n");
+        if newline == -1:
+            return pieces[0].decode().strip(), "";
+        return pieces[0][:newline].decode().strip(), pieces[0][newline+1:].translate(None, SEQ_WHITESPACE).decode();
+    # Most records are within one block
+
+    header, seq_pieces = b"".join(pieces), [];
+    for i in range(len(pieces)):
+        newline = pieces[i].find(b"\n");
+        if newline != -1:
+            header = b"".join(pieces[:i] + [pieces[i][:newline]]);
+            seq_pieces = [pieces[i][newline+1:]] + pieces[i+1:];
+            break;
+    # The header can be split between blocks, so look for the first piece with a newline
+
+    seq = b"".join([ piece.translate(None, SEQ_WHITESPACE) for piece in seq_pieces ]);
+    return header.decode().strip(), seq.decode();
+
+#############################################################################
+
+def iter_fasta(filename, block_size=FASTA_BLOCK_SIZE):
+# Reads a FASTA file and yields the header and sequence of each record in order, as strings, without keeping more
+# than one record in memory. The ">" and surrounding whitespace are removed from headers, and all whitespace (line
+# breaks, including Windows ones) is removed from sequences. The file can be gzipped or bzipped.
+# The file is read in large blocks of bytes and records are found by the ">" at the start of a line with
+# bytes.find. The pieces of the blocks a record is in are only joined once, so reading long sequences like
+# chromosomes takes linear time instead of adding up strings line by line.
+# Raises a ValueError if there is anything but whitespace before the first header.
+
+    def leading(pieces):
+    # Checks the pieces of the file before the first header
+        if b"".join(pieces).strip():
+            raise ValueError("Text before the first FASTA header in " + filename);
+
+    with openSeqFile(filename) as infile:
+        pieces = [];
+        in_record = False;
+        line_start = True;
+        # The pieces of the current record since its ">", whether the first header has been found, and
+        # whether the next block starts a new line
+
+        while True:
+            block = infile.read(block_size);
+            if not block:
+                break;
+
+            if line_start and block[:1] == b">":
+                first = 0;
+            else:
+                first = block.find(b"\n>") + 1;
+                if first == 0:
+                    pieces.append(block);
+                    line_start = block[-1:] == b"\n";
+                    continue;
+            # The first ">" at the start of a line in the block, including at the start of the block after a newline.
+            # Blocks without one are all part of the current record.
+
+            pieces.append(block[:first]);
+            if in_record:
+                yield fastaRecord(pieces);
+            else:
+                leading(pieces);
+            in_record = True;
+            # The first ">" ends the record from the previous blocks
+
+            last = max(first, block.rfind(b"\n>") + 1);
+            if last > first:
+                for record in block[first+1:last].split(b"\n>"):
+                    yield fastaRecord([record]);
+            # The records that start and end in the block are split all at once
+
+            pieces = [block[last+1:]];
+            line_start = block[-1:] == b"\n";
+        ## End block loop
+
+        if in_record:
+            yield fastaRecord(pieces);
+        else:
+            leading(pieces);
+
+#############################################################################
+
 def fastaReader(i_name, meth="dict"):
 # This function takes an input file and determines if it is a compressed or
 # uncompressed FASTA file (.fa). If it doesn't end with .fa it returns it to
 # be skipped.
-    #try:
-    if i_name.endswith(".fa.gz") or i_name.endswith(".fas.gz") or i_name.endswith(".faa.gz") or i_name.endswith(".fna.gz") or i_name.endswith(".fasta.gz"):
-        if meth == "dict":
-            seqs = fastaGetDictCompressed(i_name);
-        elif meth == "ind":
-            seqs = fastaReadInd(i_name);
-    elif i_name.endswith(".fa") or i_name.endswith(".fas") or i_name.endswith(".faa") or i_name.endswith(".fna") or i_name.endswith(".fasta"):
-        if meth == "dict":
-            seqs = fastaGetDict(i_name);
-        elif meth == "ind":
-            seqs = fastaReadInd(i_name);
-    else:
+    if not isFasta(i_name):
         return None, i_name;
-    #except:
-    #    return None, i_name;
+    if meth == "dict":
+        seqs = fastaGetDict(i_name);
+    elif meth == "ind":
+        seqs = fastaReadInd(i_name);
     if seqs == {}:
         return None, i_name;
     return seqs, False;
@@ -258,133 +367,68 @@ def fastaReader(i_name, meth="dict"):
 
 #############################################################################
 
-def fastaGetLists(i_name):
-# fastaGetLists reads a file and parses (separates) each FASTA sequence in the file into two corresponding lists:
-# one containing the title line of the sequence and another containing the sequence itself. This function also
-# returns the input and output file names.
+def fastaStream(i_name):
+# Like fastaReader, but instead of a dict it returns an iterator over the (title, sequence) of each record in the
+# file, from iter_fasta. Titles start with ">" like the keys from fastaReader. Files that aren't FASTA by their
+# extension or have no sequences return None and the file name to be skipped.
+    from itertools import chain
 
-    infile = open(i_name, "r");
-    inseqs = infile.read();
-    infile.close();
-    #This block reads the input file.
-
-    seqs = [''] * inseqs.count('>');
-    titles = [''] * inseqs.count('>');
-
-    k = 0;
-
-    if len(seqs) > 1:
-        for k in range(len(seqs) - 1):
-            titles[k] = inseqs[:inseqs.index('\n')];
-
-            seqs[k] = inseqs[inseqs.index('\n') + 1:inseqs.index('>', inseqs.index('\n')) - 1];
-            tmp = inseqs.index('>', inseqs.index('\n'));
-            inseqs = inseqs[tmp:];
-
-            titles[k + 1] = inseqs[:inseqs.index('\n')];
-            seqs[k + 1] = inseqs[inseqs.index('\n'):];
+    if not isFasta(i_name):
+        return None, i_name;
 
-    else:
-        titles[0] = inseqs[:inseqs.index('\n')];
-        seqs[0] = inseqs[inseqs.index('\n') + 1:];
+    records = ( (">" + header, seq) for header, seq in iter_fasta(i_name) );
+    first = next(records, None);
+    if first is None:
+        return None, i_name;
+    return chain([first], records), False;
+    # The first record is read to check the file isn't empty and then put back.
 
-    for i in range(len(seqs)):
-        seqs[i] = seqs[i].replace('\n', '');
-    # The above lines parse the seqs file by creating a list with the correct amount of elements (one per gene) based on the count of FASTA title lines ('>'). It
-    # then reads through the input string and stores all gene sequences in a separate list element. Finally, all newlines are removed.
+#############################################################################
 
+def fastaGetLists(i_name):
+# fastaGetLists reads a file and parses (separates) each FASTA sequence in the file into two corresponding lists:
+# one containing the title line of the sequence and another containing the sequence itself.
+    titles, seqs = [], [];
+    for header, seq in iter_fasta(i_name):
+        titles.append(">" + header);
+        seqs.append(seq);
     return titles, seqs;
 
 #############################################################################
 
 def fastaGetDict(i_name):
 # fastaGetDict reads a FASTA file and returns a dictionary containing all sequences in the file with 
-# the key:value format as title:sequence.
-
-    seqdict = {};
-    for line in open(i_name, "r"):
-        if line == "\n":
-            continue;
-        line = line.replace("\n", "");
-        if line[0] == '>':
-            curkey = line;
-            seqdict[curkey] = "";
-        else:
-            seqdict[curkey] = seqdict[curkey] + line;
-
-    return seqdict;
+# the key:value format as title:sequence. Titles start with ">". The file can be compressed.
+    return { ">" + header : seq for header, seq in iter_fasta(i_name) };
 
 #############################################################################
 
 def fastaGetDictCompressed(i_name):
-# fastaGetDict reads a FASTA file and returns a dictionary containing all sequences in the file with 
-# the key:value format as title:sequence.
-    import gzip
-
-    seqdict = {};
-    for line in gzip.open(i_name, "rb"):
-        line = line.decode().replace("\n", "");
-        if line[:1] == '>':
-            curkey = line;
-            seqdict[curkey] = "";
-        else:
-            seqdict[curkey] = seqdict[curkey] + line;
-
-    return seqdict;
+# fastaGetDict now reads gzipped and bzipped files as well, so this is the same.
+    return fastaGetDict(i_name);
 
 #############################################################################
 
 def fastaReadSeqs(filename, header_sep=False):
-# Read a FASTA formatted sequence file
-# Great iterator and groupby code from: https://www.biostars.org/p/710/ 
-# Returns dictionary with the key:value format as title:sequence.
-
-    import gzip
-    from itertools import groupby
-
-    compression = core.detectCompression(filename);
-
-    if compression == "gz":
-        file_stream = gzip.open(filename);
-        fa_iter = (x[1] for x in groupby(file_stream, lambda line: line.decode()[0] == ">"));
-        readstr = lambda s : s.decode().strip();
-    elif compression == "none":
-        file_stream = open(filename); 
-        fa_iter = (x[1] for x in groupby(file_stream, lambda line: line[0] == ">"));
-        readstr = lambda s : s.strip();
-    # Read the lines of the file depending on the compression level
-    # file_stream opens the file as an iterable
-    # groupby takes an iterable (file_stream) and a function that indicates the key of the group. It iterates over
-    # the iterable and when it encounters a key, it groups all following items to it (perfect for FASTA files).
-    # fa_iter is a generator object holding all the grouped iterators.
-    # readstr is a function that changes depending on compression level -- for compressed files we also need to decode
-    # each string in the iterators below.
+# Read a FASTA formatted sequence file, compressed or not.
+# Returns dictionary with the key:value format as title:sequence, without the ">" in titles.
+# With header_sep, titles are cut at the first occurrence of it.
+    if header_sep:
+        return { header.split(header_sep)[0] : seq for header, seq in iter_fasta(filename) };
+    return dict(iter_fasta(filename));
 
-    seqdict = {};
-    # A dictionary of sequences:
-    # <sequence id/header> : <sequence>
-
-    for header_obj in fa_iter:
-        #print(header_obj)
-        header = readstr(header_obj.__next__());
-        # The header object is an iterator. This gets the string.
-
-        curkey = header[1:];
-        # This removes the ">" character from the header string to act as the key in seqdict
-
-        if header_sep:
-            curkey = curkey.split(header_sep)[0];
-
-        seq = "".join(readstr(s) for s in fa_iter.__next__());
-        # The current header should correspond to the current iterator in fa_iter. This gets all those
-        # lines and combines them as a string.
-
-        #print(header, len(seq));
-
-        seqdict[curkey] = seq;
-        # Save the sequence in seqdict
+#############################################################################
 
-    return seqdict;
+def relabelHeader(title, new_label, header_delim, ropt):
+# Adds a new label to the start (ropt 1) or end (ropt 3) of a FASTA title, with header_delim in between, or
+# replaces the title with it (ropt 2).
+    if ropt == 1:
+        new_title = ">" + new_label + header_delim + title[1:];
+    elif ropt == 2:
+        new_title = ">" + new_label;
+    elif ropt == 3:
+        new_title = title + header_delim + new_label;
+    return new_title;
 
 #############################################################################
 
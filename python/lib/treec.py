@@ -3,11 +3,26 @@
 # Gregg Thomas
 #############################################################################
 
+import os
 import sys
 import re
+import gzip
+import struct
+import hashlib
+import zipfile
+import array
 import copy
 import random
-import itertools
+import multiprocessing as mp
+
+#############################################################################
+
+NEWICK_TOKENS = re.compile(r"[(),;]|[^(),;]+");
+# Tokens in a Newick string: structural characters or the text (labels and branch lengths) between them
+
+NEWICK_INTERNAL_LABEL = re.compile(rb"\)[^(),;:]+");
+NEWICK_BRANCH_LENGTH = re.compile(rb":[^(),;]*");
+# The label after a closing parenthesis and a branch length, in a Newick string read as bytes
 
 #############################################################################
 
@@ -16,7 +31,9 @@ class Tree:
 # dictionary with usable info about the tree in the following format:
 # node:[branch length (if present), ancestral node, node type, node label (if present)]
 
-    def __init__(self, tree_string, get_subtrees=False, debug=False):
+    def __init__(self, tree_string, get_subtrees=False, debug=False, taxa=False):
+    # If a TaxonTable is given as taxa, tip labels are interned in it so that trees read with the same
+    # table share their label strings
 
         tree = tree_string.strip();
         if tree[-1] != ";":
@@ -58,6 +75,21 @@ class Tree:
         self.root = "";
         # Node lists and counts
 
+        self.bipartitions = False;
+        # An optional index of clades as bitmasks, built by indexBipartitions()
+
+        self.lca_index = False;
+        # The index for LCA queries, built by getLCAIndex() when first needed
+
+        self.traversal = False;
+        # The cached traversal orders, built by getTraversal() when first needed
+
+        self.root_dists = False;
+        # The distance from the root to each node as a numpy array, built by getRootDists() when first needed
+
+        self.taxa = taxa;
+        # The shared table of tip labels, if any
+
         ## Class attributes
         #####
 
@@ -66,7 +98,17 @@ class Tree:
         ## Remove the branch lengths and node labels from the input tree string
         #####     
 
-        for tip_label in self.topo_str.replace("(","").replace(")","").replace(";","").split(","):
+        scan = scanNewick(tree);
+        # A single stack-based pass over the tree string that returns every node with its ancestor,
+        # descendants, label, branch length and the nesting level of its parentheses
+
+        for tip_ind in scan['tips']:
+            tip_label = scan['text'][tip_ind];
+            if taxa:
+                tip_label = taxa.labels[taxa.getId(tip_label)];
+                scan['text'][tip_ind] = tip_label;
+            # Use the shared copy of the label if there is a taxon table
+
             self.tips.append(tip_label);
             self.type[tip_label] = 'tip';
         ## Retrieval of the tip labels
@@ -79,44 +121,35 @@ class Tree:
         ## Node counting and root checking
         #####
 
-        # self.bl = { node : "NA" for node in self.nodes };
-        # self.label = { node : "" for node in self.internals + [self.root] };
-        # self.anc = { node : "NA" for node in self.nodes };
-        ## With the node lists set, initialize the other node attributes
-        #####
-
-        # z = 0;
-        # numnodes = 1;
-        # while z < (len(self.topo_str)-1):
-        #     self.labeled_topo_str += self.topo_str[z];
-        #     if self.topo_str[z] == ")":
-        #         node_label = "<" + str(numnodes) + ">";
-        #         self.labeled_topo_str += node_label;
-        #         numnodes += 1;
-        #     z += 1;
-        # if debug:
-        #     print("LABELED TOPOLOGY:", self.labeled_topo_str);
-        #     print("----------");
-        ## Add the generated internal node labels onto the topology string
-        #####
-
-        subtrees = {};
-
-        pairs = re.findall(r"\([\d\w/.,:_<>-]+\)", tree);
+        node_names = scan['text'][:];
         node_count = 1;
-        while pairs:
+        for level in scan['levels']:
+            for node_ind in level:
+                node_names[node_ind] = "<" + str(node_count) + ">";
+                node_count += 1;
+        # Internal nodes are numbered in the order that the innermost pairs of parentheses are
+        # resolved: first all pairs that contain only tips, left to right, then all pairs that
+        # contain only those, and so on up to the root. scanNewick groups the nodes into these
+        # levels so the labels match the ones given by the old regex parser
+
+        pieces = scan['pieces'];
+        for node_ind in scan['internals']:
+            pieces[scan['slot'][node_ind]] = node_names[node_ind];
+        # Fill the generated node labels into the empty slots the scan left after every closing
+        # parenthesis of the tree string
+
+        for level in scan['levels']:
         # Loop over all pairs of opening an closing parens at each
         # tree level
 
-            for pair in pairs:
+            for anc_ind in level:
             # Loop over every pair in the current set
 
-                anc_label = "<" + str(node_count) + ">";
+                anc_label = node_names[anc_ind];
                 self.desc[anc_label] = [];
-                node_count += 1;
                 # The ancestral label
 
-                node_list = pair.replace("(", "").replace(")", "").split(",");
+                node_list = scan['desc'][anc_ind];
                 num_nodes = len(node_list);
                 if num_nodes > 2:
                     self.num_polytomies += 1;
@@ -127,16 +160,14 @@ class Tree:
                 # A list of nodes in the current pair to add
                 # as descendants for the ancestral node
 
-                for node in node_list:
+                for node_ind in node_list:
                 # Loop over each node in the current pair list
 
-                    if ":" in node:
-                        node, bl = node.split(":");
-                    else:
-                        bl = "NA"
-                    # Check if the current node has a branch length
+                    node = node_names[node_ind];
+                    bl = scan['bl'][node_ind];
+                    # Look up the node name and branch length from the scan
 
-                    if node in self.tips:
+                    if scan['type'][node_ind] == "tip":
                         self.label[node] = "NA";
                         self.bl[node] = bl;
                         # Tip info
@@ -144,38 +175,22 @@ class Tree:
                         self.desc[node] = "NA";
                         # Tips have no descendants
 
-                        if bl != "NA":
-                            subtrees[node] = node + ":" + str(bl);
-                        else:
-                            subtrees[node] = node;
+                        if get_subtrees:
+                            subtrees[node] = pieces[scan['start'][node_ind]];
                         # For tips, the subtree is just that node and its branch length
-                        # If the current node is a tip label, add no label
                     ## Tips
 
                     else:
-                        cur_label = re.sub(r"<[\d]+>", "", node);
-                        node = re.findall(r"<[\d]+>", node)[0];
-                        # Parse out the provided labels in the tree from
-                        # the ones generated here for all internal nodes
-
                         self.type[node] = "internal";
                         self.internals.append(node);
-                        self.label[node] = cur_label;
+                        self.label[node] = scan['text'][node_ind];
                         self.bl[node] = bl;
                         # Node information
 
-                        subtrees[node] = "(";
-                        for d in self.desc[node]:
-                            subtrees[node] += subtrees[d] + ",";
-                        subtrees[node] = subtrees[node][:-1] + ")" + node;
-
-                        if cur_label:
-                            subtrees[node] += str(cur_label);
-                        if bl != "NA":
-                            subtrees[node] += ":" + str(bl);
-                        # For internal nodes, the subtree is the combination of the subtrees of its
-                        # descendants
-                        # Add branch lengths and labels as needed
+                        if get_subtrees:
+                            subtrees[node] = "".join(pieces[scan['start'][node_ind]:scan['end'][node_ind]]);
+                        # For internal nodes, the subtree is the span of the labeled tree string from
+                        # its opening parenthesis to its label and branch length
                     ## Internal nodes
 
                     cur_nodes.append(node);
@@ -190,14 +205,7 @@ class Tree:
                 for node in cur_nodes:
                     self.sis[node] = [ n for n in cur_nodes if n != node ];
                 # Set the sister branches for each node in the current pair
-
-                tree = tree.replace(pair, anc_label);
-                # Replace the current pair with the ancestral label in the tree
             ## End pairs loop
-
-            pairs = re.findall(r"\([\d\w/.,:_<>-]+\)", tree);
-            # Find all new pairs in the tree
-        # If there are no pairs left, we've reached the root of the tree
         ## End tree level loop
 
         ## Main tree parsing loop
@@ -225,10 +233,7 @@ class Tree:
             self.rooted = True;
         # Check if there is a polytomy at the root for rootedness
 
-        subtrees[anc_label] = "(";
-        for d in self.desc[anc_label]:
-            subtrees[anc_label] += subtrees[d] + ",";
-        subtrees[anc_label] = subtrees[anc_label][:-1] + ")" + anc_label;
+        subtrees[anc_label] = "".join(pieces[scan['start'][anc_ind]:scan['end'][anc_ind]]);
         self.tree_str = subtrees[self.root];
         # Add the subtree for the root, which ends up being the fully labeled tree
 
@@ -542,12 +547,12 @@ class Tree:
 
     def getDesc(self, node):
     # This function takes a node in the current tree object
-    # and returns a list of the two direct descendant nodes of it.
+    # and returns a list of the direct descendant nodes of it.
 
-        if node in self.tips:
+        if self.type[node] == "tip":
             return [node];
         else:
-            return [ n for n in self.nodes if self.anc[n] == node ];
+            return list(self.desc[node]);
 
     ##########
 
@@ -577,34 +582,77 @@ class Tree:
 
     ##########
 
+    def getTraversal(self):
+    # Returns the traversal index (see the TraversalIndex class) for this tree, building it if needed
+
+        if not self.traversal:
+            self.traversal = TraversalIndex(self.nodes, self.root, self.desc);
+        return self.traversal;
+
+    ##########
+
+    def preorder(self, node=False):
+    # Iterates over the nodes in the subtree of a node (the whole tree by default), with each node before its
+    # descendants, from left to right
+
+        trav = self.getTraversal();
+        if node is False:
+            node = self.root;
+        start = trav.pre_pos[trav.index[node]];
+        end = start + trav.size[trav.index[node]];
+        return ( self.nodes[trav.pre[i]] for i in range(start, end) );
+
+    ##########
+
+    def postorder(self, node=False):
+    # Iterates over the nodes in the subtree of a node (the whole tree by default), with each node after its
+    # descendants, from left to right
+
+        trav = self.getTraversal();
+        if node is False:
+            node = self.root;
+        end = trav.post_pos[trav.index[node]] + 1;
+        start = end - trav.size[trav.index[node]];
+        return ( self.nodes[trav.post[i]] for i in range(start, end) );
+
+    ##########
+
+    def levelorder(self, node=False):
+    # Iterates over the nodes in the subtree of a node (the whole tree by default) by their number of branches
+    # from it, from left to right
+
+        trav = self.getTraversal();
+        if node is False or node == self.root:
+            return ( self.nodes[i] for i in trav.level );
+        start = trav.pre_pos[trav.index[node]];
+        end = start + trav.size[trav.index[node]];
+        return ( self.nodes[i] for i in trav.level if start <= trav.pre_pos[i] < end );
+        # The subtree of a node is the stretch of the preorder starting at it
+
+    ##########
+
     def getClade(self, node, full=False):
     # This function takes a node in the current tree object
-    # and finds all tip labels that are descendants of it.
-    # This is done by getting the direct descendants of the node with getDesc and then
-    # recursively calling itself on those descendants.
+    # and finds all tip labels that are descendants of it, in order from left to right.
+    # If full is set, internal nodes descending from the node are included after their descendants.
+    # The clade is a slice of the cached postorder, so there is no recursion.
 
-        clade = [];
-        if node in self.tips:
+        if self.type[node] == "tip":
             return [node];
 
-        desc = self.desc[node];
-        for d in desc:
-            if d not in self.tips:
-                clade += self.getClade(d, full);
-                if full:
-                    clade.append(d);
-                # If full is true, the function will also return all internal nodes
-                # descending from the given node
-            else:
-                clade.append(d);
-
-        return clade;
+        if full:
+            return [ n for n in self.postorder(node) if n != node ];
+        return [ n for n in self.postorder(node) if self.type[n] == "tip" ];
 
     ##########
 
     def getClades(self, full=False):
     # Calls getClade() on every node in a tree object
 
+        if self.bipartitions and not full:
+            return { node : self.bipartitions.getTips(self.bipartitions.clade[node]) for node in self.nodes };
+        # With the bipartition index, the clades are read from the masks
+
         clades = {};
         for node in self.nodes:
             clades[node] = set(self.getClade(node, full=full));
@@ -619,6 +667,10 @@ class Tree:
         if node == self.root:
             return "NA";
 
+        if self.bipartitions:
+            return self.bipartitions.getTips(self.bipartitions.split(node));
+        # With the bipartition index, the split is the complement of the clade mask
+
         return set(self.tips) - set(self.getClade(node));
 
     ##########
@@ -713,7 +765,7 @@ class Tree:
 
     ##########
 
-    def sampleQuartets(self, num_quartets=100):
+    def sampleQuartets(self, num_quartets=100, seed=None, as_arrays=False):
     # For sCF, we treat the species tree as unrooted, so for each node(*)/branch, the possible clades
     # to sample quartets from are the two clades directly descendant from the node, the clade
     # descendant from the sister node, and all other species.
@@ -733,41 +785,64 @@ class Tree:
     #         /         \
     #    other           descendant 2 (right)
     # UNROOTED TREE
+    #
+    # Returns a dict of node : list of sampled quartets as ((d1 tip, d2 tip), (sister tip, other tip)).
+    # Quartets are sampled by number without building all of them, so memory only depends on num_quartets.
+    # seed: seed for the random sampling, for reproducible quartets
+    # as_arrays: instead of tips, return node : (the 4 sorted clade lists, a NumPy array with one row of 4
+    #            clade indices per quartet)
     #
 
         full_quartets = self.getQuartets();
         sampled_quartets = {};
+        rng = random.Random(seed);
+        # One generator for all nodes so a seed gives the same quartets every run
+
+        if as_arrays:
+            import numpy as np;
 
         for node in self.nodes:
-            if node in self.tips or node == self.root:
+            if self.type[node] == "tip" or node == self.root or full_quartets[node] == "NA":
                 continue;
-            # Cannot calculate sCF for tips, the root, or node descendant from the root
+            # Cannot calculate sCF for tips, the root, or node descendant from the root with a tip as its sister
+
+            clades = [ sorted(full_quartets[node][q]) for q in ['d1', 'd2', 's', 'q4'] ];
+            # Sort the tips in each clade so that sampled indices always point to the same tips
 
-            assert all(len(full_quartets[node][q]) > 0 for q in full_quartets[node]), \
+            assert all(len(clade) > 0 for clade in clades), \
                 " * ERROR: quartet sampling failed for node: " + node + "\n" + \
-                "\tleft:   " + len(full_quartets[node]['d1']) + "\n" + \
-                "\tright:  " + len(full_quartets[node]['d2']) + "\n" + \
-                "\tsister: " + len(full_quartets[node]['s']) + "\n" + \
-                "\tother:  " + len(full_quartets[node]['q4']) + "\n"
+                "\tleft:   " + str(len(clades[0])) + "\n" + \
+                "\tright:  " + str(len(clades[1])) + "\n" + \
+                "\tsister: " + str(len(clades[2])) + "\n" + \
+                "\tother:  " + str(len(clades[3])) + "\n"
             # Make sure each clade list has species or throw an error.. this shouldn't happen
 
-            split1_pairs = list(itertools.product(full_quartets[node]['d1'], full_quartets[node]['d2']));
-            split2_pairs = list(itertools.product(full_quartets[node]['s'], full_quartets[node]['q4']));
-            # Get every possible pair of species from each clade side of the split
-            # i.e. all pairs of left-right species (split1) and all pairs of sister-other species (split2)
+            sizes = [ len(clade) for clade in clades ];
+            cur_num_quartets = sizes[0] * sizes[1] * sizes[2] * sizes[3];
+            # Every quartet has one tip from each clade, so the quartets at this node can be numbered
+            # 0 to cur_num_quartets-1 as mixed radix numbers, with one digit for the tip from each clade
+            # and the last clade changing fastest
 
-            quartets = list(itertools.product(split1_pairs, split2_pairs));
-            # Get all pairs from the pairs of species in split1 and split2 for all possible quartets at this node
+            if cur_num_quartets > num_quartets:
+                indices = rng.sample(range(cur_num_quartets), num_quartets);
+            else:
+                indices = range(cur_num_quartets);
+            # If there are more quartets on the current node than the number to sample, sample their numbers
+            # without replacement. Otherwise, use all quartets
 
-            cur_num_quartets = len(quartets);
-            # Count the total number of quartets at this node
+            if as_arrays:
+                index_array = np.array(np.unravel_index(np.array(indices, dtype=np.int64), sizes)).T;
+                sampled_quartets[node] = (clades, index_array);
+                continue;
+            # Convert each quartet number to the index of its tip in each clade
 
-            if cur_num_quartets > num_quartets:
-                random.shuffle(quartets);
-                quartets = quartets[:num_quartets];
-            # If there are more quartets on the current node than the number to sample, sub-sample here
-            # Otherwise, use all quartets
-            ## SET A SEED FOR REPRODUCIBILITY
+            quartets = [];
+            for index in indices:
+                index, l = divmod(index, sizes[3]);
+                index, k = divmod(index, sizes[2]);
+                i, j = divmod(index, sizes[1]);
+                quartets.append(((clades[0][i], clades[1][j]), (clades[2][k], clades[3][l])));
+            # Convert each quartet number to its tips, as pairs from each side of the split
 
             sampled_quartets[node] = quartets;
             # Add the current set of quartets to the global dict
@@ -789,7 +864,9 @@ class Tree:
                 subtrees[node] = node;
         # For tips, the subtree is just that node and its branch length
 
-        for node in self.internals + [self.root]:
+        for node in self.postorder():
+            if self.type[node] == "tip":
+                continue;
             subtrees[node] = "(";
             for d in self.desc[node]:
                 subtrees[node] += subtrees[d] + ",";
@@ -812,35 +889,23 @@ class Tree:
 
         tip_set = set(tip_set);
 
-        clade_nodes = [];
-        for node in self.internals:
-            if set(self.getClade(node)) <= tip_set:
-                clade_nodes.append(node);
-        # In the input tree, find all nodes that have clades that are
+        in_set = {};
+        for node in self.nodes:
+            if self.type[node] == "tip":
+                in_set[node] = node in tip_set;
+            else:
+                in_set[node] = all(in_set[d] for d in self.desc[node]);
+        # In one pass up the tree, find all nodes that have clades that are
         # a subset of the given tip set
 
-        nodes_to_rm = [];
-        for node in clade_nodes:
-            for node_check in clade_nodes:
-                if node == node_check:
-                    continue;
-
-                if node in set(self.getClade(node_check, full=True)):
-                #if node in self.desc[node_check]:
-                    nodes_to_rm.append(node);
-        clade_set = [ n for n in clade_nodes if n not in nodes_to_rm ];
-        # We only want the deepest node from each possible clade, so remove
-        # nodes from those found that are descendants of another node.
+        clade_set = set( node for node in self.nodes if in_set[node] and (node == self.root or not in_set[self.anc[node]]) );
+        # We only want the deepest node from each possible clade, so keep only
+        # nodes whose ancestor isn't also in the set
 
-        nodes_to_rm = [];
-        for node in tip_set:
-            if any(node in set(self.getClade(n, full=True)) for n in clade_set):
-                nodes_to_rm.append(node);
-        clade_set += [ n for n in tip_set if n not in nodes_to_rm ];
-        # From the original input set, remove any nodes that are now found
-        # in a clade
+        clade_set |= set( node for node in tip_set if node not in in_set );
+        # Names that aren't in the tree are returned as they are
 
-        return set(clade_set);
+        return clade_set;
 
     ##########
 
@@ -848,6 +913,10 @@ class Tree:
     # A function that takes a set of tips and finds whether any branches
     # are defined on either side by them
 
+        if self.bipartitions:
+            return self.bipartitions.findSplits(tip_set);
+        # With the bipartition index, the clade and split are looked up directly
+
         split_nodes = [];
         for node in self.nodes:
             if clades:
@@ -872,36 +941,19 @@ class Tree:
     ##########
 
     def LCA(self, node_list):
-    # Given a list of nodes, this function finds the least common ancestor of them,
-    # and tells whether the nodes provided form a monophyletic clade.
-
-        ancs = {};
-        for node in node_list:
-            ancs[node] = [node];
-        # For each node in the input list, we make a list of the path from that node 
-        # to the root of the tree, including that node
-
-        for node in node_list:
-            if node == self.root:
-                continue;
-
-            cur_anc = self.anc[node];
-            ancs[node].append(cur_anc);
+    # Given a list of nodes, this function finds the least common ancestor of them
+    # with the Euler tour index, which is built the first time it is needed
 
-            while cur_anc != self.root:
-                cur_anc = self.anc[cur_anc];
-                ancs[node].append(cur_anc);
-        # For each node, add every node between it and the root to its ancs list
+        return self.getLCAIndex().LCA(node_list);
 
-        intersect_anc = set.intersection(*list(map(set, list(ancs.values()))));
-        # Gets the intersect of all lists of paths to the root, unordered
+    ##########
 
-        lcp = [t for t in list(ancs.values())[0] if t in intersect_anc];
-        # Orders the nodes in the intersect of all paths based on their order in
-        # the path of an arbitrary node (since it should be identical for all of them)
+    def getLCAIndex(self):
+    # Returns the LCA index (see the LCAIndex class) for this tree, building it if needed
 
-        return lcp[0];
-        # Returns the first node in the common path as the LCA  
+        if not self.lca_index:
+            self.lca_index = LCAIndex(self.root, self.desc);
+        return self.lca_index;
 
     ##########
 
@@ -909,6 +961,15 @@ class Tree:
     # Determines whether a set of nodes is within a monophyletic clade -- do
     # they all descend from the same ancestor with no other descendants?
 
+        if self.bipartitions and all(node in self.type and self.type[node] == "tip" for node in node_list):
+            return self.bipartitions.findClade(node_list) != False;
+        # With the bipartition index, a set of tips is monophyletic if its mask is the clade of a node
+
+        if all(node in self.type and self.type[node] == "tip" for node in node_list):
+            lca_index = self.getLCAIndex();
+            return lca_index.num_tips[lca_index.LCA(node_list)] == len(set(node_list));
+        # For a list of tips, they are monophyletic if their LCA has no other tips descending from it
+
         monophyletic = False;
         if set(self.getClade(self.LCA(node_list))) == set(node_list):
             monophyletic = True;
@@ -916,200 +977,207 @@ class Tree:
 
     ##########
 
-    def addBranchLength(self):
-    # Re-writes the branch lengths onto a tree object topology
+    def getRootDists(self):
+    # Returns a numpy array of the distance from the root to each node, in the order of self.nodes, building it
+    # if needed. Missing branch lengths count as 0.
 
-        tree = self.labeled_topo_str;
+        if self.root_dists is False:
+            import numpy as np;
 
-        for node in self.nodes:
-            new_node_str = node;
-            if self.has_label and node in self.internals:
-                new_node_str += str(self.label[node]);
+            trav = self.getTraversal();
+            num_nodes = len(self.nodes);
+            pre_pos = np.asarray(trav.pre_pos, dtype=np.int64);
+            subtree_end = pre_pos + np.asarray(trav.size, dtype=np.int64);
 
-            if self.has_bl and node != self.root:
-                new_node_str += ":" + str(self.bl[node]);
+            bl = np.array([ float(self.bl[node]) if self.bl[node] not in ("NA", "") else 0.0 for node in self.nodes ]);
+            bl[trav.index[self.root]] = 0.0;
+            # The branch length of each node, in the same order as the traversal index
 
-            tree = tree.replace(node, new_node_str);
+            diff = np.zeros(num_nodes + 1);
+            diff[pre_pos] = bl;
+            diff -= np.bincount(subtree_end, weights=bl, minlength=num_nodes + 1);
+            self.root_dists = np.cumsum(diff[:num_nodes])[pre_pos];
+            # A branch is on the path to the root of every node in its subtree, which is a stretch of the preorder, so
+            # each branch length is added at the start of its stretch and taken away after the end. The sum along the
+            # preorder is then the distance to the root of the node at each position.
 
-        return tree;
+        return self.root_dists;
 
     ##########
 
-    def addLabel(self, label_dict, delim=""):
-    # Given a dictionary with { node : label } format, adds those labels and the branch
-    # lengths onto the given tree's topology
-    # Returns: tree string
-
-        new_tree_str = self.tree_str;
-        # Extract labeled tree topology to add labels to
-
-        for node in self.nodes:
-            old_label = node;
-            new_label = node;
-            if self.type[node] == "tip":
-                old_label = node;
-                new_label = node;
-            # If the node is a tip, always add the node as a label
-
-            if node in label_dict:
-                if self.has_label:
-                    old_label += self.label[node];
-
-                if delim and self.has_label:
-                    new_label += self.label[node] + delim + str(label_dict[node]);
-                else:
-                    new_label += str(label_dict[node]);
-            # If the node is in the given dictionary, add the new label
-
-            # if self.has_bl and node != self.root:
-            #     new_label += ":" + str(self.bl[node]);
-            # If the tree has branch lengths, add the bl
-
-            if new_label or node == self.root:
-                new_tree_str = new_tree_str.replace(old_label, new_label);
-            # If a new label was created, replace the old node label in the
-            # tree with it
+    def nodeDist(self, node1, node2):
+    # Returns the distance along the branches between two nodes, from their distances to the root and to their LCA
 
-        return new_tree_str;
+        root_dists = self.getRootDists();
+        index = self.getTraversal().index;
+        lca = self.LCA([node1, node2]);
+        return float(root_dists[index[node1]] + root_dists[index[node2]] - 2 * root_dists[index[lca]]);
 
     ##########
 
-    def Prune(self, node_list, debug=False):
-    # Prunes a tree string by reconstructing it from sub-trees, skipping those
-    # that are to be pruned and combining branch lengths of the unpruned neighbors
-
-    ## PRUNING UNROOTED TREES IS BUGGYYYYYYYY
-
-        # unrooted = False;
-        # if not self.rooted:
-        #     unrooted = True;
-        #     self = self.Root(self.tips[0]);            
+    def patristicMatrix(self, tips=False):
+    # Returns the distances along the branches between every pair of tips as an n x n numpy array of floats, with
+    # rows and columns in the order of tips (all tips in self.tips by default).
+    #
+    # The distance between two tips is the sum of their distances to the root minus twice the distance to the root
+    # of their LCA. With the tips in order from left to right, the pairs of tips with a given LCA are the blocks
+    # between the tips of each of its descendants and those of the descendants after it, so each entry is set once.
 
-        subtrees = {};
-        # A dict of subtrees for each node in the tree
+        import numpy as np;
 
-        pruned_desc_dict = copy.deepcopy(self.desc);
-        # A local copy of the descendants dict to adjust for pruning
+        if tips is False:
+            tips = self.tips;
 
-        node_list = list(self.findClades(set(node_list)));
-        # Make sure all the nodes to prune represent monophyletic groups (else this algorithm will error)
+        root_dists = self.getRootDists();
+        index = self.getTraversal().index;
 
-        for node in self.tips:
-            if self.has_bl:
-                subtrees[node] = node + ":" + str(self.bl[node]);
+        start, end, order = {}, {}, [];
+        for node in self.postorder():
+            if self.type[node] == "tip":
+                start[node] = len(order);
+                order.append(node);
+                end[node] = len(order);
             else:
-                subtrees[node] = node;
-        ## Add tips to subtree dict
-        #####
+                start[node] = start[self.desc[node][0]];
+                end[node] = end[self.desc[node][-1]];
+        # The stretch of the tips in left to right order that descend from each node
 
+        num_tips = len(order);
+        matrix = np.empty((num_tips, num_tips));
         for node in self.internals:
-            
-            # if not self.rooted and node == self.root:
-            #     continue;
+            lca_dist = -2 * root_dists[index[node]];
+            for d in self.desc[node][:-1]:
+                matrix[start[d]:end[d], end[d]:end[node]] = lca_dist;
+                matrix[end[d]:end[node], start[d]:end[d]] = lca_dist;
+        np.fill_diagonal(matrix, -2 * root_dists[[ index[tip] for tip in order ]]);
+        # Each node is the LCA of the tips of one descendant and the tips of the descendants after it
 
-            desc_to_prune = [d for d in pruned_desc_dict[node] if d in node_list];
-            desc_to_keep = [d for d in pruned_desc_dict[node] if d not in node_list];
-            # For the current node, get which descendants to prune and which to keep
+        tip_dists = root_dists[[ index[tip] for tip in order ]];
+        matrix += tip_dists[:, None];
+        matrix += tip_dists[None, :];
 
-            if len(desc_to_prune) in [0, 2]:
-                subtrees[node] = "(";
-                for d in pruned_desc_dict[node]:
-                    subtrees[node] += subtrees[d] + ",";
-                subtrees[node] = subtrees[node][:-1] + ")" + node;
+        tip_order = [ start[tip] for tip in tips ];
+        if tip_order != list(range(num_tips)):
+            matrix = matrix[np.ix_(tip_order, tip_order)];
+        # Put the rows and columns in the order of tips
 
-                if self.has_label:
-                    subtrees[node] += str(self.label[node]);
-                if self.has_bl and node != self.root:
-                    subtrees[node] += ":" + str(self.bl[node]);
-            # If neither or both descendants are pruned, build the subtree for the current node
+        return matrix;
 
-            elif desc_to_prune:
-            # If one descendant is pruned, make adjustments
-                if node == self.root:
-                    continue;
+    ##########
 
-                anc = self.anc[node];
-                desc_to_keep = desc_to_keep[0];
-                # Unpack the node to keep and its ancestor
+    def isUltrametric(self, tol=1e-4):
+    # Checks whether all tips are the same distance from the root, to within a tolerance relative to the largest
+    # distance from the root to a tip
 
-                if self.has_bl:
-                    new_bl = str(float(self.bl[desc_to_keep]) + float(self.bl[node]));
+        root_dists = self.getRootDists();
+        index = self.getTraversal().index;
+        tip_dists = root_dists[[ index[tip] for tip in self.tips ]];
+        return bool(tip_dists.max() - tip_dists.min() <= tol * tip_dists.max());
 
-                    self.bl[desc_to_keep] = new_bl;
-                    # Update the branch length of the node in the main tree class so it is carried over
+    ##########
 
-                    subtrees[desc_to_keep] = subtrees[desc_to_keep][:subtrees[desc_to_keep].rfind(":")] + ":" + new_bl;
-                # If the tree has branch lengths, we need to add the bl of the current node with the bl
-                # of its ancestor and adjust the subtree to match
-                            
-                anc_desc_ind = pruned_desc_dict[anc].index(node);
-                pruned_desc_dict[anc][anc_desc_ind] = desc_to_keep;
-                # In the ancestral node, replace this node as a descendant with the node to keep 
-        ## Construct subtrees for each internal node, adjusting when a node needs to be pruned
-        #####
+    def indexBipartitions(self, taxa=False):
+    # Builds the bitmask index of clades for this tree (see the Bipartitions class). Once built, getClades,
+    # getSplit(s), findSplits and Monophyletic use it. Pass the same TaxonTable to compare masks between trees,
+    # which defaults to the one the tree was read with.
 
-        if any(d in node_list for d in self.desc[self.root]):
-        # If either of the nodes descending from the last (root) node are to be pruned, then the final
-        # tree is just the subtree from the other node.
-            if self.rooted:
-                desc_to_keep = [d for d in pruned_desc_dict[self.root] if d not in node_list][0];
-                pruned_tree = subtrees[desc_to_keep] + ";";
-                # Find the node that is to be kept and lookup its subtree
-                
-                if self.has_bl:
-                    pruned_tree = pruned_tree[:pruned_tree.rfind(":")];
-                # Remove the trailing branch length which led to the root
+        if taxa is False:
+            taxa = self.taxa;
+        self.bipartitions = Bipartitions(self, taxa);
+        return self.bipartitions;
 
-            else:
-                desc_to_keep = [d for d in pruned_desc_dict[self.root] if d not in node_list];
+    ##########
 
-                pruned_tree = "";
-                if len(desc_to_keep) > 1:
-                    pruned_tree = "(";
+    def writeNewick(self, label=True, support=False, bl=True, float_format=False, handle=False, node_names=False, end=";"):
+    # Writes the tree as a Newick string with writeNewick. label, support and bl can each be a function that takes a
+    # node and returns the value to write, or None to leave it out. By default the tree's own labels and branch lengths
+    # are written, and False leaves them all out. With node_names, the generated node names are written before the
+    # labels of internal nodes, as in tree_str.
 
-                for d in desc_to_keep:
-                    pruned_tree += subtrees[d] + ",";
-                pruned_tree = pruned_tree[:-1];
+        if label is True:
+            label = lambda node : self.label[node] if self.label[node] != "NA" else None;
+        if bl is True:
+            bl = lambda node : None if not self.has_bl or self.bl[node] == "NA" else (float(self.bl[node]) if float_format else self.bl[node]);
+        if node_names:
+            node_label = label;
+            label = lambda node : node + (str(node_label(node)) if node_label and node_label(node) is not None else "");
 
-                if len(desc_to_keep) > 1:
-                    pruned_tree += ")";
+        children = lambda node : self.desc[node] if self.type[node] != "tip" else None;
+        return writeNewick(self.root, children, label=label, support=support, bl=bl, float_format=float_format, handle=handle, end=end);
 
-                pruned_tree += ";"
-            # For unrooted trees, if there is more than one descendant to keep, combine the subtrees
-            # Otherwise, the final tree is just the subtree from that node to keep
+    ##########
 
-        else:
-        # If both descendants from the last (root) node are to be kept, combine them
-        # to the final tree
-            if self.rooted:
-                l = subtrees[pruned_desc_dict[self.root][0]];
-                r = subtrees[pruned_desc_dict[self.root][1]];
-                # Lookup both descendant subtrees
+    def addBranchLength(self):
+    # Re-writes the branch lengths and labels onto the tree topology with the generated node names
+    # Returns: tree string
 
-                pruned_tree = "(" + l + "," + r + ");";
+        return self.writeNewick(node_names=True, end="");
 
-            else:
-                l = subtrees[pruned_desc_dict[self.root][0]];
-                m = subtrees[pruned_desc_dict[self.root][1]];
-                r = subtrees[pruned_desc_dict[self.root][2]];
+    ##########
 
-                pruned_tree = "(" + l + "," + m + "," + r + ");";
-            # Combine the subtrees and add the last branch length if necessary
-        ## Make the final tree by combining the subtrees descending from the last (root) node
-        #####
+    def addLabel(self, label_dict, delim=""):
+    # Given a dictionary with { node : label } format, adds those labels and the branch
+    # lengths onto the given tree's topology. With delim, the new labels are added after
+    # existing ones instead of replacing them.
+    # Returns: tree string
 
-        pruned_tree = re.sub(r"<[\d]+>", "", pruned_tree);
-        # Remove the added node labels
+        def newLabel(node):
+            old_label = self.label[node] if self.has_label and self.label[node] != "NA" else None;
+            if node not in label_dict:
+                return old_label;
+            if delim and old_label is not None:
+                return old_label + delim + str(label_dict[node]);
+            return str(label_dict[node]);
 
-        # pruned_tree = Tree(pruned_tree);
+        return self.writeNewick(label=newLabel, node_names=True, end="");
 
-        # if unrooted:
-        #     pruned_tree = pruned_tree.Unroot;
+    ##########
 
-        # if ",:" in pruned_tree:
-        #     print()
+    def Prune(self, node_list, debug=False):
+    # Returns a tree string with the given nodes (and all their descendants) removed, without the generated
+    # node labels. In one pass up the tree, the number of tips kept below each node is counted. Nodes left
+    # with a single kept descendant are then removed and their branch lengths added to it.
 
-        return pruned_tree;
+        kept = { node : 1 for node in self.tips };
+        removed = set(node_list);
+
+        for node in self.nodes:
+            if node in removed:
+                kept[node] = 0;
+            elif self.type[node] != "tip":
+                kept[node] = sum(kept[d] for d in self.desc[node]);
+        # Count the tips kept below each node. Tree.nodes lists descendants before their ancestors, and
+        # removed nodes stay at 0
+
+        def collapse(node, bl):
+        # Follows a chain of nodes with only one kept descendant, adding up the branch lengths
+            while self.type[node] != "tip":
+                kept_desc = [ d for d in self.desc[node] if kept[d] ];
+                if len(kept_desc) != 1:
+                    break;
+                node = kept_desc[0];
+                if self.has_bl:
+                    bl = str(round(float(bl) + float(self.bl[node]), 10));
+            return node, bl;
+
+        new_bl = {};
+        def keptDesc(node):
+        # The kept descendants of a node, after collapsing, with their new branch lengths
+            if self.type[node] == "tip":
+                return None;
+            desc = [];
+            for d in self.desc[node]:
+                if kept[d]:
+                    d, d_bl = collapse(d, self.bl[d]);
+                    new_bl[d] = d_bl;
+                    desc.append(d);
+            return desc;
+
+        top, top_bl = collapse(self.root, "0");
+        return writeNewick(top, keptDesc,
+                            label=lambda node : self.label[node] if self.label[node] not in ["NA", ""] else None,
+                            bl=lambda node : new_bl[node] if self.has_bl and new_bl[node] != "NA" else None);
+        # The branch length to the root is not written
 
     ##########
 
@@ -1260,99 +1328,94 @@ class Tree:
     def Root(self, node_list):
     # A function to root or re-root a tree
     # Node list can either be multiple tips or a single internal node
+    # Returns False if the tree can't be rooted on the given nodes
 
-        if self.rooted:
-            self = self.Unroot();
-        # If the tree is rooted, unroot it first
-
-        if all(node in self.tips for node in node_list):
-        # If a list of tips is given as input
-        
-            if self.Monophyletic(node_list):
-                new_root = self.LCA(node_list);
-            # If the tips form a monophyletic group, then their LCA is the new root node
-
-            else:
-                if self.LCA(node_list) == self.root:
-                # If the LCA of the given tips is the root (of an unrooted tree), then we
-                # try to root on the remaining tips
-
-                    possible_split = [ tip for tip in self.tips if tip not in node_list ];
-                    # Get all the other tips to check if they form a monophyletic group
-
-                    if self.Monophyletic(possible_split):
-                        print("rooting on ingroup")
-                        new_root = self.LCA(possible_split);
-                    # If the remaining tips form a monophyletic group, the new root node is their LCA
-
-                else:
-                    print("cannot root");
-                    return False;
-                # If we can't root on either the provided tips or their complement, we cannot root this tree because
-                # the given tips are paraphyletic
-            ##
-
-        elif len(node_list) > 1:
-            print("can't root on both tips and internal nodes or multiple internal nodes")
+        tree_str = self.rootString(node_list);
+        if not tree_str:
             return False;
-        # If the list isn't all tips and is longer than 1 entry, we can't root it
-
-        else:
-            new_root = node_list[0];
-        # If the given node list is 1 entry long and it is an internal node, root on that node
+        return Tree(tree_str);
 
-        subtrees = self.genSubtrees();
-        # Parse the subtrees at each node in the tree
+    ##########
 
-        anc = self.anc[new_root];
-        sis = self.sis[new_root];
-        # Get the ancestral node and sister node of the new root
+    def rootString(self, node_list):
+    # Returns the tree string for this tree rooted on the branch above the given nodes, without re-parsing it.
+    # Node list can either be multiple tips, which must form a clade on one side of a branch in the unrooted
+    # tree, or a single internal node. Returns False if the tree can't be rooted on the given nodes.
+    #
+    # The edges on the path from the new root to the old one are reversed, taking their branch lengths and
+    # labels (e.g. support values) with them. The branch the root is placed on is split in half and a
+    # bifurcating old root is removed by joining its two branches.
 
-        if self.has_bl:
-            root_bl = float(self.bl[new_root]);
-            new_root_bl = ":" + str(root_bl / 2);
-            # For the new branch length, just divide the old one by 2... probably not the best...
+        if all(node in self.type and self.type[node] == "tip" for node in node_list):
+            node_set = set(node_list);
+            other_tips = [ tip for tip in self.tips if tip not in node_set ];
+            if not other_tips:
+                return False;
+            # Can't root on all the tips
 
-            tree_str = "(" + subtrees[new_root].replace(":" + self.bl[new_root], new_root_bl);
-            # Start by adding the subtree at the new root to the new tree string
+            if self.Monophyletic(node_list):
+                new_root = self.LCA(node_list);
+            elif self.Monophyletic(other_tips):
+                new_root = self.LCA(other_tips);
+            else:
+                return False;
+            # The new root goes above the LCA of either the given tips or the rest of the tips (the ingroup),
+            # whichever is a clade in the current rooting. If neither is, the given tips are paraphyletic.
 
+        elif len(node_list) == 1 and node_list[0] in self.type:
+            new_root = node_list[0];
         else:
-            new_root_bl = "";
-            tree_str = "(" + subtrees[new_root];
-            # Start by adding the subtree at the new root to the new tree string
-        ## Initialize the new rooted tree with the root and its branch length (if the input tree had them)
-
-
-        closings = [];
-        # Closings is a list of closing parentheses (and branch lengths)
-        # As each subtree is added to the tree string, an opening parentheses is added and will
-        # need to be closed
-
-        while anc != self.root:
-        # This loops through every node, starting from the new root node
-
-            tree_str +=  ",(" + subtrees[sis[0]];
-            # Add the subtree from the SISTER node to the tree string, again as a sister
-
-            if self.has_bl:
-                closings.append("):" + self.bl[anc]);
-            else:
-                closings.append(")");
-            # Add a closing parentheses (and branch length) to the closings list for this subtree
+            return False;
+        # Otherwise root on a single internal node
 
-            sis = self.sis[anc];
-            anc = self.anc[sis[0]];
-            # Get the next SISTER branch, which is sister of the ancestor to the current ancestor
-            # and the next ancestor
-        ## End subtree rooting loop            
+        if new_root == self.root:
+            return False;
+        # Can't root above the root
+
+        half_bl = lambda bl : "NA" if bl == "NA" else str(float(bl) / 2);
+        sum_bl = lambda bl1, bl2 : "NA" if "NA" in (bl1, bl2) else str(round(float(bl1) + float(bl2), 10));
+
+        new_desc, new_bl, new_label = {}, {}, {};
+        new_bl[new_root] = half_bl(self.bl[new_root]);
+        new_desc[None] = [new_root];
+        new_bl[None], new_label[None] = "NA", "NA";
+        # None is the new root, with the given node on one side of the split branch
+
+        parent_children = new_desc[None];
+        prev, node = new_root, self.anc[new_root];
+        edge_bl, edge_label = new_bl[new_root], "NA";
+        # The branch and label above node in the new tree, starting with the other half of the split branch
+
+        while True:
+            children = [ d for d in self.desc[node] if d != prev ];
+
+            if node == self.root and len(children) == 1:
+                child = children[0];
+                new_bl[child] = sum_bl(self.bl[child], edge_bl);
+                new_label[child] = self.label[child] if self.label[child] != "NA" else edge_label;
+                parent_children.append(child);
+                break;
+            # Remove a bifurcating old root by joining its two branches
+
+            new_bl[node], new_label[node] = edge_bl, edge_label;
+            new_desc[node] = children;
+            parent_children.append(node);
+            # Add this node below the previous one on the path, with its other descendants
 
-        tree_str += ",(" + subtrees[sis[0]] + "," + subtrees[sis[1]] + "".join(reversed(closings)) + ")" + new_root_bl + ");";
-        # Add both other branches that are sister to the current branch descending from the root of the tree, then add
-        # the closing parentheses and the remainder of the original branch length
+            if node == self.root:
+                break;
 
-        rooted_tree = Tree(tree_str);
+            parent_children = children;
+            edge_bl, edge_label = self.bl[node], self.label[node];
+            prev, node = node, self.anc[node];
+            # The reversed branch to the next node up carries the branch length and label of this node
+        ## End path reversal loop
 
-        return rooted_tree;
+        children = lambda node : new_desc[node] if node in new_desc else (self.desc[node] if self.type[node] != "tip" else None);
+        label = lambda node : new_label[node] if node in new_label else self.label[node];
+        bl = lambda node : new_bl[node] if node in new_bl else self.bl[node];
+        return writeNewick(None, children, label=lambda node : label(node) if label(node) != "NA" else None,
+                            bl=lambda node : bl(node) if self.has_bl and bl(node) != "NA" else None);
 
     ##########
 
@@ -1461,64 +1524,2952 @@ class Tree:
 
 ## END TREE CLASS
 #############################################################################
-## BEGIN TREE STRING FUNCTIONS
+## BEGIN COMPACT TREE CLASSES
 
-def remBranchLength(tree_str):
-# Removes branch lengths and labels from a tree string
+class TaxonTable:
+# A table of interned tip labels that can be shared by many trees, so each label is only stored once
+# and every taxon has the same integer id in every tree that uses the table
 
-    tree_str = re.sub(r'[)][\d\w<>/.eE_:-]+', ')', tree_str);
-    tree_str = re.sub(r':[\d.eE-]+', '', tree_str);
+    __slots__ = ("labels", "index");
 
-    return tree_str;
+    def __init__(self, labels=False):
+        self.labels = [];
+        self.index = {};
+        # The list of labels, where the position is the id, and the reverse lookup
 
-#############################################################################
+        if labels:
+            for label in labels:
+                self.getId(label);
 
-def getSubtree(node, tree_str):
-# Gets the subtree string at a given node from a labeled tree string from treeParse
-# Much slower than genSubtrees method
+    ##########
 
-    subtree = "";
-    # Initialize the subtree string
+    def getId(self, label):
+    # Returns the id of a label, adding it to the table if it hasn't been seen yet
 
-    partree = tree_str[:tree_str.index(node)][::-1]
-    # Slice the tree string at the index of the node label and reverse it
+        taxon_id = self.index.get(label);
+        if taxon_id is None:
+            taxon_id = len(self.labels);
+            label = sys.intern(label);
+            self.labels.append(label);
+            self.index[label] = taxon_id;
 
-    cp = 0;
-    op = 0;
-    # Counts of closing an opening parentheses. The subtree will be complete when they
-    # are equal
+        return taxon_id;
 
-    for c in partree:
-        if c == ")":
-            cp = cp + 1;
-        if c == "(":
-            op = op + 1;
-        subtree = subtree + c;
-        if cp == op:
-            break;
-    # Loop through every character in the sliced and reversed tree, counting parentheses and adding
-    # charcters to the subtree string one at a time. Stop when the number of closing parentheses equals
-    # the number of opening
+#############################################################################
 
-    return subtree[::-1];
-    # Return the reverse of the subtree, which is the original orientation
+class CompactTree:
+# An array based version of Tree for holding many trees in memory at once.
+#
+# Nodes are integer ids. Internal nodes come first so that node <N> from Tree has id N-1 and the root is
+# the last internal node. Tips follow in the same order as Tree.tips. The topology is stored as an array
+# of ancestor ids and an array of descendant ids with offsets for each node (the descendants of node i
+# are children[child_start[i]:child_start[i+1]]). Branch lengths are float64 (nan when missing) and tips
+# are stored as ids in a TaxonTable that can be shared between trees.
+#
+# Methods take and return node labels in the same format as Tree so code can switch between them.
+
+    __slots__ = ("taxa", "anc", "child_start", "children", "bl", "taxon", "label", "depth", "root", "num_tips",
+                    "num_internals", "num_nodes", "num_polytomies", "binary", "rooted", "has_bl", "has_label", "tip_nodes");
+
+    def __init__(self, taxa, num_internals, anc, desc, bl, tip_labels, labels):
+    # Builds the arrays from per-node lists indexed by node id. Use from_tree() or from_string() rather
+    # than calling this directly.
+
+        self.taxa = taxa;
+        self.num_internals = num_internals;
+        self.num_nodes = len(anc);
+        self.num_tips = self.num_nodes - num_internals;
+        self.root = num_internals - 1;
+        # Node counts and the root, which is always the last internal node
+
+        self.anc = array.array('l', anc);
+        self.child_start = array.array('l', [0] * (self.num_nodes + 1));
+        self.children = array.array('l');
+        self.num_polytomies = 0;
+        for node in range(num_internals):
+            self.children.extend(desc[node]);
+            self.child_start[node+1] = len(self.children);
+            if len(desc[node]) > 2:
+                self.num_polytomies += 1;
+        for node in range(num_internals, self.num_nodes):
+            self.child_start[node+1] = len(self.children);
+        # The descendants of all nodes in a single array with offsets
+
+        self.binary = self.num_polytomies == 0;
+        self.rooted = len(desc[self.root]) <= 2;
+        # Same definitions as Tree
+
+        self.bl = array.array('d', bl);
+        self.has_bl = any(b == b for b in self.bl);
+        # Branch lengths, with nan (which is not equal to itself) for missing ones
+
+        self.taxon = array.array('l', [ taxa.getId(label) for label in tip_labels ]);
+        # Tip labels as ids in the taxon table
+
+        if any(labels):
+            self.label = tuple(sys.intern(l) if l else None for l in labels);
+            self.has_label = True;
+        else:
+            self.label = None;
+            self.has_label = False;
+        # Internal node labels are only stored if there are any
 
-#############################################################################
+        self.depth = None;
+        # The number of edges between each node and the root, built only when needed by getDepth
 
-# def adjustTreeDict(tree_dict, root):
-# # Gets some info about branch lengths from the tree dict and retrieves support
-# # label
+        self.tip_nodes = None;
+        # The map of taxon ids to tip node ids, built only when needed
 
-#     num_no_supp = 0;
-#     # Number of nodes with no support
+    ##########
 
-#     bls = [];
-#     # A list of all branch lengths in the tree
+    @classmethod
+    def from_arrays(cls, taxa, num_internals, anc, child_start, children, bl, taxon, label):
+    # Builds a CompactTree around existing arrays without copying them, for views of trees in a TreeCache.
+    # The arrays can be any indexable type, but lists are fastest to read one element at a time, so TreeCache
+    # reads its memory maps into lists a block of trees at a time. label is a tuple of internal node labels
+    # (None for no label) or None.
+
+        tree = cls.__new__(cls);
+        tree.taxa = taxa;
+        tree.num_internals = int(num_internals);
+        tree.num_nodes = len(anc);
+        tree.num_tips = tree.num_nodes - tree.num_internals;
+        tree.root = tree.num_internals - 1;
+
+        tree.anc = anc;
+        tree.child_start = child_start;
+        tree.children = children;
+        tree.bl = bl;
+        tree.taxon = taxon;
+        tree.label = label;
+        tree.has_label = label is not None;
+        tree.has_bl = any(b == b for b in bl);
+        tree.tip_nodes = None;
+
+        tree.num_polytomies = sum(1 for node in range(tree.num_internals) if child_start[node+1] - child_start[node] > 2);
+        tree.binary = tree.num_polytomies == 0;
+        tree.rooted = child_start[tree.root+1] - child_start[tree.root] <= 2;
+        # Same definitions as Tree
+
+        tree.depth = None;
+        # Same as in __init__
 
-#     na_bl_spec = [];
-#     # A list of species that have no branch length (i.e. tips from Astral)
+        return tree;
 
-#     for n in tree_dict:
+    ##########
+
+    @classmethod
+    def from_string(cls, tree_str, taxa=False):
+    # Builds a CompactTree directly from a Newick string without building a Tree
+
+        if not taxa:
+            taxa = TaxonTable();
+
+        tree = tree_str.strip();
+        if tree[-1] != ";":
+            tree += ";";
+        scan = scanNewick(tree);
+
+        ids = [-1] * len(scan['text']);
+        num_internals = 0;
+        for level in scan['levels']:
+            for node_ind in level:
+                ids[node_ind] = num_internals;
+                num_internals += 1;
+        node_id = num_internals;
+        for node_ind in scan['tips']:
+            ids[node_ind] = node_id;
+            node_id += 1;
+        # Internal ids follow the <N> numbering of Tree, then tips in order
+
+        anc, desc, bl = [-1] * node_id, [[]] * num_internals, [float("nan")] * node_id;
+        tip_labels, labels = [""] * (node_id - num_internals), [None] * num_internals;
+        for node_ind in range(len(ids)):
+            node = ids[node_ind];
+            if scan['anc'][node_ind] != -1:
+                anc[node] = ids[scan['anc'][node_ind]];
+                if scan['bl'][node_ind] not in ["NA", ""]:
+                    bl[node] = float(scan['bl'][node_ind]);
+            # Root branch lengths and labels are ignored, as in Tree
+
+            if scan['type'][node_ind] == "tip":
+                tip_labels[node - num_internals] = scan['text'][node_ind];
+            else:
+                desc[node] = [ ids[d] for d in scan['desc'][node_ind] ];
+                if scan['anc'][node_ind] != -1 and scan['text'][node_ind]:
+                    labels[node] = scan['text'][node_ind];
+
+        return cls(taxa, num_internals, anc, desc, bl, tip_labels, labels);
+
+    ##########
+
+    @classmethod
+    def from_tree(cls, tree, taxa=False):
+    # Builds a CompactTree from a Tree object
+
+        if not taxa:
+            taxa = TaxonTable();
+
+        num_internals = tree.num_internals;
+        ids = { node : int(node[1:-1]) - 1 for node in tree.internals };
+        for tip in tree.tips:
+            ids[tip] = len(ids);
+        # Internal ids follow the <N> numbering, then tips in order
+
+        anc, desc, bl = [-1] * len(ids), [[]] * num_internals, [float("nan")] * len(ids);
+        labels = [None] * num_internals;
+        for node in tree.nodes:
+            node_id = ids[node];
+            if node == tree.root:
+                desc[node_id] = [ ids[d] for d in tree.desc[node] ];
+                continue;
+
+            anc[node_id] = ids[tree.anc[node]];
+            if tree.has_bl:
+                bl[node_id] = float(tree.bl[node]);
+
+            if tree.type[node] != "tip":
+                desc[node_id] = [ ids[d] for d in tree.desc[node] ];
+                if tree.label[node] not in ["NA", ""]:
+                    labels[node_id] = tree.label[node];
+        # Tree fills in missing labels with NA, so those are treated as no label
+
+        return cls(taxa, num_internals, anc, desc, bl, tree.tips, labels);
+
+    ##########
+
+    def to_tree(self):
+    # Converts back to a Tree object. Node labels are the same since the descendant order is kept.
+
+        return Tree(self.toNewick());
+
+    ##########
+
+    def nodeName(self, node):
+    # Returns the Tree style label for a node id
+
+        if node < self.num_internals:
+            return "<" + str(node + 1) + ">";
+        return self.taxa.labels[self.taxon[node - self.num_internals]];
+
+    ##########
+
+    def nodeId(self, name):
+    # Returns the node id for a Tree style node label
+
+        if self.tip_nodes is None:
+            self.tip_nodes = { self.taxon[i] : self.num_internals + i for i in range(self.num_tips) };
+
+        taxon_id = self.taxa.index.get(name);
+        if taxon_id is not None and taxon_id in self.tip_nodes:
+            return self.tip_nodes[taxon_id];
+        if name.startswith("<") and name.endswith(">"):
+            return int(name[1:-1]) - 1;
+        raise KeyError(name);
+
+    ##########
+
+    @property
+    def tips(self):
+    # The tip labels in the same order as Tree.tips
+
+        return [ self.taxa.labels[taxon_id] for taxon_id in self.taxon ];
+
+    ##########
+
+    def getMasks(self, taxa=False):
+    # Returns a list of the clade of each node id as a bitmask of taxon ids. If a different TaxonTable is given,
+    # the masks use its ids instead.
+
+        masks = [0] * self.num_nodes;
+        for node in range(self.num_internals, self.num_nodes):
+            taxon_id = int(self.taxon[node - self.num_internals]);
+            if taxa and taxa is not self.taxa:
+                taxon_id = taxa.getId(self.taxa.labels[taxon_id]);
+            masks[node] = 1 << taxon_id;
+        for node in range(self.num_internals):
+            for d in self.getDesc(node):
+                masks[node] |= masks[d];
+        # Internal node ids are always larger than those of their internal descendants, so each node's
+        # descendants are done first
+
+        return masks;
+
+    ##########
+
+    def getSplits(self, taxa=False):
+    # Same as getSplits for a Tree: the unrooted splits as a dict of bitmask : branch length
+
+        masks = self.getMasks(taxa);
+        all_tips = masks[self.root];
+        low_tip = all_tips & -all_tips;
+
+        splits = {};
+        for node in range(self.num_nodes):
+            if node == self.root:
+                continue;
+
+            mask = masks[node];
+            if mask & low_tip:
+                mask = all_tips ^ mask;
+            if not mask:
+                continue;
+
+            bl = float(self.bl[node]);
+            splits[mask] = splits.get(mask, 0.0) + (bl if bl == bl else 0.0);
+        # Missing branch lengths (nan) count as 0
+
+        return splits;
+
+    ##########
+
+    def getDepth(self):
+    # Returns the number of edges between each node id and the root, building them the first time
+
+        if self.depth is None:
+            self.depth = array.array('l', [0] * self.num_nodes);
+            for node in range(self.root - 1, -1, -1):
+                self.depth[node] = self.depth[self.anc[node]] + 1;
+            for node in range(self.num_internals, self.num_nodes):
+                self.depth[node] = self.depth[self.anc[node]] + 1;
+        # Ancestors of internal nodes always have larger ids, so going down from the root fills in each node
+        # after its ancestor
+
+        return self.depth;
+
+    ##########
+
+    def getDesc(self, node):
+    # Returns the ids of the direct descendants of a node id
+
+        return self.children[self.child_start[node]:self.child_start[node+1]];
+
+    ##########
+
+    def getClade(self, node, full=False):
+    # Same as Tree.getClade, returning the tip labels (and internal node labels if full is set) that descend
+    # from a node in the same order, but with a stack instead of recursion
+
+        node = self.nodeId(node);
+        if node >= self.num_internals:
+            return [self.nodeName(node)];
+
+        clade = [];
+        stack = list(reversed(self.getDesc(node)));
+        while stack:
+            cur_node = stack.pop();
+            if cur_node < 0:
+                clade.append(self.nodeName(~cur_node));
+            # Negative entries mark internal nodes to add after their descendants
+
+            elif cur_node >= self.num_internals:
+                clade.append(self.nodeName(cur_node));
+
+            else:
+                if full:
+                    stack.append(~cur_node);
+                stack.extend(reversed(self.getDesc(cur_node)));
+
+        return clade;
+
+    ##########
+
+    def getSplit(self, node):
+    # Same as Tree.getSplit, the tips that do not descend from a node
+
+        if self.nodeId(node) == self.root:
+            return "NA";
+
+        return set(self.nodeName(n) for n in range(self.num_internals, self.num_nodes)) - set(self.getClade(node));
+
+    ##########
+
+    def LCA(self, node_list):
+    # Same as Tree.LCA, returning the label of the least common ancestor of a list of nodes. Each pair of
+    # nodes is brought to the same depth and then moved up together.
+
+        depth = self.getDepth();
+        lca = self.nodeId(node_list[0]);
+        for node in node_list[1:]:
+            node = self.nodeId(node);
+
+            while depth[node] > depth[lca]:
+                node = self.anc[node];
+            while depth[lca] > depth[node]:
+                lca = self.anc[lca];
+            while node != lca:
+                node = self.anc[node];
+                lca = self.anc[lca];
+
+        return self.nodeName(lca);
+
+    ##########
+
+    def Prune(self, node_list):
+    # Same as Tree.Prune, returning a tree string with the given nodes (and all their descendants) removed.
+    # Nodes left with a single descendant are removed and their branch lengths are added to it.
+
+        kept = array.array('l', [1] * self.num_nodes);
+        for node in node_list:
+            kept[self.nodeId(node)] = 0;
+
+        for node in range(self.num_internals):
+            if kept[node]:
+                kept[node] = sum(kept[d] for d in self.getDesc(node));
+        # Count the tips kept below each node. Descendant ids are always smaller for internal nodes so
+        # each node's descendants are counted first. Pruned internal nodes stay at 0.
+
+        return self.toNewick(kept);
+
+    ##########
+
+    def toNewick(self, kept=False):
+    # Writes the tree as a Newick string without the generated node labels. If given, kept is an array of
+    # the number of tips kept below each node: nodes at 0 are skipped and nodes with a single kept
+    # descendant are collapsed.
+
+        def collapse(node, bl):
+        # Follows a chain of nodes with only one kept descendant, adding up the branch lengths
+            while kept and node < self.num_internals:
+                kept_desc = [ d for d in self.getDesc(node) if kept[d] ];
+                if len(kept_desc) != 1:
+                    break;
+                node = kept_desc[0];
+                bl += self.bl[node];
+            return node, bl;
+
+        new_bl = {};
+        def keptDesc(node):
+        # The kept descendants of a node, after collapsing, with their new branch lengths
+            if node >= self.num_internals:
+                return None;
+            desc = [];
+            for d in self.getDesc(node):
+                if not kept or kept[d]:
+                    d, d_bl = collapse(d, self.bl[d]);
+                    new_bl[d] = d_bl;
+                    desc.append(d);
+            return desc;
+
+        top, top_bl = collapse(self.root, 0.0);
+        return writeNewick(top, keptDesc, name=self.nodeName,
+                            label=lambda node : self.label[node] if self.has_label and self.label[node] else None,
+                            bl=lambda node : new_bl[node] if new_bl[node] == new_bl[node] else None);
+        # The branch length to the root is not written and missing branch lengths (nan) are skipped
+
+## END COMPACT TREE CLASSES
+#############################################################################
+## BEGIN BIPARTITION INDEX CLASS
+
+class Bipartitions:
+# An index of the clades in a Tree as integer bitmasks, where each tip is a bit given by its id in a
+# TaxonTable. The masks are computed in one pass over the nodes, since Tree.nodes always lists
+# descendants before their ancestors. Subset and equality tests between clades and splits are then
+# integer operations, and a dict from mask to node finds the node for a set of tips.
+#
+# Sharing one TaxonTable between trees makes masks from different trees directly comparable.
+
+    __slots__ = ("taxa", "clade", "all_tips", "node", "root");
+
+    def __init__(self, tree, taxa=False):
+
+        if not taxa:
+            taxa = TaxonTable();
+        self.taxa = taxa;
+        self.root = tree.root;
+
+        self.clade = {};
+        for tip in tree.tips:
+            self.clade[tip] = 1 << taxa.getId(tip);
+        # The mask for each tip is a single bit
+
+        for node in tree.nodes:
+            if tree.type[node] != "tip":
+                mask = 0;
+                for d in tree.desc[node]:
+                    mask |= self.clade[d];
+                self.clade[node] = mask;
+        # The mask for each internal node is the union of its descendants
+
+        self.all_tips = self.clade[tree.root];
+        self.node = { mask : node for node, mask in self.clade.items() };
+        # The lookup of nodes by their clade mask
+
+    ##########
+
+    def getMask(self, tips):
+    # Returns the mask for a set of tip labels, or False if any label isn't in the taxon table
+
+        mask = 0;
+        for tip in tips:
+            taxon_id = self.taxa.index.get(tip);
+            if taxon_id is None:
+                return False;
+            mask |= 1 << taxon_id;
+        return mask;
+
+    ##########
+
+    def getTips(self, mask):
+    # Returns the set of tip labels in a mask
+
+        tips = set();
+        while mask:
+            low_bit = mask & -mask;
+            tips.add(self.taxa.labels[low_bit.bit_length() - 1]);
+            mask ^= low_bit;
+        return tips;
+
+    ##########
+
+    def split(self, node):
+    # Returns the mask of the tips that don't descend from a node
+
+        return self.all_tips & ~self.clade[node];
+
+    ##########
+
+    def isSubset(self, node, other_node):
+    # Checks whether the clade of one node is contained in the clade of another
+
+        return self.clade[node] & ~self.clade[other_node] == 0;
+
+    ##########
+
+    def findClade(self, tips):
+    # Returns the node whose clade is exactly the given tips, or False if there isn't one
+
+        mask = self.getMask(tips);
+        if mask is False:
+            return False;
+        return self.node.get(mask, False);
+
+    ##########
+
+    def findSplits(self, tip_set):
+    # Same as Tree.findSplits: the nodes whose clade or split is exactly the given tips
+
+        split_nodes = set();
+        mask = self.getMask(tip_set);
+        if mask is False or mask & ~self.all_tips:
+            return split_nodes;
+        # Tips not in the tree can't match any clade or split
+
+        if mask in self.node:
+            split_nodes.add(self.node[mask]);
+        # A node with the tips as its clade
+
+        split_node = self.node.get(self.all_tips & ~mask);
+        if split_node is not None and split_node != self.root:
+            split_nodes.add(split_node);
+        # A node with the tips as its split, which is the complement of its clade. The root has no split.
+
+        return split_nodes;
+
+## END BIPARTITION INDEX CLASS
+#############################################################################
+## BEGIN LCA INDEX CLASS
+
+class LCAIndex:
+# Constant time least common ancestor queries from an Euler tour of the tree and a sparse table of
+# minimum depths along the tour.
+#
+# The Euler tour lists every node each time it is visited on a walk down and back up the tree, so the
+# LCA of two nodes is the shallowest node visited between their first visits. The sparse table stores
+# the position of the shallowest node in every stretch of the tour with a length that is a power of 2,
+# so any stretch is covered by two overlapping entries.
+#
+# Takes the root and a dict of descendants like Tree.desc, where tips have no list of descendants.
+
+    __slots__ = ("euler", "depth", "first", "table", "num_tips");
+
+    def __init__(self, root, desc):
+
+        self.euler = [];
+        depth = [];
+        self.first = {};
+        self.num_tips = {};
+        # The nodes in the tour, their depths, the first position of each node, and the number of
+        # tips descending from each node
+
+        stack = [(root, 0, 0)];
+        while stack:
+            node, cur_depth, desc_ind = stack.pop();
+            if desc_ind == 0:
+                self.first[node] = len(self.euler);
+                self.num_tips[node] = 0;
+
+            self.euler.append(node);
+            depth.append(cur_depth);
+
+            node_desc = desc.get(node);
+            if isinstance(node_desc, list) and desc_ind < len(node_desc):
+                stack.append((node, cur_depth, desc_ind + 1));
+                stack.append((node_desc[desc_ind], cur_depth + 1, 0));
+            # Go to the next descendant, returning to this node after it
+
+            else:
+                if not isinstance(node_desc, list):
+                    self.num_tips[node] = 1;
+                if stack:
+                    self.num_tips[stack[-1][0]] += self.num_tips[node];
+            # All descendants visited, so add its tips to its ancestor, which is next on the stack
+        ## Euler tour without recursion
+
+        self.depth = array.array('l', depth);
+        self.table = [ array.array('l', range(len(self.euler))) ];
+        span = 1;
+        while span * 2 <= len(self.euler):
+            prev = self.table[-1];
+            cur = array.array('l', prev[:len(self.euler) - span * 2 + 1]);
+            for i in range(len(cur)):
+                if self.depth[prev[i + span]] < self.depth[cur[i]]:
+                    cur[i] = prev[i + span];
+            self.table.append(cur);
+            span *= 2;
+        # Each level of the table holds the position of the shallowest node in the stretch of the tour
+        # starting at each position, with stretches doubling in length at each level
+
+    ##########
+
+    def query(self, start, end):
+    # Returns the shallowest node between two positions in the tour
+
+        level = (end - start + 1).bit_length() - 1;
+        left = self.table[level][start];
+        right = self.table[level][end - (1 << level) + 1];
+        if self.depth[right] < self.depth[left]:
+            return self.euler[right];
+        return self.euler[left];
+
+    ##########
+
+    def LCA(self, node_list):
+    # Returns the LCA of any number of nodes, which is the shallowest node between the earliest and
+    # latest first visits of the nodes in the tour
+
+        positions = [ self.first[node] for node in node_list ];
+        return self.query(min(positions), max(positions));
+
+## END LCA INDEX CLASS
+#############################################################################
+## BEGIN TRAVERSAL INDEX CLASS
+
+class TraversalIndex:
+# Preorder, postorder and level order traversals of a tree, computed once with a stack and a queue instead of
+# recursion and stored as arrays of indices into the list of nodes.
+#
+# In preorder and postorder the subtree of any node is a contiguous stretch of the array: it starts at the node
+# in preorder and ends at it in postorder, and its length is the number of nodes in the subtree. So the nodes
+# below a node can be read from a slice without walking the tree again.
+#
+# Takes the list of nodes, the root, and a dict of descendants like Tree.desc, where tips have no list of descendants.
+
+    __slots__ = ("index", "pre", "post", "level", "pre_pos", "post_pos", "size");
+
+    def __init__(self, nodes, root, desc):
+
+        self.index = { node : i for i, node in enumerate(nodes) };
+        num_nodes = len(nodes);
+
+        self.pre = array.array('l');
+        self.post = array.array('l');
+        self.pre_pos = array.array('l', [0] * num_nodes);
+        self.post_pos = array.array('l', [0] * num_nodes);
+        self.size = array.array('l', [1] * num_nodes);
+        # The orders, the position of each node in them, and the number of nodes in each subtree
+
+        stack = [(self.index[root], False)];
+        while stack:
+            node_ind, closing = stack.pop();
+
+            if closing:
+                self.post_pos[node_ind] = len(self.post);
+                self.post.append(node_ind);
+                self.size[node_ind] = len(self.pre) - self.pre_pos[node_ind];
+                continue;
+            # Closing a node after all its descendants, which all come after it in the preorder
+
+            self.pre_pos[node_ind] = len(self.pre);
+            self.pre.append(node_ind);
+            stack.append((node_ind, True));
+
+            node_desc = desc[nodes[node_ind]];
+            if isinstance(node_desc, list):
+                for d in reversed(node_desc):
+                    stack.append((self.index[d], False));
+            # Descendants go on the stack in reverse so they come off left to right
+        ## Preorder and postorder without recursion
+
+        self.level = array.array('l', [self.index[root]]);
+        i = 0;
+        while i < len(self.level):
+            node_desc = desc[nodes[self.level[i]]];
+            if isinstance(node_desc, list):
+                self.level.extend(self.index[d] for d in node_desc);
+            i += 1;
+        # Level order, using the array itself as the queue
+
+## END TRAVERSAL INDEX CLASS
+#############################################################################
+## BEGIN TREE FILE FUNCTIONS
+
+class TreeLine:
+# One line of a tree file as read by iter_trees. The tree is parsed as requested, or if it couldn't
+# be, tree is None and error has the reason.
+# num: the line number, starting at 1
+# tid: the tree id for lines in "id<TAB>tree" format (e.g. best-trees.txt files), otherwise False
+# line: the full line, stripped
+# tree_str: the tree string from the line
+
+    __slots__ = ("num", "tid", "line", "tree_str", "tree", "error");
+
+    def __init__(self, num, tid, line, tree_str, tree=None, error=None):
+        self.num = num;
+        self.tid = tid;
+        self.line = line;
+        self.tree_str = tree_str;
+        self.tree = tree;
+        self.error = error;
+
+#############################################################################
+
+def openTreeFile(filename, binary=False):
+# Opens a tree file for reading text, or bytes with binary, whether it is gzipped or not
+
+    with open(filename, "rb") as tree_file:
+        magic = tree_file.read(2);
+    if magic == b"\x1f\x8b":
+        return gzip.open(filename, "rb" if binary else "rt");
+    return open(filename, "rb" if binary else "r");
+
+#############################################################################
+
+def iter_trees(filename, parser="tree", taxa=False):
+# Reads a file of trees, one per line, and yields a TreeLine for each line. The file can be gzipped and
+# lines can have a tree id before the tree separated by a tab.
+# parser: "tree" for Tree objects, "compact" for CompactTree objects, False to only split the lines, or
+#         a function that takes a tree string (e.g. treeparse.treeParse)
+# taxa: a TaxonTable shared by all trees read
+
+    if parser == "tree":
+        parse = lambda tree_str : Tree(tree_str, taxa=taxa);
+    elif parser == "compact":
+        parse = lambda tree_str : CompactTree.from_string(tree_str, taxa);
+    else:
+        parse = parser;
+    # Set the function used to parse each tree
+
+    with openTreeFile(filename) as tree_file:
+        for num, line in enumerate(tree_file, 1):
+            line = line.strip();
+            tid, tree_str = False, line;
+            if "\t" in line:
+                tid, tree_str = line.rsplit("\t", 1);
+            # Trees can't contain tabs, so anything before the last one is the tree id
+
+            if not tree_str:
+                yield TreeLine(num, tid, line, tree_str, error="Empty line");
+                continue;
+
+            if not parse:
+                yield TreeLine(num, tid, line, tree_str);
+                continue;
+
+            try:
+                tree = parse(tree_str);
+            except Exception as e:
+                yield TreeLine(num, tid, line, tree_str, error=type(e).__name__ + ": " + str(e));
+                continue;
+            # Lines that can't be read are returned with the error instead of a tree
+
+            yield TreeLine(num, tid, line, tree_str, tree);
+
+#############################################################################
+
+class TreeCollection:
+# A file of trees to loop over. Every tree read shares the same TaxonTable, and the number of lines
+# read and the lines that couldn't be read are counted on each pass through the file.
+
+    def __init__(self, filename, parser="tree", taxa=False):
+        self.filename = filename;
+        self.parser = parser;
+        self.taxa = taxa if taxa else TaxonTable();
+
+        self.num_lines = 0;
+        self.num_trees = 0;
+        self.skipped = [];
+        # Line counts and the line numbers (as strings, for printing) that couldn't be read
+
+    ##########
+
+    def __iter__(self):
+
+        self.num_lines, self.num_trees, self.skipped = 0, 0, [];
+        for tree_line in iter_trees(self.filename, self.parser, self.taxa):
+            self.num_lines += 1;
+            if tree_line.error:
+                self.skipped.append(str(tree_line.num));
+            else:
+                self.num_trees += 1;
+            yield tree_line;
+
+#############################################################################
+
+def blTransform(op=False, factor=1.0, digits=False, min_bl=False):
+# Returns a function that changes a branch length, for rewriteNewick. op is one of "*", "/", "+" or "-" to apply
+# with factor, then the result is rounded to a number of digits and raised to min_bl, each if given.
+
+    ops = { "*" : lambda bl : bl * factor, "/" : lambda bl : bl / factor,
+            "+" : lambda bl : bl + factor, "-" : lambda bl : bl - factor };
+    scale = ops[op] if op else None;
+
+    def transform(bl):
+        if scale:
+            bl = scale(bl);
+        if digits is not False:
+            bl = round(bl, digits);
+        if min_bl is not False and bl < min_bl:
+            bl = min_bl;
+        return bl;
+
+    return transform;
+
+#############################################################################
+
+def rewriteNewick(tree_str, labels=True, bl=True, bl_cache=False):
+# Removes or changes the internal node labels and branch lengths of a Newick string read as bytes, without reading
+# the tree. With labels False, the labels after closing parentheses are removed. bl can be True to keep branch
+# lengths, False to remove them, or a function that takes a branch length as a float and returns a new one (see
+# blTransform), which isn't used on the root. Raises a ValueError if the string isn't a tree or a branch length isn't a number.
+# bl_cache is a dict of the new branch lengths already written, which can be shared between trees since the same
+# branch length strings come up again and again.
+
+    tree_str = tree_str.strip();
+    if not tree_str.startswith(b"(") or tree_str.count(b"(") != tree_str.count(b")"):
+        raise ValueError("Not a Newick string: " + tree_str.decode(errors="replace"));
+
+    if bl is False:
+        tree_str = NEWICK_BRANCH_LENGTH.sub(b"", tree_str);
+    elif bl is not True:
+        if bl_cache is False:
+            bl_cache = {};
+
+        def newBL(match):
+            old_bl = match.group();
+            if old_bl in bl_cache:
+                return bl_cache[old_bl];
+            new_bl = b":" + repr(bl(float(old_bl[1:]))).encode();
+            if len(bl_cache) < 1000000:
+                bl_cache[old_bl] = new_bl;
+            return new_bl;
+
+        root_end = tree_str.rfind(b")") + 1;
+        tree_str = NEWICK_BRANCH_LENGTH.sub(newBL, tree_str[:root_end]) + tree_str[root_end:];
+    # Each branch length is found by the regex in one scan of the string, so nothing is read into nodes. A
+    # branch length on the root, after the last closing parenthesis, isn't changed.
+
+    if not labels:
+        tree_str = NEWICK_INTERNAL_LABEL.sub(b")", tree_str);
+
+    if not tree_str.endswith(b";"):
+        tree_str += b";";
+
+    return tree_str;
+
+#############################################################################
+
+def rewriteTreeFile(infilename, outfilename, labels=True, bl=True, tids=True):
+# Writes every tree in a file with rewriteNewick, streaming the file as bytes. Either file can be gzipped: the input
+# is checked for gzip and the output is gzipped if its name ends with .gz. With tids False, tree ids in front of the
+# trees are left out. Lines that aren't trees are skipped.
+# Returns the number of lines, the number of trees and the line numbers skipped (as strings, for printing).
+
+    num_lines, num_trees, skipped = 0, 0, [];
+    bl_cache = {};
+
+    if outfilename.endswith(".gz"):
+        outfile = gzip.open(outfilename, "wb", compresslevel=1);
+        # The fastest compression, which for tree files is several times faster than the default for a little more space
+    else:
+        outfile = open(outfilename, "wb", buffering=1048576);
+
+    with openTreeFile(infilename, binary=True) as infile, outfile:
+        for line in infile:
+            num_lines += 1;
+            line = line.strip();
+            tid, tree_str = False, line;
+            if b"\t" in line:
+                tid, tree_str = line.rsplit(b"\t", 1);
+            # Trees can't contain tabs, so anything before the last one is the tree id
+
+            try:
+                tree_str = rewriteNewick(tree_str, labels, bl, bl_cache);
+            except ValueError:
+                skipped.append(str(num_lines));
+                continue;
+
+            if tids and tid is not False:
+                outfile.write(tid + b"\t");
+            outfile.write(tree_str + b"\n");
+            num_trees += 1;
+
+    return num_lines, num_trees, skipped;
+
+## END TREE FILE FUNCTIONS
+#############################################################################
+## BEGIN TREE CACHE FUNCTIONS
+
+CACHE_VERSION = 2;
+# Increased whenever the layout of the cache file changes, so old caches are rebuilt
+
+CACHE_BLOCK_SIZE = 1000;
+# The number of trees read from a cache at a time when iterating over it
+
+def cachePath(filename):
+# Returns the name of the cache file for a tree file, which is kept next to it
+
+    return filename + ".treecache.npz";
+
+#############################################################################
+
+def fileHash(filename):
+# Returns the SHA-1 of a file, read in blocks
+
+    file_hash = hashlib.sha1();
+    with open(filename, "rb") as infile:
+        for block in iter(lambda : infile.read(1048576), b""):
+            file_hash.update(block);
+    return file_hash.hexdigest();
+
+#############################################################################
+
+def mapNpz(filename):
+# Opens each array in an uncompressed .npz file as a read-only memory map, so nothing is read into memory
+# until it is used. np.load only maps plain .npy files, so the offset of each array is found from the zip
+# headers and the .npy header inside it.
+
+    import numpy as np
+
+    arrays = {};
+    with zipfile.ZipFile(filename) as npz, open(filename, "rb") as npz_file:
+        for info in npz.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("Compressed arrays can't be memory mapped: " + info.filename);
+
+            npz_file.seek(info.header_offset);
+            local_header = npz_file.read(30);
+            name_len, extra_len = struct.unpack("<HH", local_header[26:30]);
+            npz_file.seek(info.header_offset + 30 + name_len + extra_len);
+            # Skip the zip local file header to the start of the .npy file
+
+            version = np.lib.format.read_magic(npz_file);
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npz_file);
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npz_file);
+            # Read the .npy header, leaving the file at the start of the data
+
+            name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename;
+            if 0 in shape:
+                arrays[name] = np.empty(shape, dtype=dtype);
+            else:
+                arrays[name] = np.memmap(filename, dtype=dtype, mode="r", shape=shape, offset=npz_file.tell(), order="F" if fortran_order else "C");
+
+    return arrays;
+
+#############################################################################
+
+def writeTreeCache(filename, cache_file=False):
+# Reads a tree file (which can be gzipped) once and writes the parsed trees to a binary cache as an uncompressed
+# .npz file. For all trees together, the cache holds:
+# anc, bl, child_start, children, taxon, label: the arrays of each CompactTree, one after another, with the
+#       label as an id in the label table (-1 for none) and the taxon id for tips (-1 for internal nodes)
+# tree_nodes, tree_children, tree_internals: where each tree starts in the node and children arrays, and its
+#       number of internal nodes
+# line_num, tid: the line number and tree id ("" for none) of each tree, and skipped: the lines that couldn't
+#       be read
+# taxa, labels: the tables of tip labels and internal node labels
+# The size, modification time and SHA-1 of the tree file are stored to check if the cache is out of date.
+# Returns the name of the cache file.
+
+    import numpy as np
+
+    if not cache_file:
+        cache_file = cachePath(filename);
+
+    source_stat = os.stat(filename);
+    source_hash = fileHash(filename);
+    # Taken before reading, so a file changed while it is read will be seen as out of date
+
+    taxa = TaxonTable();
+    label_ids = {};
+    anc, bl, child_start, children, taxon, label = array.array('l'), array.array('d'), array.array('l'), array.array('l'), array.array('l'), array.array('l');
+    tree_nodes, tree_children, tree_internals = array.array('l', [0]), array.array('l', [0]), array.array('l');
+    line_nums, tids, skipped = array.array('l'), [], array.array('l');
+    num_lines = 0;
+
+    for tree_line in iter_trees(filename, parser="compact", taxa=taxa):
+        num_lines += 1;
+        if tree_line.error:
+            skipped.append(tree_line.num);
+            continue;
+
+        tree = tree_line.tree;
+        anc.extend(tree.anc);
+        bl.extend(tree.bl);
+        child_start.extend(tree.child_start);
+        children.extend(tree.children);
+        taxon.extend([-1] * tree.num_internals);
+        taxon.extend(tree.taxon);
+
+        for node in range(tree.num_internals):
+            if tree.has_label and tree.label[node] is not None:
+                label.append(label_ids.setdefault(tree.label[node], len(label_ids)));
+            else:
+                label.append(-1);
+        label.extend([-1] * tree.num_tips);
+        # Internal node labels are stored as ids, with no labels on tips
+
+        tree_nodes.append(len(anc));
+        tree_children.append(len(children));
+        tree_internals.append(tree.num_internals);
+        line_nums.append(tree_line.num);
+        tids.append(tree_line.tid if tree_line.tid else "");
+    ## End tree loop
+
+    labels = sorted(label_ids, key=label_ids.get);
+    tmp_file = cache_file + ".tmp.npz";
+    np.savez(tmp_file,
+                version=np.array(CACHE_VERSION, dtype=np.int64),
+                source_stat=np.array([source_stat.st_size, source_stat.st_mtime_ns], dtype=np.int64),
+                source_hash=np.array(source_hash),
+                num_lines=np.array(num_lines, dtype=np.int64),
+                anc=np.array(anc, dtype=np.int32),
+                bl=np.array(bl, dtype=np.float64),
+                child_start=np.array(child_start, dtype=np.int32),
+                children=np.array(children, dtype=np.int32),
+                taxon=np.array(taxon, dtype=np.int32),
+                label=np.array(label, dtype=np.int32),
+                tree_nodes=np.array(tree_nodes, dtype=np.int64),
+                tree_children=np.array(tree_children, dtype=np.int64),
+                tree_internals=np.array(tree_internals, dtype=np.int32),
+                line_num=np.array(line_nums, dtype=np.int64),
+                tid=np.array(tids, dtype=str),
+                skipped=np.array(skipped, dtype=np.int64),
+                taxa=np.array(taxa.labels, dtype=str),
+                labels=np.array(labels, dtype=str));
+    os.replace(tmp_file, cache_file);
+    # Write to a temporary file first so a partly written cache is never read
+
+    return cache_file;
+
+#############################################################################
+
+def loadTreeCache(filename, cache_file=False):
+# Returns a TreeCache for a tree file, or False if there is no cache or it is out of date. The cache is out of date
+# if the tree file has a different size, or has a different modification time and a different SHA-1. If only the
+# modification time is different, the new one is written to the cache so the file isn't hashed again next time.
+
+    if not cache_file:
+        cache_file = cachePath(filename);
+    if not os.path.isfile(cache_file):
+        return False;
+
+    try:
+        arrays = mapNpz(cache_file);
+    except Exception:
+        return False;
+    # Unreadable caches are rebuilt
+
+    if "version" not in arrays or int(arrays['version']) != CACHE_VERSION:
+        return False;
+
+    source_stat = os.stat(filename);
+    size, mtime = [ int(x) for x in arrays['source_stat'] ];
+    if size != source_stat.st_size:
+        return False;
+    if mtime != source_stat.st_mtime_ns:
+        if str(arrays['source_hash']) != fileHash(filename):
+            return False;
+        # The hash is only checked if the file has been touched since the cache was written
+
+        import numpy as np
+
+        tmp_file = cache_file + ".tmp.npz";
+        try:
+            np.savez(tmp_file, **dict(arrays, source_stat=np.array([source_stat.st_size, source_stat.st_mtime_ns], dtype=np.int64)));
+            arrays = None;
+            os.replace(tmp_file, cache_file);
+        except OSError:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file);
+        # The same arrays are copied to a new cache with the new time, closing the old memory maps before it
+        # is replaced. If the cache can't be written it is still used, and is just hashed again next time.
+
+        if arrays is None:
+            arrays = mapNpz(cache_file);
+
+    return TreeCache(arrays);
+
+#############################################################################
+
+def treeCache(filename, cache_file=False):
+# Returns a TreeCache for a tree file, writing the cache first if it is missing or out of date
+
+    cache = loadTreeCache(filename, cache_file);
+    if not cache:
+        cache = loadTreeCache(filename, writeTreeCache(filename, cache_file));
+    return cache;
+
+#############################################################################
+
+class TreeCache:
+# The trees from a cache file written by writeTreeCache. The arrays are memory mapped, and each tree is a
+# CompactTree view of its part of them that is only made when it is asked for, so no tree is parsed. Views are
+# read a block of trees at a time, so only one block of each array is in memory when iterating over all trees.
+# Clade masks aren't stored, since they would be much larger than the trees, and are built from the descendant
+# arrays by CompactTree.getMasks when needed. All trees share one TaxonTable (taxa) with the ids used in the cache.
+
+    def __init__(self, arrays):
+        self.arrays = arrays;
+        self.taxa = TaxonTable([ str(label) for label in arrays['taxa'] ]);
+        self.labels = [ str(label) for label in arrays['labels'] ];
+
+        self.tree_nodes = arrays['tree_nodes'].tolist();
+        self.tree_children = arrays['tree_children'].tolist();
+        self.tree_internals = arrays['tree_internals'].tolist();
+        # The small per tree arrays used to find each tree's part of the others
+
+        self.num_lines = int(arrays['num_lines']);
+        self.num_trees = len(self.tree_internals);
+        self.skipped = [ str(num) for num in arrays['skipped'].tolist() ];
+        # Same counts as TreeCollection
+
+    ##########
+
+    def __len__(self):
+        return self.num_trees;
+
+    ##########
+
+    def __getitem__(self, tree_ind):
+    # Returns a CompactTree view of a tree, by its position among the trees that could be read
+
+        if tree_ind < 0:
+            tree_ind += self.num_trees;
+        if not 0 <= tree_ind < self.num_trees:
+            raise IndexError("Tree index out of range: " + str(tree_ind));
+
+        return self.getTrees(tree_ind, tree_ind + 1)[0];
+
+    ##########
+
+    def getTrees(self, first, last):
+    # Returns a list of CompactTree views of the trees from position first up to last. The part of each array
+    # for all of them is read into a list at once, since single elements of a memory map are slow to get, and
+    # each tree gets slices of those lists.
+
+        a = self.arrays;
+        node_start, node_end = self.tree_nodes[first], self.tree_nodes[last];
+        child_offset = self.tree_children[first];
+        cs_start = node_start + first;
+        # Each tree has one more child_start entry than it has nodes
+
+        anc, bl = a['anc'][node_start:node_end].tolist(), a['bl'][node_start:node_end].tolist();
+        taxon, label = a['taxon'][node_start:node_end].tolist(), a['label'][node_start:node_end].tolist();
+        child_start = a['child_start'][cs_start : node_end + last].tolist();
+        children = a['children'][child_offset : self.tree_children[last]].tolist();
+
+        trees = [];
+        for tree_ind in range(first, last):
+            start, end = self.tree_nodes[tree_ind] - node_start, self.tree_nodes[tree_ind+1] - node_start;
+            num_internals = self.tree_internals[tree_ind];
+
+            node_labels = label[start : start + num_internals];
+            tree_label = None;
+            if any(l >= 0 for l in node_labels):
+                tree_label = tuple( self.labels[l] if l >= 0 else None for l in node_labels );
+
+            trees.append(CompactTree.from_arrays(self.taxa, num_internals, anc[start:end],
+                            child_start[start + tree_ind - first : end + tree_ind - first + 1],
+                            children[self.tree_children[tree_ind] - child_offset : self.tree_children[tree_ind+1] - child_offset],
+                            bl[start:end], taxon[start + num_internals : end], tree_label));
+        return trees;
+
+    ##########
+
+    def __iter__(self):
+    # Yields a TreeLine for every line of the tree file, in order, with a CompactTree view as the tree.
+    # Lines that couldn't be read have an error and no tree.
+
+        skipped = iter(self.arrays['skipped'].tolist());
+        next_skip = next(skipped, None);
+
+        line_nums, tids = self.arrays['line_num'].tolist(), self.arrays['tid'].tolist();
+        for block_start in range(0, self.num_trees, CACHE_BLOCK_SIZE):
+            block_end = min(block_start + CACHE_BLOCK_SIZE, self.num_trees);
+            for tree_ind, tree in enumerate(self.getTrees(block_start, block_end), block_start):
+                num = line_nums[tree_ind];
+                while next_skip is not None and next_skip < num:
+                    yield TreeLine(next_skip, False, "", "", error="Couldn't be read when the cache was written");
+                    next_skip = next(skipped, None);
+
+                tid = tids[tree_ind];
+                yield TreeLine(num, tid if tid else False, "", "", tree);
+        # The trees are read from the arrays in blocks
+
+        while next_skip is not None:
+            yield TreeLine(next_skip, False, "", "", error="Couldn't be read when the cache was written");
+            next_skip = next(skipped, None);
+
+## END TREE CACHE FUNCTIONS
+#############################################################################
+## BEGIN WORKER FUNCTIONS
+
+CHUNK_FUNC, CHUNK_SHARED = None, ();
+# The function and shared arguments for runChunk, set once in each worker process by initChunkWorker instead of
+# sent with every chunk
+
+def initChunkWorker(func, shared):
+# Pool initializer for mapChunks
+
+    global CHUNK_FUNC, CHUNK_SHARED;
+    CHUNK_FUNC, CHUNK_SHARED = func, shared;
+
+#############################################################################
+
+def runChunk(chunk):
+# Runs the function from initChunkWorker on one chunk in a worker process
+
+    return CHUNK_FUNC(chunk, *CHUNK_SHARED);
+
+#############################################################################
+
+def mapChunks(func, chunks, procs, *shared, ordered=True, chunksize=1):
+# Yields func(chunk, *shared) for each chunk, e.g. lists of TreeLines from chunkTreeLines. With procs > 1 the chunks
+# are split between that many processes. func must be a module level function, and the shared arguments are sent to
+# each process once when it starts. Results are in the order of the chunks unless ordered is False, and chunksize
+# is the number of chunks sent to a process at a time.
+
+    if procs <= 1:
+        for chunk in chunks:
+            yield func(chunk, *shared);
+        return;
+
+    with mp.Pool(processes=procs, initializer=initChunkWorker, initargs=(func, shared)) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered;
+        for result in imap(runChunk, chunks, chunksize=chunksize):
+            yield result;
+    # Every result is read before the pool is closed at the end of the block
+
+## END WORKER FUNCTIONS
+#############################################################################
+## BEGIN TREE DISTANCE FUNCTIONS
+
+def getSplits(tree, taxa=False):
+# Returns the unrooted splits of a Tree as a dict of bitmask : branch length. Each split is stored as the
+# side without the tip with the lowest id, so a split has the same mask in every tree that shares the
+# TaxonTable wherever the trees are rooted. The two branches at a bifurcating root are one unrooted branch,
+# so their lengths are summed. Missing branch lengths count as 0.
+# CompactTrees (e.g. from a TreeCache) are passed to CompactTree.getSplits.
+
+    if isinstance(tree, CompactTree):
+        return tree.getSplits(taxa);
+
+    if not tree.bipartitions or (taxa and tree.bipartitions.taxa is not taxa):
+        tree.indexBipartitions(taxa);
+    clade = tree.bipartitions.clade;
+    all_tips = tree.bipartitions.all_tips;
+    low_tip = all_tips & -all_tips;
+    # The lowest bit set in the tree
+
+    splits = {};
+    for node in tree.nodes:
+        if node == tree.root:
+            continue;
+
+        mask = clade[node];
+        if mask & low_tip:
+            mask = all_tips ^ mask;
+        if not mask:
+            continue;
+        # Flip each clade to the side without the lowest tip, skipping single child nodes that span all tips
+
+        bl = tree.bl[node];
+        bl = 0.0 if bl in ("NA", "") else float(bl);
+        splits[mask] = splits.get(mask, 0.0) + bl;
+
+    return splits;
+
+#############################################################################
+
+def rfDist(splits1, splits2, num_tips):
+# Takes two dicts of splits from getSplits for trees with the same tips and returns the Robinson-Foulds
+# distance, the RF distance normalized by its maximum for bifurcating trees, 2(n-3), and the weighted RF
+# distance, the sum of the differences in branch length for every split in either tree.
+
+    shared = splits1.keys() & splits2.keys();
+    rf = len(splits1) + len(splits2) - 2 * len(shared);
+    # Splits on tip branches are in both trees, so only internal branches add to the RF distance
+
+    wrf = 0.0;
+    for mask, bl in splits1.items():
+        wrf += abs(bl - splits2[mask]) if mask in shared else bl;
+    for mask, bl in splits2.items():
+        if mask not in shared:
+            wrf += bl;
+    # Shared splits add the difference in their lengths and splits in one tree add their whole length. Adding
+    # only non-negative terms keeps rounding from making identical trees slightly negative.
+
+    max_rf = 2 * (num_tips - 3);
+    norm_rf = rf / max_rf if max_rf > 0 else 0.0;
+
+    return rf, norm_rf, wrf;
+
+#############################################################################
+
+def rfOneToMany(ref_splits, split_list, num_tips):
+# Returns a list of (rf, normalized rf, weighted rf) between one set of splits and each set in a list
+
+    return [ rfDist(ref_splits, splits, num_tips) for splits in split_list ];
+
+#############################################################################
+
+def rfRow(i, split_list, num_tips):
+# Distances from tree i to every later tree, for one row of the upper triangle of rfMatrix
+
+    return i, rfOneToMany(split_list[i], split_list[i+1:], num_tips);
+
+#############################################################################
+
+def rfMatrix(split_list, num_tips, procs=1):
+# Returns the all pairs matrix of (rf, normalized rf, weighted rf) for a list of dicts of splits from
+# getSplits, as a list of rows. Rows of the upper triangle are split between procs processes.
+
+    num_trees = len(split_list);
+    matrix = [ [ (0, 0.0, 0.0) ] * num_trees for i in range(num_trees) ];
+
+    rows = mapChunks(rfRow, range(num_trees - 1), procs if num_trees > 2 else 1, split_list, num_tips,
+                        ordered=False, chunksize=max(1, num_trees // (procs * 8)));
+    for i, row in rows:
+        for j, dists in enumerate(row, i+1):
+            matrix[i][j] = matrix[j][i] = dists;
+    # Each row is a chunk, sent to the processes in groups since later rows are shorter
+
+    return matrix;
+
+## END TREE DISTANCE FUNCTIONS
+#############################################################################
+## BEGIN CONCORDANCE FUNCTIONS
+
+def chunkTreeLines(tree_lines, chunk_size, skip_errors=True):
+# Groups the TreeLines from iter_trees (read with parser=False) into lists to send to worker processes.
+# Lines that couldn't be read are left out unless skip_errors is False.
+
+    chunk = [];
+    for tree_line in tree_lines:
+        if tree_line.error and skip_errors:
+            continue;
+        chunk.append(tree_line);
+        if len(chunk) == chunk_size:
+            yield chunk;
+            chunk = [];
+    if chunk:
+        yield chunk;
+
+#############################################################################
+
+def countConcordance(tree_lines, species_clades, species_root, taxa, count_tops=False):
+# Counts the gene trees that have each clade in a species tree for a list of unparsed TreeLines.
+# species_clades is a dict of node : clade bitmask from the taxa TaxonTable, which should already hold
+# every species tree tip so that masks match between processes.
+#
+# Gene trees can be missing taxa. Each species clade is then restricted to the tips in the gene tree, and
+# only counts towards the total for that node if the restricted clade has at least 2 tips and isn't all of
+# the gene tree's tips. Gene trees with tips that aren't in the species tree are skipped.
+#
+# Returns a dict of results that can be added together with combineConcordance.
+
+    result = {
+        'counts' : { node : 0 for node in species_clades },
+        'decisive' : { node : 0 for node in species_clades },
+        'tops' : {},
+        'unreadable' : [],
+        'skipped' : [],
+        'num_trees' : 0
+    }
+    # counts: The number of gene trees with the (restricted) clade at each species tree node
+    # decisive: The number of gene trees that could have had the clade at each node
+    # tops: For each topology, [number of trees, first line number, first tree without branch lengths]
+    # unreadable: Line numbers that couldn't be read as trees
+    # skipped: Line numbers of trees with tips that aren't in the species tree
+
+    species_tips = species_clades[species_root];
+
+    for tree_line in tree_lines:
+        num, tree_str = tree_line.num, tree_line.tree_str;
+        try:
+            tree = Tree(tree_str, taxa=taxa);
+        except Exception:
+            result['unreadable'].append(num);
+            continue;
+
+        bipartitions = tree.indexBipartitions(taxa);
+        gene_tips = bipartitions.all_tips;
+        extra_tips = gene_tips & ~species_tips;
+
+        if count_tops:
+            top = topologyHash(tree, rooted=True);
+            if top in result['tops']:
+                result['tops'][top][0] += 1;
+            else:
+                result['tops'][top] = [1, num, remBranchLength(tree_str)];
+        # Count each unique set of clades as a topology
+
+        if extra_tips:
+            result['skipped'].append(num);
+            continue;
+        result['num_trees'] += 1;
+
+        for node, clade in species_clades.items():
+            restricted = clade & gene_tips;
+            if restricted == gene_tips:
+                if node != species_root:
+                    continue;
+            elif not restricted & (restricted - 1):
+                continue;
+            # Clades with fewer than 2 tips in the gene tree, or with all of them, don't tell us anything.
+            # The root is always counted.
+
+            result['decisive'][node] += 1;
+            if restricted in bipartitions.node:
+                result['counts'][node] += 1;
+
+    return result;
+
+#############################################################################
+
+def combineConcordance(total, result):
+# Adds the results of one call to countConcordance to a running total from another. Results must be
+# added in the order of the gene trees to keep the first tree for each topology.
+
+    for node in total['counts']:
+        total['counts'][node] += result['counts'][node];
+        total['decisive'][node] += result['decisive'][node];
+
+    for top, top_info in result['tops'].items():
+        if top in total['tops']:
+            total['tops'][top][0] += top_info[0];
+        else:
+            total['tops'][top] = top_info;
+
+    total['unreadable'] += result['unreadable'];
+    total['skipped'] += result['skipped'];
+    total['num_trees'] += result['num_trees'];
+
+    return total;
+
+## END CONCORDANCE FUNCTIONS
+#############################################################################
+## BEGIN TOPOLOGY FUNCTIONS
+
+def topologyHash(tree, rooted=False):
+# Returns a hash of the topology of a Tree that doesn't depend on the order of descendants, branch lengths or labels.
+# Tips are given ids by the order of their sorted labels, so the hash is the same in every process without a shared
+# TaxonTable. The canonical form is the sorted tip labels and the sorted bitmasks of the unrooted splits with at least
+# 2 tips on each side (from getSplits), so by default, as for tree.py --uniquetops, trees with the same unrooted
+# topology and tips have the same hash whatever their order or rooting. With rooted True, the clades of the internal
+# nodes are used instead, so trees only have the same hash if they are also rooted on the same branch.
+
+    taxa = TaxonTable(sorted(tree.tips));
+    bipartitions = Bipartitions(tree, taxa);
+    all_tips = bipartitions.all_tips;
+
+    if rooted:
+        masks = set( bipartitions.clade[node] for node in tree.internals );
+    else:
+        low_tip = all_tips & -all_tips;
+        masks = set();
+        for node in tree.internals:
+            mask = bipartitions.clade[node];
+            if mask & low_tip:
+                mask = all_tips ^ mask;
+            if mask & (mask - 1) and all_tips ^ low_tip ^ mask:
+                masks.add(mask);
+    # Sets, since a node with one descendant has the same clade as it and the two branches at a bifurcating root
+    # are the same split
+
+    canonical = "\t".join(taxa.labels) + "\n" + ",".join( format(mask, "x") for mask in sorted(masks) );
+    return hashlib.sha1(canonical.encode()).hexdigest();
+
+#############################################################################
+
+def countTopologies(tree_lines, rooted=False):
+# Groups the trees in a list of unparsed TreeLines by their topologyHash. Returns a dict of results that can be added
+# together with combineTopologies.
+
+    result = { 'tops' : {}, 'unreadable' : [], 'num_trees' : 0 };
+    # tops: For each topology, [number of trees, first tree without branch lengths, line numbers of the trees]
+    # unreadable: Line numbers that couldn't be read as trees
+
+    tops = result['tops'];
+    for tree_line in tree_lines:
+        try:
+            tree = Tree(tree_line.tree_str);
+        except Exception:
+            result['unreadable'].append(tree_line.num);
+            continue;
+
+        top = topologyHash(tree, rooted);
+        if top in tops:
+            tops[top][0] += 1;
+            tops[top][2].append(tree_line.num);
+        else:
+            tops[top] = [1, remBranchLength(tree_line.tree_str), array.array('l', [tree_line.num])];
+        # Only the hash and the first tree are kept for each topology, with the line numbers in a compact array
+
+        result['num_trees'] += 1;
+
+    return result;
+
+#############################################################################
+
+def combineTopologies(total, result):
+# Adds the results of one call to countTopologies to a running total from another. Results must be added in the order
+# of the trees to keep the first tree for each topology.
+
+    for top, top_info in result['tops'].items():
+        if top in total['tops']:
+            total['tops'][top][0] += top_info[0];
+            total['tops'][top][2].extend(top_info[2]);
+        else:
+            total['tops'][top] = top_info;
+
+    total['unreadable'] += result['unreadable'];
+    total['num_trees'] += result['num_trees'];
+
+    return total;
+
+## END TOPOLOGY FUNCTIONS
+#############################################################################
+## BEGIN CONSENSUS FUNCTIONS
+
+def countSplits(tree_lines, taxa, all_tips):
+# Counts the unrooted splits (as bitmasks from getSplits) in a list of unparsed TreeLines. All trees should have
+# the tips in all_tips, a mask from the taxa TaxonTable, which should already hold every tip so that masks match
+# between processes. Trees with other tips are skipped.
+# Returns a dict of results that can be added together with combineSplitCounts.
+
+    result = { 'splits' : {}, 'unreadable' : [], 'skipped' : [], 'num_trees' : 0, 'has_bl' : False };
+    # splits: For each split, [number of trees with it, sum of its branch lengths]
+    # unreadable: Line numbers that couldn't be read as trees
+    # skipped: Line numbers of trees that don't have the same tips as the first tree
+
+    splits = result['splits'];
+    for tree_line in tree_lines:
+        try:
+            tree = Tree(tree_line.tree_str, taxa=taxa);
+        except Exception:
+            result['unreadable'].append(tree_line.num);
+            continue;
+
+        if tree.indexBipartitions(taxa).all_tips != all_tips:
+            result['skipped'].append(tree_line.num);
+            continue;
+
+        for mask, bl in getSplits(tree, taxa).items():
+            if mask in splits:
+                split = splits[mask];
+                split[0] += 1;
+                split[1] += bl;
+            else:
+                splits[mask] = [1, bl];
+        # Tip branches are counted too, to get their average length
+
+        result['num_trees'] += 1;
+        result['has_bl'] = result['has_bl'] or tree.has_bl;
+
+    return result;
+
+#############################################################################
+
+def combineSplitCounts(total, result):
+# Adds the results of one call to countSplits to a running total from another
+
+    for mask, split in result['splits'].items():
+        if mask in total['splits']:
+            total['splits'][mask][0] += split[0];
+            total['splits'][mask][1] += split[1];
+        else:
+            total['splits'][mask] = split;
+
+    total['unreadable'] += result['unreadable'];
+    total['skipped'] += result['skipped'];
+    total['num_trees'] += result['num_trees'];
+    total['has_bl'] = total['has_bl'] or result['has_bl'];
+
+    return total;
+
+#############################################################################
+
+def consensusSplits(splits, num_trees, all_tips, mode="majority", threshold=0.5):
+# Returns the list of internal splits to put in a consensus tree from the counts of countSplits:
+# "strict": splits in every tree
+# "majority": splits in more than threshold (a proportion) of the trees. With the default of 0.5, all of
+#             them are compatible with each other.
+# "greedy": the splits from most to least frequent if they are compatible with all the splits already kept,
+#           which gives a fully resolved tree when there is enough signal. The splits in more than half of the
+#           trees are all compatible and come first, so they are always kept and threshold isn't used.
+
+    low_tip = all_tips & -all_tips;
+    internal = [ mask for mask in splits if mask & (mask - 1) and all_tips ^ low_tip ^ mask ];
+    # Splits with at least two tips on both sides. Splits don't have the lowest tip, so the other side has
+    # at least two when it has any tip besides that one.
+
+    if mode == "strict":
+        return [ mask for mask in internal if splits[mask][0] == num_trees ];
+    if mode == "majority":
+        return [ mask for mask in internal if splits[mask][0] > threshold * num_trees ];
+
+    kept = [];
+    for mask in sorted(internal, key=lambda m : (-splits[m][0], m)):
+        if all(not mask & other or mask & other == mask or mask & other == other for other in kept):
+            kept.append(mask);
+    # Since no split has the lowest tip, two splits are compatible when they are disjoint or one contains
+    # the other. Ties are broken by mask so the result doesn't depend on the order of the trees.
+
+    return kept;
+
+#############################################################################
+
+def consensusTree(splits, num_trees, taxa, all_tips, kept, has_bl=False, float_format=False):
+# Builds the Newick string of an unrooted consensus tree from the splits to keep. Each split is an internal
+# node labeled with the proportion of trees that had it. With has_bl, branch lengths are the average over
+# the trees that had each split.
+#
+# Splits don't have the lowest tip, so as clades rooted at it they are nested or disjoint. Adding them from
+# largest to smallest, the node each split goes below is the one that any of its tips was last put in, so
+# each split only needs a pass over its tips, O(k * n) for k splits.
+
+    tips = [];
+    mask = all_tips;
+    while mask:
+        low_bit = mask & -mask;
+        tips.append(low_bit.bit_length() - 1);
+        mask ^= low_bit;
+    # The taxon ids of the tips, lowest first
+
+    clades = sorted(kept, key=lambda m : -bin(m).count("1"));
+    node_of = { taxon_id : 0 for taxon_id in tips };
+    children = [ [] for i in range(len(clades) + 1) ];
+    # Node 0 is the root, node i is clades[i-1]. Tips are stored as ~taxon_id.
+
+    for node, clade in enumerate(clades, 1):
+        low_bit = clade & -clade;
+        children[node_of[low_bit.bit_length() - 1]].append(node);
+
+        mask = clade;
+        while mask:
+            low_bit = mask & -mask;
+            node_of[low_bit.bit_length() - 1] = node;
+            mask ^= low_bit;
+    # Each split goes below the last node one of its tips was put in, and its tips move down to it
+
+    for taxon_id in tips:
+        children[node_of[taxon_id]].append(~taxon_id);
+
+    node_mask = [all_tips] + clades;
+    first_tip = lambda node : (~node) if node < 0 else (node_mask[node] & -node_mask[node]).bit_length() - 1;
+    for desc in children:
+        desc.sort(key=first_tip);
+    # Order descendants by their lowest tip, so the tree is the same whatever order the splits were found in
+
+    def bl(node):
+        mask = (1 << ~node) if node < 0 else node_mask[node];
+        if mask & 1 << tips[0]:
+            mask = all_tips ^ mask;
+        count, bl_sum = splits.get(mask, (0, 0.0));
+        return round(bl_sum / count, 6) if count else None;
+    # The lowest tip's own branch is stored as the split with all other tips
+
+    return writeNewick(0, lambda node : children[node] if node >= 0 else None,
+                        name=lambda node : taxa.labels[~node],
+                        support=lambda node : round(splits[node_mask[node]][0] / num_trees, 2) if node > 0 else None,
+                        bl=bl if has_bl else None, float_format=float_format);
+
+## END CONSENSUS FUNCTIONS
+#############################################################################
+## BEGIN SUPPORT FUNCTIONS
+
+def refSplits(tree, taxa):
+# Returns the internal branches of a reference tree to get support for, as a list of nodes and a list of their
+# splits from getSplits. The two branches at a bifurcating root are the same split and both get it.
+
+    if not tree.bipartitions or tree.bipartitions.taxa is not taxa:
+        tree.indexBipartitions(taxa);
+    clade = tree.bipartitions.clade;
+    all_tips = tree.bipartitions.all_tips;
+    low_tip = all_tips & -all_tips;
+
+    nodes, splits = [], [];
+    for node in tree.internals:
+        if node == tree.root:
+            continue;
+        mask = clade[node];
+        if mask & low_tip:
+            mask = all_tips ^ mask;
+        if mask & (mask - 1) and all_tips ^ low_tip ^ mask:
+            nodes.append(node);
+            splits.append(mask);
+    # Only splits with at least 2 tips on each side
+
+    return nodes, splits;
+
+#############################################################################
+
+def countSupport(tree_lines, ref_splits, taxa, all_tips, transfer=False):
+# Compares the splits of the reference tree (from refSplits) to each bootstrap tree in a list of unparsed TreeLines.
+# taxa should already hold every tip so that masks match between processes, and trees without exactly the tips in
+# all_tips are skipped.
+#
+# For Felsenstein support, counts the bootstrap trees that have each reference split. For transfer support, adds
+# up the transfer distance of each reference split to each bootstrap tree: the fewest tips that have to be moved
+# to make the split match any split in the tree, which is at most one less than the smaller side of the split.
+#
+# Returns a dict of results that can be added together with combineSupport, with the counts or distances in a
+# list in the same order as ref_splits.
+
+    result = { 'counts' : [0] * len(ref_splits), 'unreadable' : [], 'skipped' : [], 'num_trees' : 0 };
+
+    num_tips = bin(all_tips).count("1");
+    sizes = [ bin(mask).count("1") for mask in ref_splits ];
+    max_dists = [ min(size, num_tips - size) - 1 for size in sizes ];
+    # The smaller side of each split sets its largest possible transfer distance
+
+    counts = result['counts'];
+    for tree_line in tree_lines:
+        try:
+            tree = Tree(tree_line.tree_str, taxa=taxa);
+        except Exception:
+            result['unreadable'].append(tree_line.num);
+            continue;
+
+        if tree.indexBipartitions(taxa).all_tips != all_tips:
+            result['skipped'].append(tree_line.num);
+            continue;
+
+        boot_splits = getSplits(tree, taxa);
+        if transfer:
+            boot_masks = [ mask for mask in boot_splits if mask & (mask - 1) ];
+            for i, mask in enumerate(ref_splits):
+                if mask in boot_splits:
+                    continue;
+                dist = max_dists[i];
+                for boot_mask in boot_masks:
+                    diff = bin(mask ^ boot_mask).count("1");
+                    if num_tips - diff < diff:
+                        diff = num_tips - diff;
+                    if diff < dist:
+                        dist = diff;
+                        if dist == 1:
+                            break;
+                counts[i] += dist;
+            # Splits in the bootstrap tree have a distance of 0. The distance to a split is the number of tips in
+            # one split but not the other, or in neither, whichever is fewer. Tip branches never beat max_dists.
+        else:
+            for i, mask in enumerate(ref_splits):
+                if mask in boot_splits:
+                    counts[i] += 1;
+
+        result['num_trees'] += 1;
+
+    return result;
+
+#############################################################################
+
+def combineSupport(total, result):
+# Adds the results of one call to countSupport to a running total from another
+
+    total['counts'] = [ c1 + c2 for c1, c2 in zip(total['counts'], result['counts']) ];
+    total['unreadable'] += result['unreadable'];
+    total['skipped'] += result['skipped'];
+    total['num_trees'] += result['num_trees'];
+
+    return total;
+
+#############################################################################
+
+def supportValues(counts, num_trees, ref_splits, num_tips, transfer=False):
+# Turns the totals from countSupport into support values between 0 and 1. Felsenstein support is the proportion of
+# bootstrap trees with the split. Transfer support is 1 minus the average transfer distance over its largest
+# possible value.
+
+    if not num_trees:
+        return [ "NA" ] * len(counts);
+
+    if not transfer:
+        return [ count / num_trees for count in counts ];
+
+    support = [];
+    for count, mask in zip(counts, ref_splits):
+        size = bin(mask).count("1");
+        support.append(1 - (count / num_trees) / (min(size, num_tips - size) - 1));
+    return support;
+
+## END SUPPORT FUNCTIONS
+#############################################################################
+## BEGIN REROOTING FUNCTIONS
+
+def rootTreeLines(tree_lines, outgroup):
+# Roots each tree in a list of unparsed TreeLines on the outgroup with Tree.rootString. Returns a list of
+# (line number, status, output line) in the same order, where status is one of:
+# "rooted": the output line is the rooted tree, with the tree id in front if the line had one
+# "unreadable": the line couldn't be read as a tree
+# "missing": not all of the outgroup tips are in the tree
+# "paraphyletic": the outgroup and the rest of the tips are both paraphyletic, so there is no output line
+
+    rooted = [];
+    for tree_line in tree_lines:
+        if tree_line.error:
+            rooted.append((tree_line.num, "unreadable", "**Skipped - couldn't read as Newick string"));
+            continue;
+
+        try:
+            tree = Tree(tree_line.tree_str);
+        except Exception:
+            rooted.append((tree_line.num, "unreadable", "**Skipped - couldn't read as Newick string"));
+            continue;
+
+        if not all(tip in tree.type and tree.type[tip] == "tip" for tip in outgroup):
+            rooted.append((tree_line.num, "missing", "**Skipped - not all outgroups in tree."));
+            continue;
+
+        tree_str = tree.rootString(outgroup);
+        if not tree_str:
+            rooted.append((tree_line.num, "paraphyletic", False));
+            continue;
+
+        if tree_line.tid:
+            tree_str = tree_line.tid + "\t" + tree_str;
+        rooted.append((tree_line.num, "rooted", tree_str));
+
+    return rooted;
+
+## END REROOTING FUNCTIONS
+#############################################################################
+## BEGIN PRUNING FUNCTIONS
+
+def pruneTreeLines(tree_lines, keep_tips):
+# Prunes each tree in a list of unparsed TreeLines down to the tips in keep_tips with Tree.Prune. Returns a
+# list of (line number, status, output line) in the same order, where status is one of:
+# "pruned": the output line is the pruned tree, with the tree id in front if the line had one
+# "unreadable": the line couldn't be read as a tree
+# "too few": fewer than 2 of the tips to keep are in the tree, so there is no output line
+
+    pruned = [];
+    for tree_line in tree_lines:
+        if tree_line.error:
+            pruned.append((tree_line.num, "unreadable", "**Skipped - couldn't read as Newick string"));
+            continue;
+
+        try:
+            tree = Tree(tree_line.tree_str);
+        except Exception:
+            pruned.append((tree_line.num, "unreadable", "**Skipped - couldn't read as Newick string"));
+            continue;
+
+        prune_tips = [ tip for tip in tree.tips if tip not in keep_tips ];
+        if len(tree.tips) - len(prune_tips) < 2:
+            pruned.append((tree_line.num, "too few", False));
+            continue;
+
+        tree_str = tree.Prune(prune_tips);
+        if tree_line.tid:
+            tree_str = tree_line.tid + "\t" + tree_str;
+        pruned.append((tree_line.num, "pruned", tree_str));
+
+    return pruned;
+
+## END PRUNING FUNCTIONS
+#############################################################################
+## BEGIN RELABELING FUNCTIONS
+
+class TipRelabeler:
+# Relabels the tips of Newick strings from a mapping of old labels to new labels, compiled once for any number of
+# trees. With exact, a tip is relabeled if its whole label is an old label, found with a dict. Otherwise a tip is
+# relabeled if its label contains an old label, and when it contains several the one first in the mapping is used.
+#
+# All old labels go in one Aho-Corasick automaton, so each tip label is searched in one pass over its characters
+# instead of once per old label. The automaton is a trie of the old labels where each state also has a failure link
+# to the state for the longest suffix of its text that is in the trie, which is followed when the next character
+# doesn't match. Each state stores the earliest old label ending there or at any state on its failure links. The new
+# label for each tip label is also stored, since most tips are in many trees.
+#
+# mode 1 replaces the old tip label with the new label, 2 puts the new label before it and 3 puts it after it, with
+# delim between them.
+
+    __slots__ = ("labels", "olds", "goto", "fail", "first", "mode", "delim", "exact", "new_names");
+
+    def __init__(self, labels, mode=1, delim="_", exact=False):
+
+        self.labels = dict(labels);
+        self.olds = list(self.labels);
+        self.mode = mode;
+        self.delim = delim;
+        self.exact = exact;
+        self.new_names = {};
+
+        num_olds = len(self.olds);
+        self.goto = [{}];
+        self.first = [num_olds];
+        for i, old in enumerate(self.olds):
+            state = 0;
+            for char in old:
+                next_state = self.goto[state].get(char);
+                if next_state is None:
+                    next_state = len(self.goto);
+                    self.goto[state][char] = next_state;
+                    self.goto.append({});
+                    self.first.append(num_olds);
+                state = next_state;
+            if i < self.first[state]:
+                self.first[state] = i;
+        # The trie of old labels, with the index of the old label that ends at each state, or num_olds for none
+
+        self.fail = [0] * len(self.goto);
+        queue = list(self.goto[0].values());
+        q = 0;
+        while q < len(queue):
+            state = queue[q];
+            q += 1;
+            if self.first[self.fail[state]] < self.first[state]:
+                self.first[state] = self.first[self.fail[state]];
+            # The failure link is to a shallower state, which has already been done
+
+            for char, next_state in self.goto[state].items():
+                fail = self.fail[state];
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail];
+                self.fail[next_state] = self.goto[fail].get(char, 0);
+                queue.append(next_state);
+        # Failure links, in order of depth in the trie. States below the root fail back to the root.
+
+    ##########
+
+    def newName(self, name):
+    # Returns the new label for a tip label, or None if it doesn't match any old label
+
+        if name in self.new_names:
+            return self.new_names[name];
+
+        old = None;
+        if self.exact:
+            if name in self.labels:
+                old = name;
+        else:
+            state = 0;
+            first = self.first[0];
+            for char in name:
+                while state and char not in self.goto[state]:
+                    state = self.fail[state];
+                state = self.goto[state].get(char, 0);
+                if self.first[state] < first:
+                    first = self.first[state];
+            if first < len(self.olds):
+                old = self.olds[first];
+        # Find the old label that matches, the one earliest in the mapping if there are several
+
+        new_name = None;
+        if old is not None:
+            if self.mode == 1:
+                new_name = self.labels[old];
+            elif self.mode == 2:
+                new_name = self.labels[old] + self.delim + name;
+            elif self.mode == 3:
+                new_name = name + self.delim + self.labels[old];
+
+        self.new_names[name] = new_name;
+        return new_name;
+
+    ##########
+
+    def relabelTree(self, tree_str):
+    # Relabels the tips in a Newick string in one pass over its tokens, leaving everything else as it was. Returns the
+    # new string and the number of tips relabeled. Raises a ValueError if the string isn't a tree.
+
+        pieces = [];
+        num_relabeled = 0;
+        depth, closed_root, prev = 0, False, "";
+
+        for token in NEWICK_TOKENS.findall(tree_str):
+            if token == "(":
+                if closed_root:
+                    raise ValueError("More than one root node in tree string: " + tree_str);
+                depth += 1;
+
+            elif token == ")":
+                if not depth:
+                    raise ValueError("Unbalanced parentheses in tree string: " + tree_str);
+                depth -= 1;
+                closed_root = not depth;
+
+            elif token == ",":
+                if not depth:
+                    raise ValueError("Tip outside of parentheses in tree string: " + tree_str);
+
+            elif token != ";":
+                if prev in ("(", ","):
+                    name, colon, bl = token.partition(":");
+                    new_name = self.newName(name);
+                    if new_name is not None:
+                        token = new_name + colon + bl;
+                        num_relabeled += 1;
+                # Tips are the labels after an opening parenthesis or a comma. Labels after a closing parenthesis
+                # belong to internal nodes.
+
+                elif not depth and not closed_root:
+                    raise ValueError("Tip outside of parentheses in tree string: " + tree_str);
+
+            pieces.append(token);
+            prev = token;
+
+        if depth or not closed_root:
+            raise ValueError("Unbalanced parentheses in tree string: " + tree_str);
+
+        return "".join(pieces), num_relabeled;
+
+#############################################################################
+
+def relabelTreeLines(tree_lines, relabeler):
+# Relabels the tips of each tree in a list of unparsed TreeLines with a TipRelabeler. Returns a list of
+# (line number, status, output line, number of tips relabeled) in the same order, where status is one of:
+# "relabeled": the output line is the relabeled tree, with the tree id in front if the line had one
+# "unreadable": the line couldn't be read as a tree, so there is no output line
+
+    relabeled = [];
+    for tree_line in tree_lines:
+        if tree_line.error:
+            relabeled.append((tree_line.num, "unreadable", False, 0));
+            continue;
+
+        try:
+            tree_str, num_relabeled = relabeler.relabelTree(tree_line.tree_str);
+        except ValueError:
+            relabeled.append((tree_line.num, "unreadable", False, 0));
+            continue;
+
+        if tree_line.tid:
+            tree_str = tree_line.tid + "\t" + tree_str;
+        relabeled.append((tree_line.num, "relabeled", tree_str, num_relabeled));
+
+    return relabeled;
+
+## END RELABELING FUNCTIONS
+#############################################################################
+## BEGIN SITE CONCORDANCE FUNCTIONS
+
+SCF_STATES = { "dna" : "ACGT", "protein" : "ACDEFGHIKLMNPQRSTVWY" };
+# The character states counted for sCF. Everything else (gaps, N, X, ambiguity codes) is treated as missing
+
+def stateTable(seq_type="dna"):
+# Returns a NumPy lookup table from byte values to state codes 1-20, with 0 for missing data
+
+    import numpy as np;
+
+    table = np.zeros(256, dtype=np.uint8);
+    for code, state in enumerate(SCF_STATES[seq_type], 1):
+        table[ord(state)] = code;
+        table[ord(state.lower())] = code;
+    if seq_type == "dna":
+        table[ord("U")] = table[ord("u")] = table[ord("T")];
+    # RNA is read as DNA
+
+    return table;
+
+#############################################################################
+
+def alignmentMatrix(seqs, tips, seq_type="dna"):
+# Takes a dict of sequences (e.g. from seqparse.fastaReadSeqs) and a list of tips and returns a uint8 NumPy
+# matrix with a row of state codes for each tip in that order. Tips without a sequence get a row of missing
+# data. Only sites that are parsimony informative across all tips (at least two states that each appear
+# at least twice) are kept, since no other site can be informative for a quartet.
+
+    import numpy as np;
+
+    table = stateTable(seq_type);
+    aln_len = len(next(iter(seqs.values()))) if seqs else 0;
+
+    aln = np.zeros((len(tips), aln_len), dtype=np.uint8);
+    for row, tip in enumerate(tips):
+        if tip not in seqs:
+            continue;
+        if len(seqs[tip]) != aln_len:
+            raise ValueError("Sequences are not aligned: " + tip + " has length " + str(len(seqs[tip])) + ", expected " + str(aln_len));
+        aln[row] = table[np.frombuffer(seqs[tip].encode(), dtype=np.uint8)];
+    # Convert each sequence to state codes with the lookup table
+
+    num_common = np.zeros(aln_len, dtype=np.int64);
+    for code in range(1, len(SCF_STATES[seq_type]) + 1):
+        num_common += (aln == code).sum(axis=0) >= 2;
+    # Count the states at each site that appear at least twice
+
+    return aln[:, num_common >= 2];
+
+#############################################################################
+
+def quartetSiteCounts(aln, rows, batch_sites=16777216):
+# Takes an alignment matrix from alignmentMatrix and an array with a row of 4 alignment row indices for each
+# quartet, as ((d1, d2), (sister, other)) for a species tree branch. Returns an array with the number of
+# sites that support each of the three quartet topologies for each quartet:
+# 0: d1,d2|sister,other (concordant)
+# 1: d1,sister|d2,other (discordant 1)
+# 2: d1,other|d2,sister (discordant 2)
+# A site supports a topology if all 4 tips have data and the two pairs each share a different state.
+# Quartets are scored in batches of about batch_sites quartet-sites, against all sites at once.
+
+    import numpy as np;
+
+    counts = np.zeros((len(rows), 3), dtype=np.int64);
+    batch_size = max(1, batch_sites // max(1, aln.shape[1]));
+
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start+batch_size];
+        a, b, c, d = aln[batch[:,0]], aln[batch[:,1]], aln[batch[:,2]], aln[batch[:,3]];
+        # The states for each tip of each quartet in the batch, as quartets x sites matrices
+
+        valid = (a != 0) & (b != 0) & (c != 0) & (d != 0);
+        ab, ac = a == b, a == c;
+        counts[start:start+batch_size, 0] = (valid & ab & (c == d) & ~ac).sum(axis=1);
+        counts[start:start+batch_size, 1] = (valid & ac & (b == d) & ~ab).sum(axis=1);
+        counts[start:start+batch_size, 2] = (valid & (a == d) & (b == c) & ~ab).sum(axis=1);
+
+    return counts;
+
+#############################################################################
+
+def quartetRows(tree, tips, num_quartets=100, seed=None):
+# Samples quartets for every branch of a tree with Tree.sampleQuartets and returns a dict of node : array of
+# the alignment row (index in tips) of each quartet tip, for quartetSiteCounts
+
+    import numpy as np;
+
+    tip_rows = { tip : row for row, tip in enumerate(tips) };
+    node_rows = {};
+    for node, (clades, index_array) in tree.sampleQuartets(num_quartets, seed=seed, as_arrays=True).items():
+        rows = np.empty(index_array.shape, dtype=np.int64);
+        for q in range(4):
+            clade_rows = np.array([ tip_rows[tip] for tip in clades[q] ], dtype=np.int64);
+            rows[:,q] = clade_rows[index_array[:,q]];
+        node_rows[node] = rows;
+
+    return node_rows;
+
+#############################################################################
+
+def siteCountsLocus(aln_file, tips, node_rows, seq_type="dna"):
+# Reads one alignment (FASTA, can be gzipped) and returns a dict of node : quartetSiteCounts for the
+# quartets at each node
+
+    import seqparse;
+
+    aln = alignmentMatrix(seqparse.fastaReadSeqs(aln_file), tips, seq_type);
+    return { node : quartetSiteCounts(aln, rows) for node, rows in node_rows.items() };
+
+#############################################################################
+
+def siteConcordance(tree, aln_files, num_quartets=100, seed=None, procs=1, seq_type="dna"):
+# Calculates site concordance factors (sCF) for each branch of a species tree from one or more alignments,
+# e.g. the loci of a concatenated alignment, with loci split between procs processes. Site counts for each
+# sampled quartet are summed over loci. For each node, returns a dict with:
+# scf, sdf1, sdf2: the fraction of decisive sites supporting each quartet topology, averaged over the
+#                  quartets with at least one decisive site
+# scf_n, sdf1_n, sdf2_n: the number of sites supporting each topology, averaged over all quartets
+# sn: the number of decisive sites, averaged over all quartets
+# num_quartets: the number of quartets sampled
+
+    import numpy as np;
+
+    tips = sorted(tree.tips);
+    node_rows = quartetRows(tree, tips, num_quartets, seed);
+    totals = { node : np.zeros((len(rows), 3), dtype=np.int64) for node, rows in node_rows.items() };
+
+    for locus_counts in mapChunks(siteCountsLocus, aln_files, procs, tips, node_rows, seq_type, ordered=False):
+        for node in totals:
+            totals[node] += locus_counts[node];
+    # Sum the site counts for each quartet over all loci, with each alignment as a chunk
+
+    scf = {};
+    for node, counts in totals.items():
+        decisive = counts.sum(axis=1);
+        informative = decisive > 0;
+        fractions = counts[informative] / decisive[informative][:,None];
+        # The fraction of sites supporting each topology for quartets with any decisive sites
+
+        scf[node] = {
+            'scf' : float(fractions[:,0].mean()) if informative.any() else "NA",
+            'sdf1' : float(fractions[:,1].mean()) if informative.any() else "NA",
+            'sdf2' : float(fractions[:,2].mean()) if informative.any() else "NA",
+            'scf_n' : float(counts[:,0].mean()) if len(counts) else 0.0,
+            'sdf1_n' : float(counts[:,1].mean()) if len(counts) else 0.0,
+            'sdf2_n' : float(counts[:,2].mean()) if len(counts) else 0.0,
+            'sn' : float(decisive.mean()) if len(counts) else 0.0,
+            'num_quartets' : len(counts)
+        };
+
+    return scf;
+
+## END SITE CONCORDANCE FUNCTIONS
+#############################################################################
+## BEGIN QUARTET CONCORDANCE FUNCTIONS
+
+def quartetGroups(tree, taxa):
+# Gets the 4 groups of tips around each branch of a species tree with Tree.getQuartets, as the d1, d2, sister and
+# other clades. Returns the list of nodes with quartets and an array with a row for each of them, giving the group
+# (0-3) of each taxon id in the taxa TaxonTable, or -1 for taxa in none of the groups.
+
+    import numpy as np;
+
+    nodes, rows = [], [];
+    for node, quartet in tree.getQuartets().items():
+        if quartet == "NA":
+            continue;
+        row = np.full(len(taxa.labels), -1, dtype=np.int8);
+        for group, key in enumerate(["d1", "d2", "s", "q4"]):
+            for tip in quartet[key]:
+                row[taxa.getId(tip)] = group;
+        nodes.append(node);
+        rows.append(row);
+
+    return nodes, np.array(rows, dtype=np.int8).reshape(len(rows), len(taxa.labels));
+
+#############################################################################
+
+def geneQuartetCounts(tree, groups, taxa):
+# Counts the quartets in one gene tree that support each of the three topologies around each species tree branch,
+# with the groups from quartetGroups. Returns an array with a row for each branch and a column for each topology:
+# 0: d1,d2|sister,other (concordant)
+# 1: d1,sister|d2,other (discordant 1)
+# 2: d1,other|d2,sister (discordant 2)
+# Gene trees can be missing taxa and have polytomies. Quartets unresolved in the gene tree count for no topology, and
+# tips that aren't in the species tree are ignored.
+#
+# Quartets are never listed. With the gene tree rooted anywhere, a quartet of tips a,b,c,d is ab|cd if the LCA of a
+# and b has neither c nor d below it, or the LCA of c and d has neither a nor b below it. So for each pair of groups,
+# the pairs of tips (one from each) whose LCA is each node are counted from the number of tips of each group below
+# the node and below each of its descendants. Each of these is multiplied by the pairs from the other two groups that
+# are outside the node, and the quartets where both pairs are on separate sides (LCAs that aren't ancestors of each
+# other) are subtracted since they were counted twice. This takes O(n) array operations over all branches at once,
+# instead of O(n^4) quartets.
+
+    import numpy as np;
+
+    trav = tree.getTraversal();
+    num_nodes = len(tree.nodes);
+    num_branches = len(groups);
+
+    pre_pos = np.asarray(trav.pre_pos, dtype=np.int64);
+    end = np.arange(num_nodes) + np.asarray(trav.size, dtype=np.int64)[np.asarray(trav.pre, dtype=np.int64)];
+    # The stretch of the preorder for the subtree of each node, indexed by preorder position from here on
+
+    anc = np.array([ pre_pos[trav.index[tree.anc[tree.nodes[i]]]] if tree.nodes[i] != tree.root else 0 for i in trav.pre ], dtype=np.int64);
+
+    tip_pos, tip_ids = [], [];
+    for tip in tree.tips:
+        taxon_id = taxa.index.get(tip);
+        if taxon_id is not None and taxon_id < groups.shape[1]:
+            tip_pos.append(pre_pos[trav.index[tip]]);
+            tip_ids.append(taxon_id);
+    tip_groups = groups[:, tip_ids].T;
+    # The species tree group of each gene tree tip for every branch
+
+    counts = [];
+    for group in range(4):
+        in_group = np.zeros((num_nodes + 1, num_branches), dtype=np.int64);
+        in_group[np.array(tip_pos, dtype=np.int64) + 1] = tip_groups == group;
+        in_group = np.cumsum(in_group, axis=0);
+        counts.append(in_group[end] - in_group[:num_nodes]);
+    totals = [ group_counts[0] for group_counts in counts ];
+    # The number of tips of each group below each node, from sums along the preorder. The root is first.
+
+    def lcaPairs(p, q):
+    # The number of pairs of tips from groups p and q whose LCA is each node
+        pairs = counts[p] * counts[q];
+        below = np.zeros_like(pairs);
+        np.add.at(below, anc[1:], pairs[1:]);
+        return pairs - below;
+
+    def outside(p, q):
+    # The number of pairs of tips from groups p and q that are both outside each node
+        return (totals[p] - counts[p]) * (totals[q] - counts[q]);
+
+    def unrelated(pairs):
+    # The sum of pairs over the nodes that are neither below nor above each node
+        below = np.cumsum(np.vstack([np.zeros((1, num_branches), dtype=np.int64), pairs]), axis=0);
+        below = below[end] - below[:num_nodes];
+        above = np.zeros((num_nodes + 1, num_branches), dtype=np.int64);
+        above[1:] += pairs;
+        np.add.at(above, end, -pairs);
+        above = np.cumsum(above, axis=0)[:num_nodes];
+        return pairs.sum(axis=0) - below - above;
+
+    quartet_counts = np.zeros((num_branches, 3), dtype=np.int64);
+    for topology, (p, q, r, s) in enumerate([(0, 1, 2, 3), (0, 2, 1, 3), (0, 3, 1, 2)]):
+        pq_pairs, rs_pairs = lcaPairs(p, q), lcaPairs(r, s);
+        quartet_counts[:, topology] = (pq_pairs * outside(r, s)).sum(axis=0) + (rs_pairs * outside(p, q)).sum(axis=0) - (pq_pairs * unrelated(rs_pairs)).sum(axis=0);
+
+    return quartet_counts;
+
+#############################################################################
+
+def countQuartetConcordance(tree_lines, groups, taxa):
+# Adds up geneQuartetCounts over a list of unparsed TreeLines. taxa should already hold every species tree tip so
+# that the groups match between processes. Returns a dict of results that can be added together with
+# combineQuartetConcordance.
+
+    import numpy as np;
+
+    result = { 'counts' : np.zeros((len(groups), 3), dtype=np.int64), 'unreadable' : [], 'num_trees' : 0 };
+
+    for tree_line in tree_lines:
+        try:
+            tree = Tree(tree_line.tree_str, taxa=taxa);
+        except Exception:
+            result['unreadable'].append(tree_line.num);
+            continue;
+
+        result['counts'] += geneQuartetCounts(tree, groups, taxa);
+        result['num_trees'] += 1;
+
+    return result;
+
+#############################################################################
+
+def combineQuartetConcordance(total, result):
+# Adds the results of one call to countQuartetConcordance to a running total from another
+
+    total['counts'] = total['counts'] + result['counts'];
+    total['unreadable'] += result['unreadable'];
+    total['num_trees'] += result['num_trees'];
+
+    return total;
+
+## END QUARTET CONCORDANCE FUNCTIONS
+#############################################################################
+## BEGIN NODE MAPPING FUNCTIONS
+
+def refMasks(ref_index, shared):
+# Returns a dict of the clade masks of the internal nodes of a reference tree restricted to the shared taxa, to
+# the node. Nodes with the same shared taxa form a chain of single descendants up the tree. Ancestors come after
+# their descendants in Bipartitions.clade and overwrite them, so each mask maps to the ancestor-most node sharing
+# the mask, the one closest to the root.
+
+    ref_masks = {};
+    for node, mask in ref_index.clade.items():
+        mask &= shared;
+        if mask & (mask - 1):
+            ref_masks[mask] = node;
+    # Masks with fewer than 2 shared taxa are left out, which also leaves out the tips
+
+    return ref_masks;
+
+#############################################################################
+
+def mapNodes(query_tree, ref_tree, exact=False, mask_cache=False):
+# Maps each internal node in a query tree onto a reference tree. The trees can have different tips, since clades
+# are compared as bitmasks of the taxa in both trees.
+# A query node maps to the ancestor-most reference node (the one closest to the root) with the same shared taxa
+# in its clade, when pruning the unshared taxa leaves a chain of such nodes. With exact, that is the only match and
+# other nodes aren't mapped (""). Otherwise, nodes that aren't in the reference tree map to the smallest clade
+# containing them, at the top of the chain above the LCA of their shared taxa in the reference tree. For unrooted query trees, a node also matches a reference node on the other side of its split.
+# Nodes with fewer than 2 shared taxa aren't mapped.
+# mask_cache: a dict to keep the masks from refMasks between calls, for mapping many trees onto one reference
+# Returns: node_map { query node : ref node } and rev_map { ref node : query node }
+
+    if not ref_tree.bipartitions:
+        ref_tree.indexBipartitions();
+    ref_index = ref_tree.bipartitions;
+
+    query_index = query_tree.bipartitions;
+    if not query_index or query_index.taxa is not ref_index.taxa:
+        query_index = Bipartitions(query_tree, ref_index.taxa);
+    # Both trees need masks from the same taxon table
+
+    shared = query_index.all_tips & ref_index.all_tips;
+    if mask_cache is not False:
+        if shared not in mask_cache:
+            mask_cache[shared] = refMasks(ref_index, shared);
+        ref_masks = mask_cache[shared];
+    else:
+        ref_masks = refMasks(ref_index, shared);
+    # The reference clades restricted to the shared taxa, as a lookup from mask to node
+
+    node_map = {};
+    for query_node in query_tree.internals:
+        mask = query_index.clade[query_node] & shared;
+        if not mask & (mask - 1):
+            node_map[query_node] = "";
+            continue;
+        # Skip nodes with fewer than 2 shared taxa
+
+        ref_node = ref_masks.get(mask);
+        if ref_node is None and not query_tree.rooted:
+            ref_node = ref_masks.get(shared & ~mask);
+        # Exact matches are looked up directly
+
+        if ref_node is None and not exact:
+            lca = ref_tree.LCA(list(ref_index.getTips(mask)));
+            ref_node = ref_masks[ref_index.clade[lca] & shared];
+        # Otherwise map to the deepest node above the LCA of the shared taxa
+
+        node_map[query_node] = ref_node if ref_node is not None else "";
+    ## End query node loop
+
+    rev_map = { v : k for k,v in node_map.items() if v != "" };
+    # In some cases we may want the map from the query tree to the ref tree, though
+    # not all nodes will map
+
+    return node_map, rev_map;
+
+#############################################################################
+
+def mapTreeLines(tree_lines, ref_tree, exact=False, mask_cache=False):
+# Maps the internal nodes of each tree in a list of unparsed TreeLines onto a reference tree with mapNodes. Returns
+# a list of (line number, status, output line, number of nodes mapped) in the same order, where status is one of:
+# "mapped": the output line is the tree with each internal node labeled with the reference node it maps to, with
+#           the tree id in front if the line had one
+# "unreadable": the line couldn't be read as a tree
+
+    if mask_cache is False:
+        mask_cache = {};
+
+    mapped = [];
+    for tree_line in tree_lines:
+        if tree_line.error:
+            mapped.append((tree_line.num, "unreadable", "**Skipped - couldn't read as Newick string", 0));
+            continue;
+
+        try:
+            tree = Tree(tree_line.tree_str);
+        except Exception:
+            mapped.append((tree_line.num, "unreadable", "**Skipped - couldn't read as Newick string", 0));
+            continue;
+
+        node_map, rev_map = mapNodes(tree, ref_tree, exact, mask_cache);
+        tree_str = tree.writeNewick(label=lambda node : node_map[node] if node_map[node] else None);
+        if tree_line.tid:
+            tree_str = tree_line.tid + "\t" + tree_str;
+        mapped.append((tree_line.num, "mapped", tree_str, sum(1 for ref_node in node_map.values() if ref_node)));
+
+    return mapped;
+
+## END NODE MAPPING FUNCTIONS
+#############################################################################
+## BEGIN RECONCILIATION FUNCTIONS
+
+class SpeciesMap:
+# The tables of a rooted species tree that gene trees are reconciled with in reconcileGeneTree. Species tree nodes are
+# numbered by their position in Tree.nodes, so descendants have lower ids than their ancestors and the root is last.
+# lca:   a row for each species node with its LCA with every other node, so each gene tree node is mapped with one
+#        lookup per descendant. Since subtrees are contiguous in the preorder, the table is filled in blocks from pairs
+#        of slices of it, with one write per pair of nodes.
+# depth: the number of branches between each node and the root
+# anc:   the id of the ancestor of each node, or -1 for the root
+# sis:   the ids of the sisters of each node, the branches a gene lineage is lost on when it skips the node
+# Gene tip labels are matched to species tips by splitting them on delim and taking the field at that position (-1 for
+# the last). Labels that are species tip labels themselves are matched whole.
+
+    __slots__ = ("nodes", "tip_ids", "lca", "depth", "anc", "sis", "delim", "field", "species");
+
+    def __init__(self, stree, delim="_", field=0):
+
+        import numpy as np;
+
+        self.nodes = list(stree.nodes);
+        ids = { node : node_id for node_id, node in enumerate(self.nodes) };
+        self.tip_ids = { tip : ids[tip] for tip in stree.tips };
+        self.anc = [ ids[stree.anc[node]] if node != stree.root else -1 for node in self.nodes ];
+        self.sis = [ [ ids[sis] for sis in stree.sis[node] ] if node != stree.root else [] for node in self.nodes ];
+
+        self.depth = [0] * len(self.nodes);
+        for node_id in range(len(self.nodes) - 2, -1, -1):
+            self.depth[node_id] = self.depth[self.anc[node_id]] + 1;
+        # Ancestors come after their descendants, so going backwards each ancestor's depth is already set
+
+        trav = stree.getTraversal();
+        pre = np.asarray(trav.pre, dtype=np.int32);
+        def subtree(node):
+        # The ids of the nodes in the subtree of a node, as a slice of the preorder
+            start = trav.pre_pos[ids[node]];
+            return pre[start:start + trav.size[ids[node]]];
+
+        table = np.empty((len(self.nodes), len(self.nodes)), dtype=np.int32);
+        for node_id, node in enumerate(self.nodes):
+            node_subtree = subtree(node);
+            table[node_id, node_subtree] = node_id;
+            table[node_subtree, node_id] = node_id;
+            # A node is the LCA of itself and every node below it
+
+            if stree.type[node] == "tip":
+                continue;
+            desc_subtrees = [ subtree(desc) for desc in stree.desc[node] ];
+            for i, subtree1 in enumerate(desc_subtrees):
+                for subtree2 in desc_subtrees[i+1:]:
+                    table[np.ix_(subtree1, subtree2)] = node_id;
+                    table[np.ix_(subtree2, subtree1)] = node_id;
+            # And of any two nodes below different descendants
+
+        self.lca = [ array.array('i', row.tobytes()) for row in table ];
+        # Rows as arrays, which are quicker than numpy to index one value at a time and smaller than lists
+
+        self.delim = delim;
+        self.field = field;
+        self.species = {};
+        # The species tip id of each gene tip label seen so far, or None if it didn't match one
+
+    ##########
+
+    def getSpecies(self, gene_label):
+    # Returns the id of the species tip for a gene tip label, or None if it doesn't match any species tip
+
+        if gene_label not in self.species:
+            species_id = self.tip_ids.get(gene_label);
+            if species_id is None and self.delim:
+                fields = gene_label.split(self.delim);
+                if -len(fields) <= self.field < len(fields):
+                    species_id = self.tip_ids.get(fields[self.field]);
+            self.species[gene_label] = species_id;
+
+        return self.species[gene_label];
+
+#############################################################################
+
+def reconcileGeneTree(tree, species_map, dups=False, losses=False):
+# Reconciles a rooted gene tree with a species tree by LCA mapping. Each gene tip maps to its species and each internal
+# node to the LCA of the species its descendants map to. A node is a duplication if it maps to the same species node as
+# one of its descendants, and otherwise a speciation.
+# Losses are counted on each branch between a gene node and its descendants: the gene lineage is lost on the sisters of
+# every species node it skips between the species node of the ancestor (or its descendant towards the gene descendant,
+# for speciations) and the species node of the gene descendant.
+# Gene tips whose species isn't in the species tree are ignored, as if pruned from the gene tree.
+# dups, losses: lists with a count for each species node, which the duplications at each species node and the losses on
+#               the branch leading to each species node are added to
+# Returns: node_map { gene node : species node id or None } and the numbers of duplications, losses and ignored tips
+
+    lca, depth, anc, sis = species_map.lca, species_map.depth, species_map.anc, species_map.sis;
+
+    node_map = {};
+    num_dups, num_losses, num_ignored = 0, 0, 0;
+    for node in tree.nodes:
+        if tree.type[node] == "tip":
+            node_map[node] = species_map.getSpecies(node);
+            if node_map[node] is None:
+                num_ignored += 1;
+            continue;
+        # Descendants come before their ancestors in Tree.nodes, so tips are mapped first
+
+        desc_ids = [ node_map[desc] for desc in tree.desc[node] if node_map[desc] is not None ];
+        if len(desc_ids) < 2:
+            node_map[node] = desc_ids[0] if desc_ids else None;
+            continue;
+        # Nodes with only one descendant left after ignoring tips take its species node with no event
+
+        species_id = desc_ids[0];
+        for desc_id in desc_ids[1:]:
+            species_id = lca[species_id][desc_id];
+        node_map[node] = species_id;
+
+        is_dup = species_id in desc_ids;
+        if is_dup:
+            num_dups += 1;
+            if dups is not False:
+                dups[species_id] += 1;
+        # A node that maps to the same species node as one of its descendants is a duplication
+
+        stop_depth = depth[species_id] + (0 if is_dup else 1);
+        for desc_id in desc_ids:
+            while depth[desc_id] > stop_depth:
+                num_losses += len(sis[desc_id]);
+                if losses is not False:
+                    for sis_id in sis[desc_id]:
+                        losses[sis_id] += 1;
+                desc_id = anc[desc_id];
+        # Walk up from each descendant's species node, losing the lineage on the sisters of each node passed
+    ## End gene node loop
+
+    return node_map, num_dups, num_losses, num_ignored;
+
+#############################################################################
+
+def countReconciliation(tree_lines, species_map):
+# Reconciles each tree in a list of unparsed TreeLines with reconcileGeneTree. Returns a dict of results that can be
+# added together with combineReconciliation, with the duplications at and losses above each species node, and a
+# (line number, tree id, duplications, losses) tuple for each gene tree in order. Trees with no tips in the species
+# tree are listed as unmapped, and the gene tip labels that were ignored are kept.
+
+    num_species_nodes = len(species_map.nodes);
+    result = { 'dups' : [0] * num_species_nodes, 'losses' : [0] * num_species_nodes, 'trees' : [],
+               'unreadable' : [], 'unmapped' : [], 'ignored' : set(), 'num_trees' : 0 };
+
+    for tree_line in tree_lines:
+        try:
+            tree = Tree(tree_line.tree_str);
+        except Exception:
+            result['unreadable'].append(tree_line.num);
+            continue;
+
+        node_map, num_dups, num_losses, num_ignored = reconcileGeneTree(tree, species_map, result['dups'], result['losses']);
+        if node_map[tree.root] is None:
+            result['unmapped'].append(tree_line.num);
+            continue;
+        if num_ignored:
+            result['ignored'].update(tip for tip in tree.tips if node_map[tip] is None);
+
+        result['trees'].append((tree_line.num, tree_line.tid, num_dups, num_losses));
+        result['num_trees'] += 1;
+
+    return result;
+
+#############################################################################
+
+def combineReconciliation(total, result):
+# Adds the results of one call to countReconciliation to a running total from another
+
+    total['dups'] = [ a + b for a, b in zip(total['dups'], result['dups']) ];
+    total['losses'] = [ a + b for a, b in zip(total['losses'], result['losses']) ];
+    for key in ["trees", "unreadable", "unmapped"]:
+        total[key] += result[key];
+    total['ignored'] |= result['ignored'];
+    total['num_trees'] += result['num_trees'];
+
+    return total;
+
+## END RECONCILIATION FUNCTIONS
+#############################################################################
+## BEGIN RANDOM TREE FUNCTIONS
+
+TREE_MODELS = ["yule", "coalescent", "caterpillar"];
+
+def randomTree(num_tips, model="yule", seed=None, prefix="t", float_format=".6f"):
+# Returns the Newick string of a random rooted, ultrametric tree with tips labeled prefix1 to prefixN. The tree is built
+# backwards in time from the tips by joining pairs of lineages, and written without recursion, so trees with any number
+# of tips can be made. The same seed always gives the same tree for a model, and the seed is combined with the model
+# so that different models get different trees.
+# yule:        a pure birth tree with a speciation rate of 1. With k lineages, the time to the next join going back is
+#              exponential with rate k, and two random lineages join.
+# coalescent:  a Kingman coalescent tree in coalescent units. With k lineages the rate is k(k-1)/2 and two random
+#              lineages join.
+# caterpillar: the most unbalanced tree, where each tip in a random order joins the clade of the ones before it, with
+#              times as for yule
+# Yule and coalescent trees have the same distribution of topologies and only differ in their branch lengths, but with
+# the model in the seed they are still different samples from it.
+
+    if model not in TREE_MODELS:
+        raise ValueError("Tree model must be one of " + ", ".join(TREE_MODELS) + ": " + str(model));
+    if num_tips < 2:
+        raise ValueError("Random trees need at least 2 tips: " + str(num_tips));
+
+    rng = random.Random(None if seed is None else str(seed) + "-" + model);
+    # A string seed gives the same numbers on every run, so the model can be part of it
+
+    height = [0.0] * num_tips;
+    desc = [None] * num_tips;
+    lineages = list(range(num_tips));
+    if model == "caterpillar":
+        rng.shuffle(lineages);
+    # Tips are nodes 0 to N-1 and each join adds an internal node, so the root is the last node
+
+    cur_time = 0.0;
+    for num_lineages in range(num_tips, 1, -1):
+        if model == "coalescent":
+            cur_time += rng.expovariate(num_lineages * (num_lineages - 1) / 2);
+        else:
+            cur_time += rng.expovariate(num_lineages);
+
+        if model == "caterpillar":
+            joined = [lineages.pop(), lineages.pop()];
+        else:
+            joined = [];
+            for i in range(2):
+                lineage_ind = rng.randrange(len(lineages));
+                joined.append(lineages[lineage_ind]);
+                lineages[lineage_ind] = lineages[-1];
+                lineages.pop();
+        # Pick the lineages to join, removing random ones by swapping them to the end of the list
+
+        lineages.append(len(height));
+        height.append(cur_time);
+        desc.append(joined);
+    ## End join loop
+
+    anc = [-1] * len(height);
+    for node, node_desc in enumerate(desc):
+        if node_desc:
+            for d in node_desc:
+                anc[d] = node;
+
+    return writeNewick(len(height) - 1, lambda node : desc[node], name=lambda node : prefix + str(node + 1),
+                       bl=lambda node : height[anc[node]] - height[node] if anc[node] != -1 else None, float_format=float_format);
+
+## END RANDOM TREE FUNCTIONS
+#############################################################################
+## BEGIN TREE STRING FUNCTIONS
+
+def remBranchLength(tree_str):
+# Removes branch lengths and labels from a tree string
+
+    tree_str = re.sub(r'[)][\d\w<>/.eE_:-]+', ')', tree_str);
+    tree_str = re.sub(r':[\d.eE-]+', '', tree_str);
+
+    return tree_str;
+
+#############################################################################
+
+def writeNewick(root, children, name=str, label=None, support=None, bl=None, float_format=False, handle=False, end=";"):
+# Writes a tree as a Newick string in one traversal with a stack, so nodes are never found by searching the string.
+# root: the root node
+# children: function returning the list of descendants of a node in order, or an empty list or None for tips
+# name: function returning the text for a tip
+# label: function returning the label of an internal node, or None for no label
+# support: function returning a support value for an internal node, or None. Written after the label, with a / if
+#          the node also has a label
+# bl: function returning the branch length of a node, or None. The branch length of the root is not written
+# float_format: format spec (e.g. ".6f") for branch lengths and supports given as floats
+# handle: if given, the tree is written to this file handle in pieces and None is returned
+# end: the string written after the tree
+
+    fmt = lambda value : format(value, float_format) if float_format and isinstance(value, float) else str(value);
+
+    tree_str = [];
+    stack = [(root, 0)];
+    # The state of each node on the stack is 0 when opening it, 1 when closing it, or 2 for a comma
+
+    while stack:
+        node, state = stack.pop();
+
+        if state == 2:
+            tree_str.append(",");
+            continue;
+
+        if state == 0:
+            desc = children(node);
+            if desc:
+                tree_str.append("(");
+                stack.append((node, 1));
+                for i in range(len(desc)-1, -1, -1):
+                    stack.append((desc[i], 0));
+                    if i:
+                        stack.append((None, 2));
+                continue;
+            # Opening an internal node, the closing and descendants are put on the stack in reverse
+
+            tree_str.append(name(node));
+            # Tips
+
+        else:
+            tree_str.append(")");
+            node_label = label(node) if label else None;
+            if node_label not in (None, ""):
+                tree_str.append(str(node_label));
+
+            node_support = support(node) if support else None;
+            if node_support is not None:
+                if node_label not in (None, ""):
+                    tree_str.append("/");
+                tree_str.append(fmt(node_support));
+        # Closing an internal node after its descendants have been written
+
+        if bl and node != root:
+            node_bl = bl(node);
+            if node_bl is not None:
+                tree_str.append(":" + fmt(node_bl));
+        # Branch lengths
+
+        if handle and len(tree_str) > 4096:
+            handle.write("".join(tree_str));
+            tree_str = [];
+        # Write large trees out in pieces
+    ## End Newick writing loop
+
+    tree_str.append(end);
+    if handle:
+        handle.write("".join(tree_str));
+        return None;
+    return "".join(tree_str);
+
+#############################################################################
+
+def scanNewick(tree_str):
+# Reads a Newick string in a single pass with a stack of open nodes. Returns a dict of lists indexed
+# by the order each node is first seen:
+# text: tip name or internal node label, bl: branch length string or "NA", type: "tip" or "internal",
+# anc: index of ancestor (-1 for the root), desc: list of descendant indices
+# Also returns the internal nodes grouped into levels by their height above their deepest tip, in the
+# order of their opening parentheses, and the tree as a list of string pieces with an empty slot after
+# each closing parenthesis so that node labels can be filled in without any string replacement.
+
+    scan = { 'text' : [], 'bl' : [], 'type' : [], 'anc' : [], 'desc' : [], 'tips' : [], 'internals' : [],
+                'levels' : [], 'pieces' : [], 'slot' : [], 'start' : [], 'end' : [], 'root' : -1 };
+    pieces = scan['pieces'];
+
+    height = [];
+    stack = [];
+    closed = -1;
+    # closed is the index of the last internal node closed, used to assign the label and branch length
+    # that come after a closing parenthesis
+
+    for token in NEWICK_TOKENS.findall(tree_str):
+        if token == "(":
+            if not stack and scan['root'] != -1:
+                raise ValueError("More than one root node in tree string: " + tree_str);
+
+            node_ind = len(scan['text']);
+            scan['text'].append("");
+            scan['bl'].append("NA");
+            scan['type'].append("internal");
+            scan['anc'].append(stack[-1] if stack else -1);
+            scan['desc'].append([]);
+            scan['slot'].append(-1);
+            scan['start'].append(len(pieces));
+            scan['end'].append(-1);
+            scan['internals'].append(node_ind);
+            height.append(0);
+
+            if stack:
+                scan['desc'][stack[-1]].append(node_ind);
+            else:
+                scan['root'] = node_ind;
+            stack.append(node_ind);
+            pieces.append("(");
+            closed = -1;
+        ## Opening a new internal node
+
+        elif token == ")":
+            if not stack:
+                raise ValueError("Unbalanced parentheses in tree string: " + tree_str);
+
+            closed = stack.pop();
+            pieces.append(")");
+            scan['slot'][closed] = len(pieces);
+            pieces.append("");
+            scan['end'][closed] = len(pieces);
+            # The slot is an empty piece where the node label will go
+
+            height[closed] += 1;
+            if stack and height[closed] > height[stack[-1]]:
+                height[stack[-1]] = height[closed];
+            # The height of a node is one more than the highest of its descendants. The ancestor
+            # stores the highest seen so far until it is closed
+        ## Closing an internal node
+
+        elif token == ",":
+            pieces.append(",");
+            closed = -1;
+
+        elif token == ";":
+            break;
+
+        else:
+            if ":" in token:
+                name, bl = token.split(":", 1);
+            else:
+                name, bl = token, "NA";
+            # Split the label from the branch length
+
+            if closed != -1:
+                if "<" in name:
+                    name = re.sub(r"<[\d]+>", "", name);
+                    token = name if bl == "NA" else name + ":" + bl;
+                # Remove node labels from a tree string already labeled by Tree
+
+                scan['text'][closed] = name;
+                scan['bl'][closed] = bl;
+                if closed != scan['root']:
+                    pieces.append(token);
+                    scan['end'][closed] = len(pieces);
+                # Labels and branch lengths on the root are not kept in the labeled tree
+            ## A label and/or branch length for the internal node just closed
+
+            else:
+                if not stack:
+                    raise ValueError("Tip outside of parentheses in tree string: " + tree_str);
+
+                node_ind = len(scan['text']);
+                scan['text'].append(name);
+                scan['bl'].append(bl);
+                scan['type'].append("tip");
+                scan['anc'].append(stack[-1]);
+                scan['desc'].append("NA");
+                scan['slot'].append(-1);
+                scan['start'].append(len(pieces));
+                scan['tips'].append(node_ind);
+                height.append(0);
+
+                scan['desc'][stack[-1]].append(node_ind);
+                pieces.append(token);
+                scan['end'].append(len(pieces));
+            ## A tip with its branch length
+    ## End token loop
+
+    if stack or scan['root'] == -1:
+        raise ValueError("Unbalanced parentheses in tree string: " + tree_str);
+
+    scan['levels'] = [ [] for h in range(height[scan['root']]) ];
+    for node_ind in scan['internals']:
+        scan['levels'][height[node_ind]-1].append(node_ind);
+    # Group the internal nodes by height. Since they are visited in order of their opening parentheses,
+    # each level is ordered left to right in the tree string
+
+    return scan;
+
+#############################################################################
+
+def getSubtree(node, tree_str):
+# Gets the subtree string at a given node from a labeled tree string from treeParse
+# Much slower than genSubtrees method
+
+    subtree = "";
+    # Initialize the subtree string
+
+    partree = tree_str[:tree_str.index(node)][::-1]
+    # Slice the tree string at the index of the node label and reverse it
+
+    cp = 0;
+    op = 0;
+    # Counts of closing an opening parentheses. The subtree will be complete when they
+    # are equal
+
+    for c in partree:
+        if c == ")":
+            cp = cp + 1;
+        if c == "(":
+            op = op + 1;
+        subtree = subtree + c;
+        if cp == op:
+            break;
+    # Loop through every character in the sliced and reversed tree, counting parentheses and adding
+    # charcters to the subtree string one at a time. Stop when the number of closing parentheses equals
+    # the number of opening
+
+    return subtree[::-1];
+    # Return the reverse of the subtree, which is the original orientation
+
+#############################################################################
+
+# def adjustTreeDict(tree_dict, root):
+# # Gets some info about branch lengths from the tree dict and retrieves support
+# # label
+
+#     num_no_supp = 0;
+#     # Number of nodes with no support
+
+#     bls = [];
+#     # A list of all branch lengths in the tree
+
+#     na_bl_spec = [];
+#     # A list of species that have no branch length (i.e. tips from Astral)
+
+#     for n in tree_dict:
 #         if n == root:
 #             continue;
 #         # Skip the root since it won't have a length or support
@@ -1551,71 +4502,6 @@ def getSubtree(node, tree_str):
 
 #############################################################################
 
-def mapNodes(query_tree, query_clades, query_splits, ref_tree, ref_clades, ref_splits):
-# Species must have same tip labels, except for missing/pruned species
-# Smaller tree must be query tree
-
-    node_map = {};
-    # Node map dict
-
-    for query_node in query_tree.internals:
-    # We map every internal query node in the query tree
-
-        max_node = "";
-        max_node_set = {};
-        # We map nodes by finding the clade in reference tree that has 
-        # that the query clade is a subset of and that maximizes number of 
-        # nodes in the reference tree
-
-        query_clade = query_clades[query_node];
-        query_split = query_splits[query_node];
-        # Look up the query clade and split for the current node
-
-        for ref_node in ref_tree.internals:
-        # Check every internal ref node in the ref tree
-
-            check_node = False;
-            # Flag if the current query clade is contained in the current ref clade
-
-            ref_clade = ref_clades[ref_node];
-            ref_split = ref_splits[ref_node];
-            # Look up the ref clade and split
-
-            if not query_tree.rooted and query_node == query_tree.root:
-                if query_clade <= ref_clade or query_clade <= ref_split:
-                    check_node = True;
-            # If the tree is NOT rooted and the query node is the "root", check if
-            # the query node is a subset ofeither side of the ref node
-
-            elif query_clade <= ref_clade and query_split <= ref_split:
-                check_node = True;
-            # If the tree is rooted, check whether the query split is a subset on both
-            # sides of the ref split
-
-            # elif query_tree.split[query_node] <= ref_tree.clade[ref_node] and query_tree.clade[query_node] <= ref_tree.split[ref_node]:
-            #     check_node = True;                    
-
-            if check_node:
-                node_set = ref_clade | ref_split;
-                if len(node_set) > len(max_node_set):
-                    max_node_set = node_set;
-                    max_node = ref_node;
-            # If we find the query node matches the ref node, here we check if it is the deepest
-            # possible ref node by counting the tips and comparing it to the previous match
-        ## End ref node loop
-
-        node_map[query_node] = max_node;
-        # Save the deepest matching node as the map
-    ## End query node loop
-
-    rev_map = { v : k for k,v in node_map.items() if v != "" };
-    # In some cases we may want the map from the query tree to the ref tree, though
-    # not all nodes will map
-
-    return node_map, rev_map;
-
-#############################################################################
-
 def spacedOut(string, totlen, sep=" "):
 # Properly adds spaces to the end of a message to make it a given length
     spaces = sep * (totlen - len(string));
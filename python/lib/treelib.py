@@ -4,8 +4,7 @@
 # August 2017
 #############################################################################
 
-import core, sys, os, subprocess, treeparse as tp, re
-from collections import defaultdict
+import core, sys, os, treeparse as tp, treec
 
 #############################################################################
 
@@ -18,31 +17,25 @@ def treeSep(infile, out_prefix, outdir):
 	pathfile = open(os.path.join(outdir, "tree-sep-paths.txt"), "w");
 	# Creates a file with a list of paths to each gene tree file. Thought I would use this for Notung, but maybe not.
 
-	num_lines, num_trees, line_skip = 0,0,[];
-	for line in open(infile):
-		num_lines += 1;
-		tree = line.strip();
-		try:
-			td, t, r = tp.treeParse(line);
-		except:
-			line_skip.append(str(num_lines-1));
+	trees = treec.TreeCollection(infile);
+	for tree_line in trees:
+		if tree_line.error:
 			continue;
-		num_trees += 1;
 		# Check to make sure each line can be read as a Newick string.
 
-		outfilename = os.path.join(outdir, out_prefix + "-" + str(num_lines) + ".tre");
+		outfilename = os.path.join(outdir, out_prefix + "-" + str(tree_line.num) + ".tre");
 		pathfile.write(os.path.abspath(outfilename) + "\n");
 		with open(outfilename, "w") as treefile:
-			treefile.write(tree);
+			treefile.write(tree_line.line);
 		# Write the valid Newick string to its own output file.
 	pathfile.close();
 
 	print("\n" + core.getTime() + " Done!");
 	print("-----");
-	print(str(num_lines) + " lines in file.");
-	if line_skip != []:
-		print("The following " + str(len(line_skip)) + " line(s) were skipped because they couldn't be read as Newick formatted trees: " + ",".join(line_skip));
-	print(str(num_trees) + " trees separated!");
+	print(str(trees.num_lines) + " lines in file.");
+	if trees.skipped != []:
+		print("The following " + str(len(trees.skipped)) + " line(s) were skipped because they couldn't be read as Newick formatted trees: " + ",".join(trees.skipped));
+	print(str(trees.num_trees) + " trees separated!");
 	print("=======================================================================");
 
 #############################################################################
@@ -51,19 +44,17 @@ def treeJoin(infiles, outfilename):
 # This function takes an input directory and reads all files. It puts any Newick strings
 # it finds into the output file.
 	num_files, num_read, num_trees, tre_skip, parse_skip = 0,0,0,[],[];
+	taxa = treec.TaxonTable();
 	with open(outfilename, "w") as treefile:
 		for infile in infiles:
 			num_files += 1;
-			for line in open(infile):
-				line = line.strip();
-				try:
-					td, t, r = tp.treeParse(line);
-				except:
+			for tree_line in treec.iter_trees(infile, taxa=taxa):
+				if tree_line.error:
 					if infile not in parse_skip:
 						parse_skip.append(infile);
 					continue;
 				num_trees += 1;
-				treefile.write(line + "\n");
+				treefile.write(tree_line.line + "\n");
 				# Check if each line in the current file is a Newick string and, if so, write it to 
 				# the output file.
 
@@ -89,29 +80,24 @@ def labelTree(infiles, tree_flag, outfilename):
 		sys.exit();
 	# For a tree string, just print the labeled tree to the screen
 
-	infile = infiles[0];
-	num_lines, num_trees, line_skip = 0,0,[];
+	trees = treec.TreeCollection(infiles[0], parser=tp.treeParse);
 	with open(outfilename, "w") as treefile:
-		for line in open(infile):
-			num_lines += 1;
-			try:
-				td, tree, r = tp.treeParse(line);
-			except:
-				line_skip.append(str(num_lines));
+		for tree_line in trees:
+			if tree_line.error:
 				continue;
-			num_trees += 1;
+			td, tree, r = tree_line.tree;
 			# for each line in the file, check to make sure it is a Newick string.
 
-			labeled_tree = tp.addBranchLength(tree, td);
-			treefile.write(labeled_tree + "\n");
+			tp.addBranchLength(tree, td, handle=treefile);
+			treefile.write("\n");
 			# Label the tree and write to the output file.
 
 	print("\n" + core.getTime() + " Done!");
 	print("-----");
-	print(str(num_lines) + " total lines.");
-	print(str(num_trees) + " trees labeled.");
-	if line_skip != []:
-		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join([os.path.basename(f) for f in line_skip]));
+	print(str(trees.num_lines) + " total lines.");
+	print(str(trees.num_trees) + " trees labeled.");
+	if trees.skipped != []:
+		print("The following " + str(len(trees.skipped)) + " lines couldn't be read as trees and were skipped: " + ",".join(trees.skipped));
 	print("=======================================================================");	
 
 #############################################################################
@@ -130,18 +116,14 @@ def rootCheck(infiles, tree_flag, outfilename):
 		sys.exit();
 	# If the input is a Newick string, simply print the result to the screen.
 
-	infile = infiles[0];
-	num_lines, num_trees, line_skip, num_unroot, num_rooted, num_undet = 0,0,[],0,0,0;
+	trees = treec.TreeCollection(infiles[0], parser=tp.treeParse);
+	num_unroot, num_rooted, num_undet = 0,0,0;
 	with open(outfilename, "w") as treefile:
-		for line in open(infile):
-			num_lines += 1;
-			try:
-				td, tree, r = tp.treeParse(line);
-			except:
-				line_skip.append(str(num_lines));
+		for tree_line in trees:
+			if tree_line.error:
 				treefile.write("**Skipped\n");
 				continue;
-			num_trees += 1;
+			td, tree, r = tree_line.tree;
 			# Check to make sure each line in the file can be read as a Newick string. If not, skip it.
 
 			rooted = tp.rootedOrNot(td);
@@ -161,10 +143,10 @@ def rootCheck(infiles, tree_flag, outfilename):
 
 	print("\n" + core.getTime() + " Done!");
 	print("-----");
-	print(str(num_lines) + " total lines.");
-	if line_skip != []:
-		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
-	print(str(num_trees) + " trees checked.");
+	print(str(trees.num_lines) + " total lines.");
+	if trees.skipped != []:
+		print("The following " + str(len(trees.skipped)) + " lines couldn't be read as trees and were skipped: " + ",".join(trees.skipped));
+	print(str(trees.num_trees) + " trees checked.");
 	print(str(num_rooted) + " rooted trees.");
 	print(str(num_unroot) + " unrooted trees.");
 	print(str(num_undet) + " undetermined trees.");
@@ -172,11 +154,44 @@ def rootCheck(infiles, tree_flag, outfilename):
 
 #############################################################################
 
-def rootTrees(infiles, tree_flag, outgroup, outfilename):
-# This function relies on Newick Utilities (NU) to root trees at a specified outgroup.
-	import re
-	tmpfilename = "tmp9825xyz-t-m-p.tmp";
-	# NU can only read trees from a file, so I make a temporary one.
+def rootTreeFile(infile, outgroup, outfilename, procs=1):
+# Roots every tree in a file at the outgroup and writes them to the output file in order, splitting chunks
+# of trees between processes. Used by rootTrees and rootTreesBest.
+	chunk_size = 1000;
+	trees = treec.TreeCollection(infile, parser=False);
+	tree_chunks = treec.chunkTreeLines(trees, chunk_size, skip_errors=False);
+	num_trees, non_mono, line_skip = 0,[],[];
+
+	with open(outfilename, "w", buffering=1048576) as treefile:
+		results = treec.mapChunks(treec.rootTreeLines, tree_chunks, procs, outgroup);
+		# Root each chunk of trees, in order.
+
+		for result in results:
+			for num, status, out_line in result:
+				if status == "rooted":
+					num_trees += 1;
+				elif status == "paraphyletic":
+					non_mono.append(str(num));
+					continue;
+				else:
+					line_skip.append(str(num));
+				treefile.write(out_line + "\n");
+		# Write the rooted trees and notes for the lines that were skipped.
+
+	print("\n" + core.getTime() + " Done!");
+	print("-----");
+	print(str(trees.num_lines) + " total lines.");
+	if line_skip != []:
+		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
+	if non_mono != []:
+		print("The following " + str(len(non_mono)) + " lines did not contain monophyletic outgroups: " + ",".join(non_mono));
+	print(str(num_trees) + " trees rooted.");
+	print("=======================================================================");
+
+#############################################################################
+
+def rootTrees(infiles, tree_flag, outgroup, outfilename, procs=1):
+# This function roots trees at a specified outgroup.
 	try:
 		outgroup = outgroup.split(",");
 	except:
@@ -185,141 +200,34 @@ def rootTrees(infiles, tree_flag, outgroup, outfilename):
 
 	if tree_flag:
 		td, tree, r, tree_string = infiles;
-		lca, monophyletic = tp.LCA(outgroup, td);
-		if monophyletic == 0:
+		rooted_tree = treec.Tree(tree_string).rootString(outgroup);
+		if not rooted_tree:
 			sys.exit(core.errorOut(27, "Your outgroup labels (-outgroup) must be monophyletic!"));
 		# Specified outgroups must be monophyletic.
-		
-		with open(tmpfilename, "w") as tmpfile:
-			tmpfile.write(tree_string);
-		nw_cmd = "nw_reroot " + tmpfilename + " " + " ".join(outgroup);
+
 		print("\n----Rooted tree----");
-		os.system(nw_cmd);
+		print(rooted_tree);
 		print()
-		# The NU call with nw_reroot.
 		sys.exit();
 	# If the input is a Newick string, just print the output to the screen.
 
-	tmpfilename_2 = "tmp25xzgz-t-m-p.tmp"
-	# To retrieve output from NU I use another temporary file.
-	infile = infiles[0];
-	num_lines, num_trees, non_mono, line_skip = 0,0,[],[];
-	with open(outfilename, "w") as treefile:
-		for line in open(infile):
-			num_lines += 1;
-			tid = False;
-			if len(line.split("\t")) > 1:
-				tid, line = line.strip().split("\t");
-			try:
-				td, tree, r = tp.treeParse(line);
-			except:
-				line_skip.append(str(num_lines));
-				treefile.write("**Skipped - couldn't read as Newick string\n");
-				continue;
-			if not all(s in td for s in outgroup):
-				line_skip.append(str(num_lines));
-				treefile.write("**Skipped - not all outgroups in tree.\n");
-				continue;
-
-			lca, monophyletic = tp.LCA(outgroup, td);
-			if monophyletic == 0:
-				non_mono.append(str(num_lines));
-				continue;
-			num_trees += 1;
-			# Check to make sure each line is a Newick string and that the outgroups are monophyletic in that tree.
-
-			with open(tmpfilename, "w") as tmpfile:
-				tmpfile.write(line);
-			nw_cmd = "nw_reroot " + tmpfilename + " " + " ".join(outgroup) + " > " + tmpfilename_2;
-			os.system(nw_cmd);
-			# The NU call with nw_reroot.
-
-			rooted_tree = open(tmpfilename_2, "r").read().strip();
-			if tid:
-				rooted_tree = tid + "\t" + rooted_tree;
-			treefile.write(rooted_tree + "\n");
-			# Getting the output from the tmp file.
-
-	os.system("rm " + tmpfilename);
-	os.system("rm " + tmpfilename_2);
-	# Remove the tmp files.
-
-	print("\n" + core.getTime() + " Done!");
-	print("-----");
-	print(str(num_lines) + " total lines.");
-	if line_skip != []:
-		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
-	if non_mono != []:
-		print("The following " + str(len(non_mono)) + " lines did not contain monophyletic outgroups: " + ",".join(non_mono));
-	print(str(num_trees) + " trees rooted.");
-	print("=======================================================================");
+	rootTreeFile(infiles[0], outgroup, outfilename, procs);
 
 #############################################################################
 
-def rootTreesBest(infiles, tree_flag, outgroup, outfilename):
-# This function relies on Newick Utilities (NU) to root trees at a specified outgroup.
-	import re
-	tmpfilename = "tmp9825xyz-t-m-p.tmp";
-	# NU can only read trees from a file, so I make a temporary one.
+def rootTreesBest(infiles, tree_flag, outgroup, outfilename, procs=1):
+# This function roots trees at a specified outgroup in a best-trees.txt file, keeping the alignment file name on each line.
 	try:
 		outgroup = outgroup.split(",");
 	except:
 		sys.exit(core.errorOut(26, "-outgroup entered incorrectly! Should be comma delimited list of tip labels."));
 	# Check to make sure the outgroups were entered correctly.
 
-	tmpfilename_2 = "tmp25xzgz-t-m-p.tmp"
-	# To retrieve output from NU I use another temporary file.
-	infile = infiles[0];
-	num_lines, num_trees, non_mono, line_skip = 0,0,[],[];
-	with open(outfilename, "w") as treefile:
-		for line in open(infile):
-			alnfilename, line = line.strip().split("\t");
-			num_lines += 1;
-			try:
-				td, tree, r = tp.treeParse(line);
-			except:
-				line_skip.append(str(num_lines));
-				treefile.write("**Skipped - couldn't read as Newick string\n");
-				continue;
-			if not all(s in td for s in outgroup):
-				line_skip.append(str(num_lines));
-				treefile.write("**Skipped - not all outgroups in tree.\n");
-				continue;
-
-			lca, monophyletic = tp.LCA(outgroup, td);
-			if monophyletic == 0:
-				non_mono.append(str(num_lines));
-				continue;
-			num_trees += 1;
-			# Check to make sure each line is a Newick string and that the outgroups are monophyletic in that tree.
-
-			with open(tmpfilename, "w") as tmpfile:
-				tmpfile.write(line);
-			nw_cmd = "nw_reroot " + tmpfilename + " " + " ".join(outgroup) + " > " + tmpfilename_2;
-			os.system(nw_cmd);
-			# The NU call with nw_reroot.
-
-			rooted_tree = open(tmpfilename_2, "r").read().strip();
-			treefile.write(alnfilename + "\t" + rooted_tree + "\n");
-			# Getting the output from the tmp file.
-
-	os.system("rm " + tmpfilename);
-	os.system("rm " + tmpfilename_2);
-	# Remove the tmp files.
-
-	print("\n" + core.getTime() + " Done!");
-	print("-----");
-	print(str(num_lines) + " total lines.");
-	if line_skip != []:
-		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
-	if non_mono != []:
-		print("The following " + str(len(non_mono)) + " lines did not contain monophyletic outgroups: " + ",".join(non_mono));
-	print(str(num_trees) + " trees rooted.");
-	print("=======================================================================");
+	rootTreeFile(infiles[0], outgroup, outfilename, procs);
 
 #############################################################################
 
-def flightOfTheConcordance(infiles, tree_flag, genefilename, count_tops):
+def flightOfTheConcordance(infiles, tree_flag, genefilename, count_tops, procs=1):
 # This function calculates concordance factors for each node in a species tree given a
 # set of singly-copy gene trees.
 	if tree_flag:
@@ -331,90 +239,61 @@ def flightOfTheConcordance(infiles, tree_flag, genefilename, count_tops):
 			sys.exit(core.errorOut(28, "Could not read species tree (-s) as a Newick tree!"));
 		# If the input species tree was a file check to make sure it contains a valid Newick tree.	
 
-	stips = [node for node in sinfo if sinfo[node][1] == 'tip'];
-	sclades = { node : set(tp.getClade(node, sinfo)) for node in sinfo if sinfo[node][2] != 'tip' };
-	# Get the tips and clades (tip nodes) for each internal node in the species tree.
-
-	#node_counts = defaultdict(float);
-	node_counts = { node : 0.0 for node in sinfo if sinfo[node][2] != 'tip' };
-	num_lines, tre_skip, sc_skip = 0, [], [];
-	total_trees = 0.0;
-	if count_tops:
-		tops, top_counts, top_trees = [], [], [];
-
-	for line in open(genefilename):
-		num_lines += 1;
-		try:
-			ginfo, gtree, groot = tp.treeParse(line);
-		except:
-			tre_skip.append(str(num_lines));
-			continue;
-		# Check if each line in the genetrees file is a Newick string.
-
-		if count_tops:
-			gclade = set([frozenset(tp.getClade(node, ginfo)) for node in ginfo if ginfo[node][2] != 'tip']);
-			if gclade in tops:
-				topind = tops.index(gclade);
-				top_counts[topind] += 1;
-			else:
-				tops.append(gclade);
-				top_counts.append(1);
-				top_trees.append(gtree);
-
-		gtips = [node for node in ginfo if ginfo[node][1] == 'tip'];
-		if set(gtips) != set(stips) or len(gtips) != len(stips):
-			sc_skip.append(str(num_lines));
-			continue;
-		# Check to make sure the tips are identical in the current gene tree and the species tree.
-
-		gclades = [ set(tp.getClade(node, ginfo)) for node in ginfo if ginfo[node][2] != 'tip' ];
-		# Get the clades (tip nodes) for each internal node in the current gene tree.
-
-		for node in sclades:
-			if sclades[node] in gclades:
-				node_counts[node] += 1.0;
-			if node == sroot and sclades[node] not in gclades:
-				print(len(ginfo));
-				print(gtree);
-		# Check if each species tree clade is in the gene tree.
-		total_trees += 1.0;
-
+	taxa = treec.TaxonTable();
+	for node in sinfo:
+		if sinfo[node][2] == 'tip':
+			taxa.getId(node);
+	# Give every species tree tip an id up front so the clade masks are the same in every process.
+
+	sclades = {};
+	sdesc = tp.descDict(sinfo);
+	for node in sinfo:
+		if sinfo[node][2] != 'tip':
+			sclades[node] = 0;
+			for tip in tp.getClade(node, sinfo, sdesc):
+				sclades[node] |= 1 << taxa.getId(tip);
+	# Get the clade of each internal node in the species tree as a bitmask of its tips.
+
+	chunk_size = 1000;
+	gene_trees = treec.TreeCollection(genefilename, parser=False);
+	tree_chunks = treec.chunkTreeLines(gene_trees, chunk_size);
+	results = { 'counts' : { node : 0 for node in sclades }, 'decisive' : { node : 0 for node in sclades }, 'tops' : {}, 'unreadable' : [], 'skipped' : [], 'num_trees' : 0 };
+	for result in treec.mapChunks(treec.countConcordance, tree_chunks, procs, sclades, sroot, taxa, count_tops):
+		results = treec.combineConcordance(results, result);
+	# Check each gene tree for each species tree clade, in chunks of gene trees split between processes.
 
 	print("\n" + core.getTime() + " Done!");
 
 	if count_tops:
 		print("\n----Topology counts----");
-		tops_dict = {};
-		for x in range(len(tops)):
-			tops_dict[top_trees[x]] = top_counts[x];
-		for item in sorted(list(tops_dict.items()), key=lambda x: x[1], reverse=True):
-			print(item[0], item[1]);
-		print(len(tops_dict), "total topologies found");
+		for top_count, top_num, top_tree in sorted(results['tops'].values(), key=lambda x: x[0], reverse=True):
+			print(top_tree, top_count);
+		print(len(results['tops']), "total topologies found");
 
 	print("\n----Concordance factor nodes----");
-	stree = tp.addBranchLength(stree, sinfo);
-	for node in node_counts:
-		cf = round(node_counts[node]/total_trees,2)
-		print(node, cf);
-		if sinfo[node][3] not in  ["NA",'']:
-			stree = stree.replace(node, node + "_" + str(cf));
+	cf_labels = {};
+	for node in sclades:
+		if results['decisive'][node]:
+			cf = round(results['counts'][node] / results['decisive'][node], 2);
 		else:
-			stree = stree.replace(node, node+ "_" + str(cf));
-
-	if stree[-1] == "_":
-		stree = stree[:-1];
+			cf = "NA";
+		print(node, cf);
+		cf_labels[node] = "_" + str(cf);
+	stree = tp.addBranchLength(stree, sinfo, node_labels=cf_labels);
 
 	print("\n----Concordance factor tree----");
 	print(stree);
 	print()
 
+	unreadable = gene_trees.skipped + [ str(num) for num in results['unreadable'] ];
+	unreadable.sort(key=int);
 	print("-----");
-	print(str(num_lines) + " total lines in gene tree file.");
-	if tre_skip != []:
-		print("The following " + str(len(tre_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(tre_skip));
-	if sc_skip != []:
-		print("The following " + str(len(sc_skip)) + " lines were skipped because they didn't have the same number of nodes as the species tree: " + ",".join(sc_skip));
-	print(str(total_trees) + " trees read.");
+	print(str(gene_trees.num_lines) + " total lines in gene tree file.");
+	if unreadable != []:
+		print("The following " + str(len(unreadable)) + " lines couldn't be read as trees and were skipped: " + ",".join(unreadable));
+	if results['skipped'] != []:
+		print("The following " + str(len(results['skipped'])) + " lines were skipped because they had tips that aren't in the species tree: " + ",".join([ str(num) for num in results['skipped'] ]));
+	print(str(float(results['num_trees'])) + " trees read.");
 	print("=======================================================================");
 
 #############################################################################
@@ -422,23 +301,16 @@ def flightOfTheConcordance(infiles, tree_flag, genefilename, count_tops):
 def countTips(infile):
 # This function counts all unique tip labels given a set of trees.
 
-	num_lines, num_trees, tre_skip = 0, 0, [];
-
 	tips = defaultdict(int);
 
-	for line in open(infile):
-		num_lines += 1;
-		try:
-			td, tree, root = tp.treeParse(line);
-		except:
-			tre_skip.append(str(num_lines));
+	trees = treec.TreeCollection(infile);
+	for tree_line in trees:
+		if tree_line.error:
 			continue;
-		num_trees += 1;
 		# Check if each line in the genetrees file is a Newick string.
 
-		for node in td:
-			if td[node][2] == 'tip':
-				tips[node] += 1;
+		for tip in tree_line.tree.tips:
+			tips[tip] += 1;
 		# Iterate the dictionary for each tip in the current tree.
 
 	maxlen = 0;
@@ -454,10 +326,10 @@ def countTips(infile):
 		print(core.spacedOut(tip, pad), tips[tip]);
 	# Print the tip labels and counts.
 	print("\n-----");
-	print(str(num_lines) + " total lines in input file.");
-	if tre_skip != []:
-		print("The following " + str(len(tre_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(tre_skip));
-	print(str(num_trees) + " trees read.");
+	print(str(trees.num_lines) + " total lines in input file.");
+	if trees.skipped != []:
+		print("The following " + str(len(trees.skipped)) + " lines couldn't be read as trees and were skipped: " + ",".join(trees.skipped));
+	print(str(trees.num_trees) + " trees read.");
 	print("=======================================================================");
 
 #############################################################################
@@ -465,44 +337,44 @@ def countTips(infile):
 def countClade(infile, clade):
 # This function counts all unique tip labels given a set of trees.
 
-	num_lines, num_trees, tre_skip, clade_count = 0, 0, [], 0;
+	clade_count = 0;
 
-	for line in open(infile):
-		num_lines += 1;
-		try:
-			td, tree, root = tp.treeParse(line);
-		except:
-			tre_skip.append(str(num_lines));
+	trees = treec.TreeCollection(infile);
+	for tree_line in trees:
+		if tree_line.error:
 			continue;
-		num_trees += 1;
 		# Check if each line in the genetrees file is a Newick string.
 
-		for node in td:
-			if td[node][2] != 'tip':
-				cur_clade = set(tp.getClade(node, td));
-				if cur_clade == clade:
-					clade_count += 1;
-		# Iterate the dictionary for the clade in the current tree.
+		bipartitions = tree_line.tree.indexBipartitions();
+		node = bipartitions.findClade(clade);
+		if node and tree_line.tree.type[node] != 'tip':
+			clade_count += 1;
+		# Look up the clade in the current tree by its bitmask.
 
 	print("\n" + core.getTime() + " Done!");
 	print("\n----Clade counts----");
 	print("# of trees with clade:\t", clade_count);
 	# Print the # of trees containing the clade.
 	print("\n-----");
-	print(str(num_lines) + " total lines in input file.");
-	if tre_skip != []:
-		print("The following " + str(len(tre_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(tre_skip));
-	print(str(num_trees) + " trees read.");
+	print(str(trees.num_lines) + " total lines in input file.");
+	if trees.skipped != []:
+		print("The following " + str(len(trees.skipped)) + " lines couldn't be read as trees and were skipped: " + ",".join(trees.skipped));
+	print(str(trees.num_trees) + " trees read.");
 	print("=======================================================================");
 
 #############################################################################
-def relabelTips(infile, labels, mode, delim, output):
+def relabelTips(infile, labels, mode, delim, output, exact=False, procs=1):
 # This function takes a file with many trees and searches the tip labels to match
-# strings for replacements.
+# strings for replacements. The labels are compiled once into a treec.TipRelabeler and each tree
+# is relabeled in one pass, with chunks of trees split between processes.
 	try:
-		labels = {l.split(",")[0] : l.split(",")[1] for l in labels.split(" ")};
+		if os.path.isfile(labels):
+			label_pairs = [ line.strip().replace("\t", ",").split(",") for line in open(labels) if line.strip() ];
+		else:
+			label_pairs = [ l.split(",") for l in labels.split(" ") ];
+		labels = { l[0] : l[1] for l in label_pairs };
 	except:
-		sys.exit(core.errorOut(29, "-labels was not input correctly! Format 'oldlabel1,newlabel1 oldlabel2,newlabel2'"));
+		sys.exit(core.errorOut(29, "-labels was not input correctly! Format 'oldlabel1,newlabel1 oldlabel2,newlabel2' or a file with one 'oldlabel,newlabel' per line"));
 	# Check to make sure the labels were input properly by the user.
 
 	if delim == 'space':
@@ -510,221 +382,573 @@ def relabelTips(infile, labels, mode, delim, output):
 
 	pad = 20;
 	print("\n---------Relabeling tips---------");
-	print(core.spacedOut("Old label contains", pad), "| New label");
+	print(core.spacedOut("Old label " + ("is" if exact else "contains"), pad), "| New label");
 	print("---------------------------------");
-	for old in labels:
+	for old in list(labels)[:25]:
 		print(core.spacedOut(old, pad), "| " + labels[old]);
+	if len(labels) > 25:
+		print("... and " + str(len(labels) - 25) + " more.");
 	# Some nice printing of the labels.
 
-	num_lines, num_trees, tre_skip = 0, 0, [];
-	with open(output, "w") as outfile:
-		for line in open(infile):
-			line = line.strip();
-			num_lines += 1;
-			try:
-				td, tree, root = tp.treeParse(line);
-			except:
-				tre_skip.append(str(num_lines));
-				continue;
-			num_trees += 1;
-			# Check if each line in the genetrees file is a Newick string.
-
-			for node in td:
-				for old in labels:
-					if old in node:
-						if mode == 1:
-							line = line.replace(node, labels[old]);
-						if mode == 2:
-							line = line.replace(node, labels[old] + delim + node);
-						if mode == 3:
-							line = line.replace(node, node + delim + labels[old]);
-			# Check and relabel every tip in the current tree.
-			# mode == 1 : replace old label with new label
-			# mode == 2 : put new label on beginning of old label
-			# mode == 3 : put new label at end of old label
-
-			outfile.write(line + "\n");
-			# For each node in the tree, check if it contains the text of one of the labels to replace.
-			# If so, replace it.
+	chunk_size = 1000;
+	trees = treec.TreeCollection(infile, parser=False);
+	tree_chunks = treec.chunkTreeLines(trees, chunk_size, skip_errors=False);
+	num_trees, num_tips, line_skip = 0, 0, [];
+
+	with open(output, "w", buffering=1048576) as outfile:
+		relabeler = treec.TipRelabeler(labels, mode, delim, exact);
+		results = treec.mapChunks(treec.relabelTreeLines, tree_chunks, procs, relabeler);
+		# Relabel each chunk of trees, in order. The labels are compiled once and each process gets a copy that keeps
+		# the new tip labels it finds for all its chunks.
+		# mode == 1 : replace old label with new label
+		# mode == 2 : put new label on beginning of old label
+		# mode == 3 : put new label at end of old label
+
+		for result in results:
+			for num, status, out_line, num_relabeled in result:
+				if status == "relabeled":
+					num_trees += 1;
+					num_tips += num_relabeled;
+					outfile.write(out_line + "\n");
+				else:
+					line_skip.append(str(num));
+		# Write the relabeled trees, skipping lines that aren't trees.
 
 	print("---------------------------------");
 	print("\n" + core.getTime() + " Done!");
-	print(str(num_lines) + " total lines in input file.");
-	if tre_skip != []:
-		print("The following " + str(len(tre_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(tre_skip));
+	print(str(trees.num_lines) + " total lines in input file.");
+	if line_skip != []:
+		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
 	print(str(num_trees) + " trees read.");
+	print(str(num_tips) + " tips relabeled.");
 	print("=======================================================================");
 
 #############################################################################
 
 def rmLabel(infile, mode, outfilename, best_flag=False):
 # Takes a file with many trees and removes internal node labels and/or branch lengths (depending on mode).
-	num_lines, num_trees, tre_skip, parse_skip = 0,0,[],[];
-	with open(outfilename, "w") as treefile:
-		for line in open(infile):
-			num_lines +=1;
-			line = line.strip();
-			if best_flag:
-				title, line = line.split("\t");
-			try:
-				td, out_tree, r = tp.treeParse(line);
-			except:
-				if infile not in parse_skip:
-					parse_skip.append(infile);
-				continue;
-			num_trees += 1;
-			# Check if each line in the genetrees file is a Newick string.
+# Each line is rewritten as bytes with treec.rewriteTreeFile without reading the trees, and either file can be gzipped.
+	labels = mode == 2;
+	bl = mode == 1;
+	# mode == 1 : remove internal node labels only
+	# mode == 2 : remove branch lengths only
+	# mode == 3 : remove both internal node labels and branch lengths
 
-			if mode == 1:
-				out_tree = re.sub('\)[\d\w]+:', '):', line);
-			if mode == 2:
-				out_tree = re.sub(':[\d.eE-]+', '', line);
-			if mode == 3:
-				out_tree = re.sub('<[\d]+>', '', out_tree);
-			# mode == 1 : remove internal node labels only
-			# mode == 2 : remove branch lengths only
-			# mode == 3 : remove both internal node labels and branch lengths
-
-			if best_flag:
-				treefile.write(title + "\t" + out_tree + "\n");
-			else:
-				treefile.write(out_tree + "\n");
-			# Write the edited tre to the output file.
+	num_lines, num_trees, line_skip = treec.rewriteTreeFile(infile, outfilename, labels=labels, bl=bl, tids=best_flag);
+	# Tree ids in front of the trees (e.g. in best-trees.txt files) are only kept with best_flag.
 
 	print("\n-----");
 	print("\n" + core.getTime() + " Done!");
 	print(str(num_lines) + " total lines in input file.");
-	if tre_skip != []:
-		print("The following " + str(len(tre_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(tre_skip));
+	if line_skip != []:
+		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
 	print(str(num_trees) + " trees read.");
 	print("=======================================================================");
 
 #############################################################################
 
-def scaleBL(infile, op, factor, outfilename):
-# Takes a file with many trees and removes internal node labels and/or branch lengths (depending on mode).
-	num_lines, num_trees, tre_skip, parse_skip = 0,0,[],[];
-	with open(outfilename, "w") as treefile:
-		for line in open(infile):
-			num_lines +=1;
-			line = line.strip();
-			try:
-				td, out_tree, r = tp.treeParse(line);
-			except:
-				if infile not in parse_skip:
-					parse_skip.append(infile);
-				continue;
-			num_trees += 1;
-			# Check if each line in the genetrees file is a Newick string.
-
-			for node in td:
-				if node == r:
-					continue;
-				old_bl = float(td[node][0]);
-				if op == "/":
-					new_bl = old_bl / factor;
-				elif op == "*":
-					new_bl = old_bl * factor;
-				elif op == "+":
-					new_bl = old_bl + factor;
-				elif op == "-":
-					new_bl = old_bl - factor;
-				td[node][0] = str(new_bl);
-
-			out_tree = tp.addBranchLength(out_tree, td);
-			treefile.write(out_tree + "\n");
-			# Write the edited tre to the output file.
+def scaleBL(infile, op, factor, outfilename, digits=False, min_bl=False):
+# Takes a file with many trees and scales the branch lengths by an operation and factor, then optionally rounds them
+# to a number of digits and sets a minimum length. Each line is rewritten as bytes with treec.rewriteTreeFile without
+# reading the trees, and either file can be gzipped.
+	transform = treec.blTransform(op, factor, digits, min_bl);
+	num_lines, num_trees, line_skip = treec.rewriteTreeFile(infile, outfilename, bl=transform);
 
 	print("\n-----");
 	print("\n" + core.getTime() + " Done!");
 	print(str(num_lines) + " total lines in input file.");
-	if tre_skip != []:
-		print("The following " + str(len(tre_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(tre_skip));
+	if line_skip != []:
+		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
 	print(str(num_trees) + " trees read.");
 	print("=======================================================================");
 
 #############################################################################
 
-def robF(infiles, tree_flag, genefilename, raxpath, outfile):
-# This function calls RAxML to calculate Robinson-Foulds distances for each gene tree to the species tree.
-	import re
-	raxlog = os.path.splitext(outfile)[0] + ".raxlog";
-
+def robF(infiles, tree_flag, genefilename, outfile, cache=False):
+# This function calculates Robinson-Foulds distances for each gene tree to the species tree from the splits in each tree.
+# With cache, the gene trees are read from a binary cache of the gene tree file instead of being parsed.
 	if tree_flag:
-		sinfo, stree, sroot, sfilename = infiles;
+		stree_str = infiles[3];
 	else:
-		try:
-			sinfo, stree, sroot = tp.treeParse(open(infiles[0], "r").read());
-		except:
-			sys.exit(core.errorOut(30, "Could not read species tree (-s) as a Newick tree!"));
-		# If the input species tree was a file check to make sure it contains a valid Newick tree.	
+		stree_str = open(infiles[0], "r").read().strip();
 
-	stips = [node for node in sinfo if sinfo[node][1] == 'tip'];
-	# Get the tips in the species tree.
+	if cache:
+		gene_trees = treec.treeCache(genefilename);
+		taxa = gene_trees.taxa;
+	else:
+		gene_trees = treec.TreeCollection(genefilename);
+		taxa = gene_trees.taxa;
+	# The species tree shares the taxon table of the gene trees
+
+	try:
+		stree = treec.Tree(stree_str, taxa=taxa);
+	except:
+		sys.exit(core.errorOut(30, "Could not read species tree (-s) as a Newick tree!"));
+	# Check to make sure the species tree is a valid Newick tree.
 
-	stree = re.sub("<[\d]+>", "", stree);
-	# Remove node labels from species tree.
+	stips = set(stree.tips);
+	ssplits = treec.getSplits(stree, taxa);
+	# Get the tips and splits in the species tree.
 
-	num_lines, tre_skip, sc_skip, raxfail = 0, [], [], [];
-	rfs, wrfs = [], [];
-	total_trees = 0.0;
-	tmpfile = "tmp74ghr2.tmp";
-	rfoutfile = "RAxML_RF-Distances.RFtmp7f";
+	sc_skip = [];
+	rfs, norm_rfs, wrfs = [], [], [];
+	total_trees = 0;
 
 	with open(outfile, "w") as out:
-		for line in open(genefilename):
-			num_lines += 1;
-			try:
-				ginfo, gtree, groot = tp.treeParse(line);
-			except:
+		for tree_line in gene_trees:
+			if tree_line.error:
 				out.write("Couldn't read as Newick string -- Skipping.\n");
-				tre_skip.append(str(num_lines));
 				continue;
+			gtree = tree_line.tree;
 			# Check if each line in the genetrees file is a Newick string.
 
-			gtips = [node for node in ginfo if ginfo[node][1] == 'tip'];
-			if set(gtips) != set(stips) or len(gtips) != len(stips):
+			if set(gtree.tips) != stips or len(gtree.tips) != len(stips):
 				out.write("Tip labels not identical to species tree -- Skipping.\n");
-				sc_skip.append(str(num_lines));
+				sc_skip.append(str(tree_line.num));
 				continue;
 			# Check to make sure the tips are identical in the current gene tree and the species tree.
 
-			gtree = re.sub("<[\d]+>", "", gtree);
-			# Remove node labels from gene tree.
+			cur_rf, cur_norm_rf, cur_wrf = treec.rfDist(ssplits, treec.getSplits(gtree, taxa), len(stips));
+			rfs.append(cur_rf);
+			norm_rfs.append(cur_norm_rf);
+			wrfs.append(cur_wrf);
+			out.write(str(cur_rf) + " " + str(round(cur_norm_rf, 6)) + " " + str(round(cur_wrf, 6)) + "\n");
+			total_trees += 1;
+			# Write the RF, normalized RF, and weighted RF distances for the current gene tree.
 
-			with open(tmpfile, "w") as tfile:
-				tfile.write(stree + ";\n");
-				tfile.write(gtree + ";");
+	print("-----");
+	if rfs != []:
+		print("Average RF distance for all gene trees:", float(sum(rfs)) / float(len(rfs)));
+		print("Average normalized RF distance for all gene trees:", round(float(sum(norm_rfs)) / float(len(norm_rfs)),3));
+		print("Average weighted RF distance for all gene trees:", round(float(sum(wrfs)) / float(len(wrfs)),3));
+		print("-----");
+	print(str(gene_trees.num_lines) + " total lines in gene tree file.");
+	if gene_trees.skipped != []:
+		print("The following " + str(len(gene_trees.skipped)) + " lines couldn't be read as trees and were skipped: " + ",".join(gene_trees.skipped));
+	if sc_skip != []:
+		print("The following " + str(len(sc_skip)) + " lines were skipped because they didn't have the same tips as the species tree: " + ",".join(sc_skip));
+	print(str(total_trees) + " trees successfully read and calculated RF distances.");
+	print("=======================================================================");
 
-			raxcall = raxpath + " -m PROTGAMMAJTTF -z " + tmpfile + " -f r -n RFtmp7f >> " + raxlog;
-			#print num_lines, raxcall;
-			os.system(raxcall);
+#############################################################################
 
-			if os.path.exists(rfoutfile):
-				curout = open(rfoutfile, "r").read().strip().split(" ");
-				cur_rf, cur_wrf = curout[2], curout[3];
-				rfs.append(float(cur_rf));
-				wrfs.append(float(cur_wrf));
-				out.write(cur_rf + " " + cur_wrf + "\n");
-			else:
-				out.write("RAxML failed -- Skipping.\n");
-				raxfail.append(str(num_lines));
+def rfMatrix(infile, outfile, procs=1, cache=False):
+# This function calculates Robinson-Foulds distances between all pairs of trees in a file. All trees must have the same tips.
+# With cache, the trees are read from a binary cache of the file instead of being parsed.
+	tree_ids, split_list = [], [];
+	tips = False;
+
+	if cache:
+		trees = treec.treeCache(infile);
+	else:
+		trees = treec.TreeCollection(infile);
+	for tree_line in trees:
+		if tree_line.error:
+			continue;
+		# Check if each line in the file is a Newick string.
+
+		cur_tips = set(tree_line.tree.tips);
+		if not tips:
+			tips = cur_tips;
+		elif cur_tips != tips:
+			sys.exit(core.errorOut(34, "Tree on line " + str(tree_line.num) + " doesn't have the same tips as the first tree! All trees must have the same tips for --rfmatrix."));
+		# Check that all trees have the same tips.
+
+		tree_ids.append(tree_line.tid if tree_line.tid else str(tree_line.num));
+		split_list.append(treec.getSplits(tree_line.tree, trees.taxa));
+
+	print(core.getTime() + " Calculating distances between " + str(len(split_list)) + " trees using " + str(procs) + " processes.");
+	matrix = treec.rfMatrix(split_list, len(tips) if tips else 0, procs);
+
+	with open(outfile, "w") as out:
+		out.write("tree1\ttree2\trf\tnorm.rf\twrf\n");
+		for i in range(len(tree_ids)):
+			for j in range(i+1, len(tree_ids)):
+				rf, norm_rf, wrf = matrix[i][j];
+				out.write("\t".join([tree_ids[i], tree_ids[j], str(rf), str(round(norm_rf, 6)), str(round(wrf, 6))]) + "\n");
+	# Write out each pair of trees once, identified by tree id or line number.
+
+	print("\n" + core.getTime() + " Done!");
+	print(str(trees.num_lines) + " total lines in input file.");
+	if trees.skipped != []:
+		print("The following " + str(len(trees.skipped)) + " lines couldn't be read as trees and were skipped: " + ",".join(trees.skipped));
+	print(str(trees.num_trees) + " trees read.");
+	print("=======================================================================");
+#############################################################################
+
+def siteCF(infiles, tree_flag, aln_path, num_quartets, seed, procs=1, seq_type="dna"):
+# This function calculates site concordance factors for each node in a species tree given an alignment
+# or a directory of locus alignments.
+	if tree_flag:
+		stree_str = infiles[3];
+	else:
+		stree_str = open(infiles[0], "r").read().strip();
 
-			os.system("rm " + rfoutfile);
-			os.system("rm RAxML_info.RFtmp7f");
-			total_trees += 1.0;
+	try:
+		stree = treec.Tree(stree_str);
+	except:
+		sys.exit(core.errorOut(38, "Could not read species tree (-i) as a Newick tree!"));
+	# Check to make sure the species tree is a valid Newick tree.
 
+	if os.path.isdir(aln_path):
+		aln_files = [ os.path.join(aln_path, f) for f in sorted(os.listdir(aln_path)) if not f.startswith(".") ];
+	else:
+		aln_files = [aln_path];
+	# Get the alignment file for each locus.
+
+	print(core.getTime() + " Sampling up to " + str(num_quartets) + " quartets per branch and scoring sites in " + str(len(aln_files)) + " alignment(s) using " + str(procs) + " processes.");
+	try:
+		scf = treec.siteConcordance(stree, aln_files, num_quartets, seed, procs, seq_type);
+	except ValueError as e:
+		sys.exit(core.errorOut(39, str(e)));
+
+	print("\n" + core.getTime() + " Done!");
+
+	print("\n----Site concordance factor nodes----");
+	print("node\tsCF\tsDF1\tsDF2\tsCF_N\tsDF1_N\tsDF2_N\tsN\tquartets");
+	scf_labels = {};
+	for node in stree.internals:
+		if node not in scf:
+			continue;
+		cur_scf = scf[node];
+		outline = [node];
+		for key in ['scf', 'sdf1', 'sdf2', 'scf_n', 'sdf1_n', 'sdf2_n', 'sn']:
+			outline.append(str(round(cur_scf[key], 2)) if cur_scf[key] != "NA" else "NA");
+		outline.append(str(cur_scf['num_quartets']));
+		print("\t".join(outline));
+		scf_labels[node] = "_" + outline[1];
+
+	print("\n----Site concordance factor tree----");
+	print(stree.addLabel(scf_labels));
+	print();
+	print("=======================================================================");
+
+#############################################################################
+
+def quartetCF(infiles, tree_flag, genefilename, procs=1):
+# This function calculates quartet concordance factors (qCF) for each branch of a species tree from a file of gene trees,
+# which can be missing species and have polytomies. For each branch, the quartets of gene tree tips around it are counted by
+# the topology the gene tree gives them, splitting chunks of gene trees between processes.
+	if tree_flag:
+		stree_str = infiles[3];
+	else:
+		stree_str = open(infiles[0], "r").read().strip();
+
+	try:
+		stree = treec.Tree(stree_str);
+	except:
+		sys.exit(core.errorOut(62, "Could not read species tree (-i) as a Newick tree!"));
+	# Check to make sure the species tree is a valid Newick tree.
+
+	taxa = treec.TaxonTable(sorted(stree.tips));
+	qnodes, groups = treec.quartetGroups(stree, taxa);
+	# Give every species tree tip an id up front so the groups are the same in every process.
+
+	chunk_size = 1000;
+	gene_trees = treec.TreeCollection(genefilename, parser=False);
+	tree_chunks = treec.chunkTreeLines(gene_trees, chunk_size);
+	results = { 'counts' : 0, 'unreadable' : [], 'num_trees' : 0 };
+	for result in treec.mapChunks(treec.countQuartetConcordance, tree_chunks, procs, groups, taxa):
+		results = treec.combineQuartetConcordance(results, result);
+	# Count the quartets around each species tree branch in every gene tree, in chunks of gene trees split between processes.
+
+	print("\n" + core.getTime() + " Done!");
+
+	print("\n----Quartet concordance factor nodes----");
+	print("node\tqCF\tqDF1\tqDF2\tqCF_N\tqDF1_N\tqDF2_N\tqN");
+	qcf_labels = {};
+	for i, node in enumerate(qnodes):
+		counts = [ int(count) for count in results['counts'][i] ] if results['num_trees'] else [0, 0, 0];
+		num_quartets = sum(counts);
+		outline = [node];
+		outline += [ str(round(count / num_quartets, 2)) if num_quartets else "NA" for count in counts ];
+		outline += [ str(count) for count in counts ] + [str(num_quartets)];
+		print("\t".join(outline));
+		qcf_labels[node] = "_" + outline[1];
+	# The fraction of resolved gene tree quartets with each topology, and the number of quartets.
+
+	print("\n----Quartet concordance factor tree----");
+	print(stree.addLabel(qcf_labels));
+	print();
+
+	unreadable = gene_trees.skipped + [ str(num) for num in results['unreadable'] ];
+	unreadable.sort(key=int);
 	print("-----");
-	print("Average RF distance for all gene trees:", float(sum(rfs)) / float(len(rfs)));
-	print("Average weighted RF distance for all gene trees:", round(float(sum(wrfs)) / float(len(wrfs)),3));
-	os.system("rm " + tmpfile);
+	print(str(gene_trees.num_lines) + " total lines in gene tree file.");
+	if unreadable != []:
+		print("The following " + str(len(unreadable)) + " lines couldn't be read as trees and were skipped: " + ",".join(unreadable));
+	print(str(results['num_trees']) + " trees read.");
+	print("=======================================================================");
+
+#############################################################################
+
+def pruneTrees(infile, keep_tips, outfilename, procs=1):
+# This function prunes every tree in a file down to a set of tips, splitting chunks of trees between processes.
+	chunk_size = 1000;
+	trees = treec.TreeCollection(infile, parser=False);
+	tree_chunks = treec.chunkTreeLines(trees, chunk_size, skip_errors=False);
+	num_trees, too_few, line_skip = 0,[],[];
+
+	with open(outfilename, "w", buffering=1048576) as treefile:
+		results = treec.mapChunks(treec.pruneTreeLines, tree_chunks, procs, keep_tips);
+		# Prune each chunk of trees, in order.
+
+		for result in results:
+			for num, status, out_line in result:
+				if status == "pruned":
+					num_trees += 1;
+				elif status == "too few":
+					too_few.append(str(num));
+					continue;
+				else:
+					line_skip.append(str(num));
+				treefile.write(out_line + "\n");
+		# Write the pruned trees and notes for the lines that were skipped.
+
+	print("\n" + core.getTime() + " Done!");
 	print("-----");
-	print(str(num_lines) + " total lines in gene tree file.");
-	if tre_skip != []:
-		print("The following " + str(len(tre_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(tre_skip));
-	if sc_skip != []:
-		print("The following " + str(len(sc_skip)) + " lines were skipped because they didn't have the same number of nodes as the species tree: " + ",".join(sc_skip));
-	if sc_skip != []:
-		print("The following " + str(len(sc_skip)) + " lines were skipped because they didn't have the same number of nodes as the species tree: " + ",".join(sc_skip));
-	print(str(total_trees) + " trees successfully read and calculated RF distances.");
-	print("=======================================================================");
\ No newline at end of file
+	print(str(trees.num_lines) + " total lines.");
+	if line_skip != []:
+		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
+	if too_few != []:
+		print("The following " + str(len(too_few)) + " lines had fewer than 2 of the given tips and were skipped: " + ",".join(too_few));
+	print(str(num_trees) + " trees pruned.");
+	print("=======================================================================");
+
+#############################################################################
+
+def mapTrees(infiles, tree_flag, genefilename, exact, outfilename, procs=1):
+# This function maps the internal nodes of every gene tree in a file onto the species tree, splitting chunks of trees
+# between processes. Each gene tree is written with its internal nodes labeled by the species tree nodes they map to.
+	if tree_flag:
+		stree_str = infiles[3];
+	else:
+		stree_str = open(infiles[0], "r").read().strip();
+
+	try:
+		stree = treec.Tree(stree_str);
+	except:
+		sys.exit(core.errorOut(48, "Could not read species tree (-i) as a Newick tree!"));
+	# Check to make sure the species tree is a valid Newick tree.
+
+	print("\n----Labeled species tree----");
+	print(stree.tree_str + ";");
+	# The species tree with the node names used in the output
+
+	chunk_size = 1000;
+	trees = treec.TreeCollection(genefilename, parser=False);
+	tree_chunks = treec.chunkTreeLines(trees, chunk_size, skip_errors=False);
+	num_trees, num_nodes, line_skip = 0, 0, [];
+
+	with open(outfilename, "w", buffering=1048576) as treefile:
+		results = treec.mapChunks(treec.mapTreeLines, tree_chunks, procs, stree, exact, {});
+		# Map each chunk of trees, in order. Each process keeps its own copy of the mask cache for all its chunks.
+
+		for result in results:
+			for num, status, out_line, num_mapped in result:
+				if status == "mapped":
+					num_trees += 1;
+					num_nodes += num_mapped;
+				else:
+					line_skip.append(str(num));
+				treefile.write(out_line + "\n");
+		# Write the mapped trees and notes for the lines that were skipped.
+
+	print("\n" + core.getTime() + " Done!");
+	print("-----");
+	print(str(trees.num_lines) + " total lines in gene tree file.");
+	if line_skip != []:
+		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
+	print(str(num_trees) + " trees mapped.");
+	print(str(num_nodes) + " gene tree nodes mapped to the species tree.");
+	print("=======================================================================");
+
+#############################################################################
+
+def consensus(infile, mode, threshold, outfilename, procs=1):
+# This function builds a consensus tree from a file of trees with the same tips (e.g. bootstrap replicates or gene trees) by
+# counting the splits in every tree, splitting chunks of trees between processes. Support values are written as node labels.
+	first_tree = False;
+	for tree_line in treec.TreeCollection(infile):
+		if not tree_line.error:
+			first_tree = tree_line.tree;
+			break;
+	if not first_tree:
+		sys.exit(core.errorOut(53, "No trees could be read from the input file!"));
+
+	taxa = treec.TaxonTable(sorted(first_tree.tips));
+	all_tips = first_tree.indexBipartitions(taxa).all_tips;
+	# Give every tip an id up front from the first tree so the split masks are the same in every process.
+
+	chunk_size = 1000;
+	trees = treec.TreeCollection(infile, parser=False);
+	tree_chunks = treec.chunkTreeLines(trees, chunk_size);
+	results = { 'splits' : {}, 'unreadable' : [], 'skipped' : [], 'num_trees' : 0, 'has_bl' : False };
+	for result in treec.mapChunks(treec.countSplits, tree_chunks, procs, taxa, all_tips):
+		results = treec.combineSplitCounts(results, result);
+	# Count the splits in every tree, in chunks of trees split between processes.
+
+	kept = treec.consensusSplits(results['splits'], results['num_trees'], all_tips, mode, threshold);
+	con_tree = treec.consensusTree(results['splits'], results['num_trees'], taxa, all_tips, kept, results['has_bl']);
+	with open(outfilename, "w") as outfile:
+		outfile.write(con_tree + "\n");
+
+	print("\n" + core.getTime() + " Done!");
+	print("-----");
+	print(str(trees.num_lines) + " total lines.");
+	line_skip = trees.skipped + [ str(num) for num in results['unreadable'] ];
+	if line_skip != []:
+		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
+	if results['skipped'] != []:
+		print("The following " + str(len(results['skipped'])) + " lines didn't have the same tips as the first tree and were skipped: " + ",".join(str(num) for num in results['skipped']));
+	print(str(results['num_trees']) + " trees read.");
+	print(str(len(kept)) + " of " + str(max(len(first_tree.tips) - 3, 0)) + " possible internal branches in the " + mode + " consensus tree.");
+	print("\n----Consensus tree----");
+	print(con_tree);
+	print("=======================================================================");
+
+#############################################################################
+
+def supportTree(infiles, tree_flag, bootfilename, transfer, outfilename, procs=1):
+# This function writes the support for each branch of a reference tree from a file of bootstrap trees with the same tips, as
+# either Felsenstein support (the proportion of bootstrap trees with the branch) or transfer support. Chunks of bootstrap
+# trees are split between processes and their counts added up at the end. Supports are written as node labels.
+	if tree_flag:
+		ref_str = infiles[3];
+	else:
+		ref_str = open(infiles[0], "r").read().strip();
+
+	try:
+		ref_tree = treec.Tree(ref_str);
+	except:
+		sys.exit(core.errorOut(57, "Could not read reference tree (-i) as a Newick tree!"));
+	# Check to make sure the reference tree is a valid Newick tree.
+
+	taxa = treec.TaxonTable(sorted(ref_tree.tips));
+	all_tips = ref_tree.indexBipartitions(taxa).all_tips;
+	ref_nodes, ref_splits = treec.refSplits(ref_tree, taxa);
+	# Give every tip an id up front from the reference tree so the split masks are the same in every process.
+
+	chunk_size = 1000;
+	trees = treec.TreeCollection(bootfilename, parser=False);
+	tree_chunks = treec.chunkTreeLines(trees, chunk_size);
+	results = { 'counts' : [0] * len(ref_splits), 'unreadable' : [], 'skipped' : [], 'num_trees' : 0 };
+	for result in treec.mapChunks(treec.countSupport, tree_chunks, procs, ref_splits, taxa, all_tips, transfer):
+		results = treec.combineSupport(results, result);
+	# Count the reference splits in every bootstrap tree, in chunks of trees split between processes.
+
+	support = treec.supportValues(results['counts'], results['num_trees'], ref_splits, len(ref_tree.tips), transfer);
+	support = { node : (round(value, 2) if value != "NA" else value) for node, value in zip(ref_nodes, support) };
+	sup_tree = ref_tree.writeNewick(label=lambda node : support.get(node));
+	with open(outfilename, "w") as outfile:
+		outfile.write(sup_tree + "\n");
+
+	print("\n" + core.getTime() + " Done!");
+	print("-----");
+	print(str(trees.num_lines) + " total lines in bootstrap tree file.");
+	line_skip = trees.skipped + [ str(num) for num in results['unreadable'] ];
+	if line_skip != []:
+		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
+	if results['skipped'] != []:
+		print("The following " + str(len(results['skipped'])) + " lines didn't have the same tips as the reference tree and were skipped: " + ",".join(str(num) for num in results['skipped']));
+	print(str(results['num_trees']) + " bootstrap trees read.");
+	print(str(len(ref_nodes)) + " internal branches in the reference tree.");
+	print("\n----" + ("Transfer" if transfer else "Felsenstein") + " support tree----");
+	print(sup_tree);
+	print("=======================================================================");
+
+#############################################################################
+
+def uniqueTopologies(infile, rooted, outfilename, procs=1):
+# This function groups the trees in a file by topology with treec.topologyHash, splitting chunks of trees between processes.
+# Only the hash, the count, the first tree and the line numbers are kept for each topology. Each unique topology is written
+# with the number of trees that have it and their line numbers, most common first.
+	chunk_size = 1000;
+	trees = treec.TreeCollection(infile, parser=False);
+	tree_chunks = treec.chunkTreeLines(trees, chunk_size);
+	results = { 'tops' : {}, 'unreadable' : [], 'num_trees' : 0 };
+	for result in treec.mapChunks(treec.countTopologies, tree_chunks, procs, rooted):
+		results = treec.combineTopologies(results, result);
+	# Hash the topology of every tree, in chunks of trees split between processes.
+
+	tops = sorted(results['tops'].items(), key=lambda top : top[1][0], reverse=True);
+	with open(outfilename, "w") as outfile:
+		outfile.write("topology\tcount\ttree\tlines\n");
+		for top, (top_count, top_tree, top_lines) in tops:
+			outfile.write("\t".join([top, str(top_count), top_tree, ",".join(str(num) for num in top_lines)]) + "\n");
+
+	print("\n" + core.getTime() + " Done!");
+	print("-----");
+	print(str(trees.num_lines) + " total lines in input file.");
+	line_skip = trees.skipped + [ str(num) for num in results['unreadable'] ];
+	if line_skip != []:
+		print("The following " + str(len(line_skip)) + " lines couldn't be read as trees and were skipped: " + ",".join(line_skip));
+	print(str(results['num_trees']) + " trees read.");
+	print(str(len(tops)) + " unique " + ("rooted" if rooted else "unrooted") + " topologies found.");
+	print("=======================================================================");
+
+#############################################################################
+
+def reconcile(infiles, tree_flag, genefilename, delim, field, outfilename, procs=1):
+# This function counts gene duplications and losses by reconciling every gene tree in a file with a rooted species tree by
+# LCA mapping (see treec.reconcileGeneTree). Gene tips are matched to species by splitting their labels on delim and taking
+# the field at the given position. Chunks of gene trees are split between processes. The number of duplications and losses
+# in each gene tree is written to the output file, and the totals at each species tree node are printed.
+	if tree_flag:
+		stree_str = infiles[3];
+	else:
+		stree_str = open(infiles[0], "r").read().strip();
+
+	try:
+		stree = treec.Tree(stree_str);
+	except:
+		sys.exit(core.errorOut(66, "Could not read species tree (-i) as a Newick tree!"));
+	if not stree.rooted:
+		sys.exit(core.errorOut(67, "The species tree (-i) must be rooted!"));
+	# Check to make sure the species tree is a valid, rooted Newick tree.
+
+	species_map = treec.SpeciesMap(stree, delim, field);
+	# The LCA table and other species tree tables, built once and sent to each process.
+
+	print("\n----Labeled species tree----");
+	print(stree.tree_str + ";");
+	# The species tree with the node names used in the output
+
+	chunk_size = 1000;
+	gene_trees = treec.TreeCollection(genefilename, parser=False);
+	tree_chunks = treec.chunkTreeLines(gene_trees, chunk_size);
+	results = { 'dups' : [0] * len(species_map.nodes), 'losses' : [0] * len(species_map.nodes), 'trees' : [],
+				'unreadable' : [], 'unmapped' : [], 'ignored' : set(), 'num_trees' : 0 };
+	for result in treec.mapChunks(treec.countReconciliation, tree_chunks, procs, species_map):
+		results = treec.combineReconciliation(results, result);
+	# Reconcile every gene tree, in chunks of gene trees split between processes.
+
+	with open(outfilename, "w") as outfile:
+		outfile.write("line\ttree\tduplications\tlosses\n");
+		for num, tid, num_dups, num_losses in results['trees']:
+			outfile.write("\t".join([str(num), tid if tid else "NA", str(num_dups), str(num_losses)]) + "\n");
+	# The counts for each gene tree, in the order of the gene tree file.
+
+	print("\n" + core.getTime() + " Done!");
+
+	print("\n----Duplications and losses by species tree node----");
+	print("node\tduplications\tlosses");
+	for node_id in range(len(species_map.nodes)):
+		print("\t".join([species_map.nodes[node_id], str(results['dups'][node_id]), str(results['losses'][node_id])]));
+	# Duplications are at each node, and losses are on the branch leading to it.
+	print();
+
+	unreadable = gene_trees.skipped + [ str(num) for num in results['unreadable'] ];
+	unreadable.sort(key=int);
+	print("-----");
+	print(str(gene_trees.num_lines) + " total lines in gene tree file.");
+	if unreadable != []:
+		print("The following " + str(len(unreadable)) + " lines couldn't be read as trees and were skipped: " + ",".join(unreadable));
+	if results['unmapped'] != []:
+		print("The following " + str(len(results['unmapped'])) + " lines had no tips from species in the species tree and were skipped: " + ",".join(str(num) for num in results['unmapped']));
+	if results['ignored']:
+		ignored = sorted(results['ignored']);
+		print(str(len(ignored)) + " gene tip labels didn't match a species tree tip and were ignored, e.g.: " + ",".join(ignored[:10]));
+	print(str(results['num_trees']) + " trees reconciled.");
+	print(str(sum(results['dups'])) + " total duplications and " + str(sum(results['losses'])) + " total losses.");
+	print("=======================================================================");
@@ -5,7 +5,7 @@
 # Spring 2013-present
 #############################################################################
 
-import sys, re
+import sys, re, treec
 
 #############################################################################
 def getBranchLength(bltree, spec_label):
@@ -51,18 +51,42 @@ def remNodeLabel(treestring):
 
 #############################################################################
 
-def addBranchLength(tree, treedict):
-# Re-writes the branch lengths onto a topology parsed by treeParse.
-	for node in treedict:
-		if treedict[node][2] == 'root':
-			continue;
-		if treedict[node][0] != "NA":
-			tree = tree.replace(node, node + ":" + treedict[node][0]);
-			if treedict[node][3] != "NA":
-				tree = tree.replace(node + ":" + treedict[node][0], node + "/" + treedict[node][3] + ":" + treedict[node][0]);
-		elif treedict[node][3] != "NA":
-			tree = tree.replace(node, node + "/" + treedict[node][3]);
-	return tree;
+def treeChildren(tree, treedict):
+# Returns a dict of each internal node in a tree dict from treeParse with its descendants in the order they
+# appear in the topology string. A node's name always comes after those of the nodes to its left.
+	order = {};
+	for token in treec.NEWICK_TOKENS.findall(tree):
+		if token not in "(),;":
+			order[token] = len(order);
+
+	children = {};
+	for node in sorted(treedict, key=lambda n : order.get(n, -1)):
+		if treedict[node][1] != "NA":
+			children.setdefault(treedict[node][1], []).append(node);
+	return children;
+
+#############################################################################
+
+def addBranchLength(tree, treedict, node_labels=False, float_format=False, handle=False):
+# Re-writes the branch lengths onto a topology parsed by treeParse, with the generated node names and
+# any labels from the original tree after them (<1>/label:bl). The tree is written with treec.writeNewick
+# from the tree dict, so no string replacement is done.
+# node_labels: dict of { node : text } to add directly after node names
+# float_format and handle: passed on to treec.writeNewick
+	children = treeChildren(tree, treedict);
+	root = [ node for node in treedict if treedict[node][2] == 'root' ][0];
+
+	def nodeName(node):
+		name = node;
+		if node_labels and node in node_labels:
+			name += str(node_labels[node]);
+		if node != root and treedict[node][3] not in ["NA", ""]:
+			name += "/" + treedict[node][3];
+		return name;
+
+	return treec.writeNewick(root, children.get, name=nodeName, label=nodeName,
+								bl=lambda node : treedict[node][0] if treedict[node][0] != "NA" else None,
+								float_format=float_format, handle=handle, end="");
 
 #############################################################################
 
@@ -81,54 +105,55 @@ def getDesc(d_spec, d_treedict):
 
 #############################################################################
 
-def getClade(c_spec, c_treedict):
+def descDict(treedict):
+# Returns a dict of the direct descendants of each internal node in the dictionary of a tree returned by
+# treeParse, in the same order as getDesc. This can be passed to getClade and getCladeNode to reuse it for
+# many nodes of the same tree.
+	desc = {};
+	for node in treedict:
+		if treedict[node][2] != 'root':
+			desc.setdefault(treedict[node][1], []).append(node);
+	return desc;
+
+#############################################################################
+
+def getClade(c_spec, c_treedict, desc=False):
 # This function takes a species in the current tree and the dictionary of the current tree
 # returned by treeparse and finds all tip labels that are descendants of the current node.
-# This is done by getting the direct descendants of the current node with getDesc and then
-# recursively calling itself on those descendants.
-	clade = [];
-	c_desc = getDesc(c_spec, c_treedict);
-	for d in c_desc:
-		if c_treedict[d][2] != 'tip':
-			clade.append(getClade(d, c_treedict));
-		else:
-			clade.append(d);
+# The tree is walked with a stack of nodes to visit instead of recursion.
+	if not desc:
+		desc = descDict(c_treedict);
 
-	r_clade = [];
-	for c in clade:
-		if type(c) == list:
-			for cc in c:
-				r_clade.append(cc);
+	clade = [];
+	stack = list(reversed(desc[c_spec])) if c_spec in desc else [c_spec];
+	while stack:
+		node = stack.pop();
+		if c_treedict[node][2] == 'tip' or node not in desc:
+			clade.append(node);
 		else:
-			r_clade.append(c);
-
-	return r_clade;
+			stack.extend(reversed(desc[node]));
+	return clade;
 
 #############################################################################
 
-def getCladeNode(c_spec, c_treedict):
+def getCladeNode(c_spec, c_treedict, desc=False):
 # This function takes a node in the current tree and the dictionary of the current tree
-# (returned by treeparse) and finds all tip labels that are descendants of the current node.
-# This is done by getting the direct descendants of the current node with getDesc and then
-# recursively calling itself on those descendants.
+# (returned by treeparse) and finds all nodes that are descendants of the current node,
+# with each internal node after its descendants. The tree is walked with a stack of nodes
+# to visit instead of recursion.
+	if not desc:
+		desc = descDict(c_treedict);
 
 	clade = [];
-	c_desc = getDesc(c_spec, c_treedict);
-	for d in c_desc:
-		if c_treedict[d][2] != 'tip':
-			clade.append(getCladeNode(d, c_treedict));
-			# Recursion
-		clade.append(d);
-
-	r_clade = [];
-	for c in clade:
-		if type(c) == list:
-			for cc in c:
-				r_clade.append(cc);
+	stack = [ (d, False) for d in reversed(desc[c_spec]) ] if c_spec in desc else [(c_spec, False)];
+	while stack:
+		node, closing = stack.pop();
+		if closing or c_treedict[node][2] == 'tip' or node not in desc:
+			clade.append(node);
 		else:
-			r_clade.append(c);
-
-	return r_clade;
+			stack.append((node, True));
+			stack.extend( (d, False) for d in reversed(desc[node]) );
+	return clade;
 
 #############################################################################
 
@@ -142,32 +167,32 @@ def pathToRoot(node, tree_dict):
 
 #############################################################################
 
-def LCA(spec_list, treedict):
-# Given a list of nodes, this function finds the least common ancestor of them,
-# and tells whether the nodes provided form a monophyletic clade.
+def lcaIndex(treedict):
+# Builds the Euler tour LCA index from treec for the dictionary of a tree returned by treeParse. This can
+# be passed to LCA() to reuse it for many queries on the same tree.
 
-	ancs = {};
-	for spec in spec_list:
-		ancs[spec] = [spec];
+	root = [ node for node in treedict if treedict[node][2] == 'root' ][0];
+	return treec.LCAIndex(root, descDict(treedict));
 
-	for spec in spec_list:
-		if treedict[spec][2] == 'root':
-			continue;
-		curanc = treedict[spec][1];
-		ancs[spec].append(curanc);
-		while treedict[curanc][2] != 'root':
-			curanc = treedict[curanc][1];
-			ancs[spec].append(curanc);
+#############################################################################
 
-	intersect_anc = set.intersection(*list(map(set, list(ancs.values()))))
-	lcp = [t for t in list(ancs.values())[0] if t in intersect_anc]
+def LCA(spec_list, treedict, lca_index=False):
+# Given a list of nodes, this function finds the least common ancestor of them,
+# and tells whether the nodes provided form a monophyletic clade.
+
+	if not lca_index:
+		lca_index = lcaIndex(treedict);
+	lca = lca_index.LCA(spec_list);
 
-	#lcp = sorted(set.intersection(*map(set, ancs.values())), key=lambda x: ancs.values()[0].index(x))
 	monophyletic = False;
-	if set(getClade(lcp[0],treedict)) == set(spec_list):
+	if all(treedict[spec][2] == 'tip' for spec in spec_list):
+		if lca_index.num_tips[lca] == len(set(spec_list)):
+			monophyletic = True;
+	# For tips, they are monophyletic if no other tips descend from their LCA
+	elif set(getClade(lca,treedict)) == set(spec_list):
 		monophyletic = True;
 
-	return lcp[0], monophyletic;
+	return lca, monophyletic;
 
 #############################################################################
 
@@ -205,48 +230,50 @@ def comAnc(spec_list, treedict):
 # Given a list of species within the tree and the dictionary returned by treeParse using that tree,
 # this function checks whether those species are monophyletic (ie they all share a common ancestor).
 # Similar to LCA
-
-	if len(spec_list) > 1:
-		if spec_list.count(spec_list[0]) == len(spec_list):
-			if treedict[spec_list[0]][2] == 'root':
+	while True:
+		if len(spec_list) > 1:
+			if spec_list.count(spec_list[0]) == len(spec_list):
+				if treedict[spec_list[0]][2] == 'root':
+					return 1, spec_list[0];
+				else:
+					return 1, treedict[spec_list[0]][1];
+			if treedict[spec_list[0]][1] == spec_list[1]:
+				return 1, spec_list[1];
+			if treedict[spec_list[1]][1] == spec_list[0]:
 				return 1, spec_list[0];
-			else:
-				return 1, treedict[spec_list[0]][1];
-		if treedict[spec_list[0]][1] == spec_list[1]:
-			return 1, spec_list[1];
-		if treedict[spec_list[1]][1] == spec_list[0]:
-			return 1, spec_list[0];
-
-	cur_list = [];
-	for b in spec_list:
-		if b in treedict:
-			cur_list.append(b);
-
-	ancdict = {};
-	for b in cur_list:
-		ancdict[b] = treedict[b][1];
-
-	new_list = [];
-	for b in ancdict:
-		if list(ancdict.values()).count(ancdict[b]) > 1 and ancdict[b] not in new_list:
-			new_list.append(ancdict[b]);
-		elif treedict[b][1] not in new_list:
-			new_list.append(b);
-
-	#print new_list;
-
-	if not all(n in cur_list for n in new_list):
-		flag, com_anc = comAnc(new_list, treedict);
-	elif len(new_list) > 1:
-		#print "not monophyletic";
-		flag = 0;
-		com_anc = "";
-	else:
-		#print "monophyletic";
-		flag = 1;
-		com_anc = new_list[0];
 
-	return flag, com_anc;
+		cur_list = [];
+		for b in spec_list:
+			if b in treedict:
+				cur_list.append(b);
+
+		ancdict = {};
+		for b in cur_list:
+			ancdict[b] = treedict[b][1];
+
+		new_list = [];
+		for b in ancdict:
+			if list(ancdict.values()).count(ancdict[b]) > 1 and ancdict[b] not in new_list:
+				new_list.append(ancdict[b]);
+			elif treedict[b][1] not in new_list:
+				new_list.append(b);
+
+		#print new_list;
+
+		if not all(n in cur_list for n in new_list):
+			spec_list = new_list;
+			continue;
+			# Repeat with the ancestors until no new ones are added, instead of recursing
+		elif len(new_list) > 1:
+			#print "not monophyletic";
+			flag = 0;
+			com_anc = "";
+		else:
+			#print "monophyletic";
+			flag = 1;
+			com_anc = new_list[0];
+
+		return flag, com_anc;
 
 #############################################################################
 
@@ -300,11 +327,10 @@ def nodeDist(query_node, target_node, treedict):
 
 	dist = float(treedict[query_node][0]);
 	ancnode = treedict[query_node][1];
-	#print query_node, '-', dist, '-', ancnode, '-', treedict[ancnode][0];
-	if ancnode == target_node:
-		return dist;
-	else:
-		dist += nodeDist(ancnode, target_node, treedict);
+	while ancnode != target_node:
+		dist += float(treedict[ancnode][0]);
+		ancnode = treedict[ancnode][1];
+	# Add up the branch lengths on the path up to the target node
 
 	return dist;
 
@@ -326,16 +352,26 @@ def rootedOrNot(treedict):
 #############################################################################
 
 def ultrametricOrNot(treedict, root):
-# Tells whether a tree is ultra-metric or not based on calls to nodeDist().
+# Tells whether a tree is ultra-metric or not: whether all tips are the same distance from the root when the
+# distances are rounded to 3 decimal places. Each node's distance to the root is stored when it is first found,
+# so every branch is added once instead of walking up to the root from every tip with nodeDist().
 
-	root_dists = [];
-	tips = [ n for n in treedict if treedict[n][2] == 'tip' ];
-	root_dists = [ round(nodeDist(node, root, treedict), 3) for node in tips ];
-	#print(root_dists);
-	if root_dists.count(root_dists[0]) == len(root_dists):
+	root_dists = { root : 0.0 };
+	for node in treedict:
+		path = [];
+		while node not in root_dists:
+			path.append(node);
+			node = treedict[node][1];
+		for n in reversed(path):
+			bl = treedict[n][0];
+			root_dists[n] = root_dists[treedict[n][1]] + (float(bl) if bl not in ("NA", "") else 0.0);
+	# Walk up from each node only until a node with a known distance is found
+
+	tip_dists = [ round(root_dists[node], 3) for node in treedict if treedict[node][2] == 'tip' ];
+	if tip_dists.count(tip_dists[0]) == len(tip_dists):
 		return True;
 	else:
-		return False;		
+		return False;
 
 #############################################################################
 
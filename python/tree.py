@@ -23,29 +23,54 @@ parser.add_argument("--rootcheck", dest="root_check", help="Given an input file
 parser.add_argument("--root", dest="root_tree", help="Given an input file or tree string, this will root the tree with the specified outgroup(s).", action="store_true");
 parser.add_argument("--rootbest", dest="root_tree_best", help="This option does the same thing as 'root' but on a 'best-trees.txt' file from wrappers.py --raxml. This file includes a column on each line with the source alignment file name.", action="store_true");
 parser.add_argument("--concordance", dest="fotc", help="Given an input ROOTED species tree and a file containing many single-copy ROOTED gene trees this module will calculate concordance factors for each node in the species tree. Use -genetrees for the input gene tree file and -i for the input species tree file or string.", action="store_true");
+parser.add_argument("--qcf", dest="qcf", help="Given an input species tree and a file containing many gene trees, this module will calculate quartet concordance factors for each branch of the species tree: the fraction of gene tree quartets around the branch that agree with it. Gene trees can be missing species and have polytomies. Use -genetrees for the input gene tree file and -i for the input species tree file or string.", action="store_true");
+parser.add_argument("--consensus", dest="consensus", help="Given a file with many trees that all have the same tips (e.g. bootstrap replicates or gene trees), this will build a consensus tree with the proportion of trees supporting each branch as node labels. Use -conmode to pick the type of consensus.", action="store_true");
+parser.add_argument("--support", dest="support", help="Given an input reference tree and a file of bootstrap trees with the same tips, this will label each internal branch of the reference tree with its bootstrap support. Use -boottrees for the bootstrap tree file, -i for the reference tree file or string, and --tbe for transfer support.", action="store_true");
+parser.add_argument("--uniquetops", dest="unique_tops", help="Given a file with many trees, this will find the unique topologies and write each one with the number of trees that have it and their line numbers. Trees are compared as unrooted unless --rooted is set.", action="store_true");
 parser.add_argument("--tipcount", dest="count_tips", help="Given a file with many trees, simply count the number of unique tip labels in all trees.", action="store_true");
 parser.add_argument("--cladecount", dest="count_clade", help="Given a file with many trees and a list of tips defined with -clade, count the number of trees in which those labels form a monophyletic clade.", action="store_true");
 parser.add_argument("--relabeltips", dest="relabel", help="Given a file with many trees and a set of labels defined by -labels, this will relabel tip nodes. Use -m to decide placement of new label, and -delim to enter delimiting character.", action="store_true");
-parser.add_argument("--rmlabels", dest="rmlabel", help="Given a file with many trees with the internal nodes labeled, this will write a file with the same trees but WITHOUT internal nodes labeled.", action="store_true");
+parser.add_argument("--rmlabels", dest="rmlabel", help="Given a file with many trees with the internal nodes labeled, this will write a file with the same trees but WITHOUT internal nodes labeled. The input and output files can be gzipped (output names ending in .gz).", action="store_true");
 parser.add_argument("--rmlabelsbest", dest="rmlabel_best", help="Given a best-trees.txt file from a --raxml run from wrappers, this will remove the bootstrap labels on the internal nodes.", action="store_true");
-parser.add_argument("--scale", dest="scale", help="Scale the branch lengths of the input tree(s) by an operation and value given. For example, enter '/2' to divide all branch lengths by 2, or '*5' to multiply all branch lengths by 5.", default=False);
-parser.add_argument("--rf", dest="rf", help="Given an input UNROOTED species tree and a file containing many single-copy UNROOTED gene trees this module will call RAxML to calculate Robinson-Foulds distance for each gene tree to the species tree. Use -genetrees for the input gene tree file and -i for the input species tree file or string.", action="store_true");
+parser.add_argument("--scale", dest="scale", help="Scale the branch lengths of the input tree(s) by an operation and value given. For example, enter '/2' to divide all branch lengths by 2, or '*5' to multiply all branch lengths by 5. Use -digits and -minbl to round them and set a minimum. A branch length on the root is left as it is. The input and output files can be gzipped (output names ending in .gz).", default=False);
+parser.add_argument("--scf", dest="scf", help="Given an input species tree and an alignment or a directory of locus alignments (FASTA) with -aln, this module will calculate site concordance factors for each node in the species tree.", action="store_true");
+parser.add_argument("--prune", dest="prune", help="Given a file with many trees and a set of tips defined with -taxa, this will prune every tree down to only those tips.", action="store_true");
+parser.add_argument("--rf", dest="rf", help="Given an input UNROOTED species tree and a file containing many single-copy UNROOTED gene trees this module will calculate Robinson-Foulds distance for each gene tree to the species tree. Use -genetrees for the input gene tree file and -i for the input species tree file or string.", action="store_true");
+parser.add_argument("--mapnodes", dest="map_nodes", help="Given an input species tree and a file containing many gene trees, this will map the internal nodes of each gene tree onto the species tree. Gene trees can be missing species. Use -genetrees for the input gene tree file and -i for the input species tree file or string.", action="store_true");
+parser.add_argument("--reconcile", dest="reconcile", help="Given an input ROOTED species tree and a file containing many ROOTED gene trees, this will reconcile each gene tree with the species tree by LCA mapping and count gene duplications and losses, in each gene tree and at each species tree node. Use -genetrees for the input gene tree file, -i for the input species tree file or string, and -delim and -spfield to get the species from the gene tip labels.", action="store_true");
+parser.add_argument("--rfmatrix", dest="rf_matrix", help="Given a file with many trees that all have the same tips, this will calculate Robinson-Foulds distances between all pairs of trees. Use -p to split the work between processes.", action="store_true");
 
 parser.add_argument("-prefix", dest="file_prefix", help="For --sep, a string that will be used as the base file name for each output file.", default=False);
 parser.add_argument("-outgroup", dest="outgroup", help="For --root, a comma separated list of tip labels common between trees to use as the outgroup for rooting", default=False);
-parser.add_argument("-genetrees", dest="genetrees", help="For --concordance, this is the file containing the gene trees.", default=False);
+parser.add_argument("-genetrees", dest="genetrees", help="For --concordance, --qcf, --rf, --mapnodes and --reconcile, this is the file containing the gene trees.", default=False);
+parser.add_argument("-boottrees", dest="boottrees", help="For --support, this is the file containing the bootstrap trees.", default=False);
+parser.add_argument("--tbe", dest="tbe", help="For --support. If set, transfer bootstrap support is calculated instead of Felsenstein support. Transfer support gives partial credit to bootstrap trees with a branch that is close to the reference branch.", action="store_true", default=False);
+parser.add_argument("--exact", dest="exact", help="For --mapnodes. If set, only gene tree nodes whose clade is in the species tree are mapped. Otherwise, other nodes are mapped to the deepest species tree node containing them. For --relabeltips, if set, only tips whose whole label is an old label are relabeled.", action="store_true", default=False);
+parser.add_argument("--rooted", dest="rooted", help="For --uniquetops. If set, trees are compared as rooted trees, so the same unrooted topology with different roots is counted separately.", action="store_true", default=False);
 parser.add_argument("--count", dest="count_tops", help="For --concordance. If set, the module will print out the number of times each topology was found.", action="store_true", default=False);
-parser.add_argument("-labels", dest="labels", help="For --relabeltip, the old label and the newlabel in the format: \"old1,new1 old2,new2\". Old labels don't need to match exactly with existing labels to allow for matching substrings.", default=False);
+parser.add_argument("-labels", dest="labels", help="For --relabeltip, the old label and the newlabel in the format: \"old1,new1 old2,new2\", or a file with one old,new pair per line. Old labels don't need to match exactly with existing labels to allow for matching substrings, unless --exact is set. If a tip contains more than one old label, the first one given is used.", default=False);
 parser.add_argument("-m", dest="run_mode", help="Run mode for --rmlabels. 1 (default): Remove only internal node labels; 2: remove only branch lengths; 3: remove internal node labels and branch lengths. For --relabeltips, 1 (default): Replace old label with new label; 2: Add new label to beginning of old label; 3: Add new label to end of old label.", type=int, default=1);
-parser.add_argument("-delim", dest="delim", help="For --relabeltips, with run modes 2 and 3 this is the character that will be placed between the old and new label. Underscore (_) is default. Enter 'space' for space character.", default="_");
-parser.add_argument("-raxpath", dest="raxpath", help="For --rf, the full path to your RAxML executable. By default, will simply try 'raxml'.", default="raxml");
+parser.add_argument("-delim", dest="delim", help="For --relabeltips, with run modes 2 and 3 this is the character that will be placed between the old and new label. For --reconcile, this is the character that separates the species from the rest of the gene tip labels. Underscore (_) is default. Enter 'space' for space character.", default="_");
+parser.add_argument("-spfield", dest="species_field", help="For --reconcile, the position of the species in the gene tip labels after splitting them by -delim, starting at 0. Use -1 for the last field. Default: 0.", type=int, default=0);
+parser.add_argument("-raxpath", dest="raxpath", help="Deprecated: --rf no longer calls RAxML and this option is ignored.", default=False);
+parser.add_argument("-p", dest="procs", help="For --rfmatrix, --concordance, --qcf, --consensus, --support, --uniquetops, --relabeltips, --scf, --prune, --mapnodes, --reconcile, --root and --rootbest, the number of processes to use. Default: 1.", type=int, default=1);
+parser.add_argument("-aln", dest="aln", help="For --scf, an alignment file or a directory of locus alignments in FASTA format.", default=False);
+parser.add_argument("-quartets", dest="num_quartets", help="For --scf, the number of quartets to sample for each branch. Default: 100.", type=int, default=100);
+parser.add_argument("-seed", dest="seed", help="For --scf, a seed for quartet sampling.", type=int, default=None);
+parser.add_argument("-seqtype", dest="seq_type", help="For --scf, the type of sequences in the alignments: 'dna' (default) or 'protein'.", default="dna");
+parser.add_argument("--cache", dest="cache", help="For --rf and --rfmatrix, read the trees from a binary cache next to the tree file (FILE.treecache.npz) instead of parsing them. The cache is written on the first run and again whenever the tree file changes. Requires numpy.", action="store_true", default=False);
+parser.add_argument("-conmode", dest="con_mode", help="For --consensus, the type of consensus tree: 'majority' (default) keeps branches in more than -threshold of the trees, 'strict' keeps branches in all trees, and 'greedy' adds every branch compatible with the ones already kept, from most to least frequent.", default="majority");
+parser.add_argument("-threshold", dest="threshold", help="For --consensus with -conmode majority, the proportion of trees a branch must be in to be kept. Not used by greedy, which adds branches from most to least frequent, so the ones in more than half of the trees always come first. Default: 0.5.", type=float, default=0.5);
+parser.add_argument("-digits", dest="digits", help="For --scale, round the scaled branch lengths to this many digits after the decimal point.", type=int, default=False);
+parser.add_argument("-minbl", dest="min_bl", help="For --scale, scaled branch lengths shorter than this are set to this length.", type=float, default=False);
+parser.add_argument("-taxa", dest="taxa", help="For --prune, a comma separated list of tip labels to keep, or a file with one tip label per line.", default=False);
 parser.add_argument("-clade", dest="clade", help="For --cladecount, a comma separated list of tip labels.", default=False);
 
 args = parser.parse_args();
 # Input option definitions.
 
 if not args.input or not os.path.exists(args.input):
-	if args.label_tree or args.root_check or args.root_tree or args.fotc:
+	if args.label_tree or args.root_check or args.root_tree or args.fotc or args.qcf or args.scf or args.map_nodes or args.support or args.reconcile:
 		file_flag = False;
 		tree_flag = True;
 	elif not os.path.exists(args.input):
@@ -141,7 +166,6 @@ if args.root_check:
 # --rootcheck : takes an input Newick string or file and checks if the trees are rooted or not.
 
 if args.root_tree:
-	print("\n** Warning -- The root option relies on the software Newick Utilities. If you don't have this installed and in your PATH variable, you will see an error!");
 	if file_flag == False and tree_flag == False:
 		sys.exit(core.errorOut(8, "--root only works on an input FILE containing many trees or a TREE STRING."));
 	if not args.outgroup:
@@ -161,12 +185,11 @@ if args.root_tree:
 		print("\t\t\t" + core.getDateTime());
 		print(core.spacedOut("Re-rooting all trees in:", pad), args.input);
 		print(core.spacedOut("Writing rooted trees to:", pad), output);
-	tree.rootTrees(filelist, tree_flag, args.outgroup, output);
+	tree.rootTrees(filelist, tree_flag, args.outgroup, output, args.procs);
 	sys.exit();
-# --root : takes an input Newick string or file and roots or re-roots the trees using Newick Utilities and the specified outgroups.
+# --root : takes an input Newick string or file and roots or re-roots the trees at the specified outgroups.
 
 if args.root_tree_best:
-	print("\n** Warning -- The rootbest option relies on the software Newick Utilities. If you don't have this installed and in your PATH variable, you will see an error!");
 	if file_flag == False:
 		sys.exit(core.errorOut(8.1, "--rootbest only works on the best-trees.txt FILE from wrappers.py --raxml containing many rows, each with the source alignment filename and the tree separated by a tab."));
 	if not args.outgroup:
@@ -177,9 +200,9 @@ if args.root_tree_best:
 	print("\t\t\t" + core.getDateTime());
 	print(core.spacedOut("Re-rooting all trees in:", pad), args.input);
 	print(core.spacedOut("Writing rooted trees to:", pad), output);
-	tree.rootTreesBest(filelist, tree_flag, args.outgroup, output);
+	tree.rootTreesBest(filelist, tree_flag, args.outgroup, output, args.procs);
 	sys.exit();
-# --root : takes an input Newick string or file and roots or re-roots the trees using Newick Utilities and the specified outgroups.
+# --root : takes an input Newick string or file and roots or re-roots the trees at the specified outgroups.
 
 if args.fotc:
 	if file_flag == False and tree_flag == False:
@@ -203,11 +226,115 @@ if args.fotc:
 	print("Calculating concordance factors for your species tree.");
 	print(core.spacedOut("Using gene trees in:", pad), args.genetrees);
 	print("Simply printing output to the screen");
-	tree.flightOfTheConcordance(filelist, tree_flag, args.genetrees, args.count_tops);
+	tree.flightOfTheConcordance(filelist, tree_flag, args.genetrees, args.count_tops, args.procs);
 	sys.exit();
 # --concordance : takes an input species tree (Newick string or file) and single-copy gene trees (file) 
 # and calculates concordance factors for each internal node of the species tree.
 
+if args.qcf:
+	if file_flag == False and tree_flag == False:
+		sys.exit(core.errorOut(63, "--qcf only works on an input FILE containing a tree or a TREE STRING."));
+	if not args.genetrees or not os.path.isfile(args.genetrees):
+		sys.exit(core.errorOut(64, "-genetrees must be a valid file name!"));
+	else:
+		args.genetrees = os.path.abspath(args.genetrees);
+	if args.procs < 1:
+		sys.exit(core.errorOut(65, "-p must be a positive integer."));
+	# Check if the input options are valid.
+
+	if tree_flag:
+		filelist = [False, False, False, args.input];
+	print("=======================================================================");
+	print("\t\t\t" + core.getDateTime());
+	print("Calculating quartet concordance factors for your species tree.");
+	print(core.spacedOut("Using gene trees in:", pad), args.genetrees);
+	print("Simply printing output to the screen");
+	tree.quartetCF(filelist, tree_flag, args.genetrees, args.procs);
+	sys.exit();
+# --qcf : takes an input species tree (Newick string or file) and gene trees (file) and calculates quartet
+# concordance factors for each branch of the species tree.
+
+if args.consensus:
+	if not file_flag:
+		sys.exit(core.errorOut(50, "--consensus takes an input (-i) FILE only."));
+	if args.con_mode not in ["majority", "strict", "greedy"]:
+		sys.exit(core.errorOut(51, "-conmode must be 'majority', 'strict', or 'greedy'."));
+	if not 0.5 <= args.threshold < 1 or args.procs < 1:
+		sys.exit(core.errorOut(52, "-threshold must be at least 0.5 and less than 1, and -p must be a positive integer."));
+	# Check if the input options are valid.
+
+	print("=======================================================================");
+	print("\t\t\t" + core.getDateTime());
+	print(core.spacedOut("Building a " + args.con_mode + " consensus tree from:", pad), args.input);
+	output, outnum = core.defaultOutFile(args.input, file_flag, "consensus", args.output);
+	print(core.spacedOut("Writing consensus tree to:", pad), output);
+	tree.consensus(filelist[0], args.con_mode, args.threshold, output, args.procs);
+	sys.exit();
+# --consensus : takes a file of trees and builds a majority-rule, strict, or greedy consensus tree with support labels.
+
+if args.unique_tops:
+	if not file_flag:
+		sys.exit(core.errorOut(60, "--uniquetops takes an input (-i) FILE only."));
+	if args.procs < 1:
+		sys.exit(core.errorOut(61, "-p must be a positive integer."));
+	# Check if the input options are valid.
+
+	print("=======================================================================");
+	print("\t\t\t" + core.getDateTime());
+	print(core.spacedOut("Finding unique " + ("rooted" if args.rooted else "unrooted") + " topologies in:", pad), args.input);
+	output, outnum = core.defaultOutFile(args.input, False, "uniquetops", args.output);
+	print(core.spacedOut("Writing topologies to:", pad), output);
+	tree.uniqueTopologies(filelist[0], args.rooted, output, args.procs);
+	sys.exit();
+# --uniquetops : takes a file of trees and writes each unique topology with its count and the line numbers of its trees.
+
+if args.support:
+	if file_flag == False and tree_flag == False:
+		sys.exit(core.errorOut(54, "--support only works on an input FILE containing a tree or a TREE STRING."));
+	if not args.boottrees or not os.path.isfile(args.boottrees):
+		sys.exit(core.errorOut(55, "-boottrees must be a valid file name!"));
+	else:
+		args.boottrees = os.path.abspath(args.boottrees);
+	if args.procs < 1:
+		sys.exit(core.errorOut(56, "-p must be a positive integer."));
+	# Check if the input options are valid.
+
+	if tree_flag:
+		filelist = [False, False, False, args.input];
+	print("=======================================================================");
+	print("\t\t\t" + core.getDateTime());
+	print("Calculating " + ("transfer" if args.tbe else "Felsenstein") + " support for your reference tree.");
+	print(core.spacedOut("Using bootstrap trees in:", pad), args.boottrees);
+	output, outnum = core.defaultOutFile(args.boottrees, file_flag, "support", args.output);
+	print(core.spacedOut("Writing reference tree with support to:", pad), output);
+	tree.supportTree(filelist, tree_flag, args.boottrees, args.tbe, output, args.procs);
+	sys.exit();
+# --support : takes an input reference tree (Newick string or file) and bootstrap trees (file) and labels each
+# internal branch of the reference tree with its Felsenstein or transfer support.
+
+if args.scf:
+	if file_flag == False and tree_flag == False:
+		sys.exit(core.errorOut(40, "--scf only works on an input FILE containing a tree or a TREE STRING."));
+	if not args.aln or not os.path.exists(args.aln):
+		sys.exit(core.errorOut(41, "-aln must be a valid file or directory name!"));
+	if args.seq_type not in ["dna", "protein"]:
+		sys.exit(core.errorOut(42, "-seqtype must be 'dna' or 'protein'."));
+	if args.num_quartets < 1 or args.procs < 1:
+		sys.exit(core.errorOut(43, "-quartets and -p must be positive integers."));
+	# Check if the input options are valid.
+
+	if tree_flag:
+		filelist = [False, False, False, args.input];
+	print("=======================================================================");
+	print("\t\t\t" + core.getDateTime());
+	print("Calculating site concordance factors for your species tree.");
+	print(core.spacedOut("Using alignments in:", pad), args.aln);
+	print("Simply printing output to the screen");
+	tree.siteCF(filelist, tree_flag, os.path.abspath(args.aln), args.num_quartets, args.seed, args.procs, args.seq_type);
+	sys.exit();
+# --scf : takes an input species tree (Newick string or file) and alignments and calculates site concordance
+# factors for each internal node of the species tree.
+
 if args.count_tips:
 	if not file_flag:
 		sys.exit(core.errorOut(14, "--tipcount takes an input (-i) FILE only."));
@@ -240,6 +367,8 @@ if args.relabel:
 		sys.exit(core.errorOut(18, "-labels must be entered with --relabeltips"));
 	if args.run_mode not in [1,2,3]:
 		sys.exit(core.errorOut(16, "-m must take values of 1, 2, or 3."));
+	if args.procs < 1:
+		sys.exit(core.errorOut(58, "-p must be a positive integer."));
 	print("=======================================================================");
 	print("\t\t\t" + core.getDateTime());
 	print(core.spacedOut("Relabeling tips in:", pad), args.input);
@@ -255,7 +384,7 @@ if args.relabel:
 		if args.delim == 'space':
 			args.delim = ' ';
 	print(core.spacedOut("Writing output to:", pad), output);
-	tree.relabelTips(filelist[0], args.labels, args.run_mode, args.delim, output);
+	tree.relabelTips(filelist[0], args.labels, args.run_mode, args.delim, output, args.exact, args.procs);
 	sys.exit();
 # --relabeltips : in a file containing many trees, relabels all tips containing an old label with a new label specified by user
 
@@ -284,21 +413,46 @@ if args.scale != False:
 		scale_factor = float(scale_factor);
 	except:
 		sys.exit(core.errorOut(22, "The scale factor must be an integer or a float."));
+	if args.digits is not False and args.digits < 0:
+		sys.exit(core.errorOut(59, "-digits must be 0 or a positive integer."));
 	print("=======================================================================");
 	print("\t\t\t" + core.getDateTime());
 	print(core.spacedOut("Scaling branch lengths on trees in:", pad), args.input);
+	if args.digits is not False:
+		print(core.spacedOut("Rounding branch lengths to:", pad), str(args.digits) + " digits");
+	if args.min_bl is not False:
+		print(core.spacedOut("Minimum branch length:", pad), args.min_bl);
 	output, outnum = core.defaultOutFile(args.input, file_flag, "scale", args.output);
 	print(core.spacedOut("Writing output to:", pad), output);
-	tree.scaleBL(filelist[0], scale_op, scale_factor, output);
+	tree.scaleBL(filelist[0], scale_op, scale_factor, output, args.digits, args.min_bl);
+	sys.exit();
+
+if args.prune:
+	if not file_flag:
+		sys.exit(core.errorOut(44, "--prune takes an input (-i) FILE only."));
+	if not args.taxa:
+		sys.exit(core.errorOut(45, "With --prune, a set of tip labels to keep must be specified with -taxa."));
+	if args.procs < 1:
+		sys.exit(core.errorOut(71, "-p must be a positive integer."));
+	if os.path.isfile(args.taxa):
+		keep_tips = set(line.strip() for line in open(args.taxa) if line.strip());
+	else:
+		keep_tips = set(args.taxa.split(","));
+	# Read the tips to keep from a file or a comma separated list.
+
+	print("=======================================================================");
+	print("\t\t\t" + core.getDateTime());
+	print(core.spacedOut("Pruning all trees in:", pad), args.input);
+	print(core.spacedOut("Number of tips to keep:", pad), len(keep_tips));
+	output, outnum = core.defaultOutFile(args.input, file_flag, "pruned", args.output);
+	print(core.spacedOut("Writing pruned trees to:", pad), output);
+	tree.pruneTrees(filelist[0], keep_tips, output, args.procs);
 	sys.exit();
+# --prune : takes a file with many trees and prunes them all down to a set of tips.
 
 if args.rf:
-	#if not os.path.exists(args.raxpath):
-	#	sys.exit(core.errorOut(22, "Path to RAxML (" + args.raxpath + ") not found!"));
 	if args.raxpath:
-		print("User specified path to RAxML:", args.raxpath);
-	else:
-		print("No path to RAxML specified. Trying 'raxml'");
+		print("** Warning -- --rf no longer calls RAxML. Ignoring -raxpath.");
 	# Checking the input raxpath.
 
 	if file_flag == False and tree_flag == False:
@@ -323,7 +477,72 @@ if args.rf:
 	print(core.spacedOut("Using gene trees in:", pad), args.genetrees);
 	output, outnum = core.defaultOutFile(args.genetrees, file_flag, "RF", args.output);
 	print(core.spacedOut("Writing output to:", pad), output);
-	tree.robF(filelist, tree_flag, args.genetrees, args.raxpath, output);
+	tree.robF(filelist, tree_flag, args.genetrees, output, args.cache);
 	sys.exit();
+# --rf : takes an input species tree (Newick string or file) and single-copy gene trees (file)
+# and calculates the RF distance from each gene tree to the species tree.
 
+if args.rf_matrix:
+	if not file_flag:
+		sys.exit(core.errorOut(32, "--rfmatrix takes an input (-i) FILE only."));
+	if args.procs < 1:
+		sys.exit(core.errorOut(33, "-p must be a positive integer."));
+	print("=======================================================================");
+	print("\t\t\t" + core.getDateTime());
+	print(core.spacedOut("Calculating RF distances between all trees in:", pad), args.input);
+	output, outnum = core.defaultOutFile(args.input, file_flag, "rfmatrix", args.output);
+	print(core.spacedOut("Writing output to:", pad), output);
+	tree.rfMatrix(filelist[0], output, args.procs, args.cache);
+	sys.exit();
+# --rfmatrix : takes a file of trees and calculates the RF distance between every pair of trees.
 
+if args.map_nodes:
+	if file_flag == False and tree_flag == False:
+		sys.exit(core.errorOut(46, "--mapnodes only works on an input FILE containing a tree or a TREE STRING."));
+	if not args.genetrees or not os.path.isfile(args.genetrees):
+		sys.exit(core.errorOut(47, "-genetrees must be a valid file name!"));
+	else:
+		args.genetrees = os.path.abspath(args.genetrees);
+	if args.procs < 1:
+		sys.exit(core.errorOut(49, "-p must be a positive integer."));
+	# Check if the input options are valid.
+
+	if tree_flag:
+		filelist = [False, False, False, args.input];
+	print("=======================================================================");
+	print("\t\t\t" + core.getDateTime());
+	print("Mapping gene tree nodes onto your species tree.");
+	print(core.spacedOut("Using gene trees in:", pad), args.genetrees);
+	output, outnum = core.defaultOutFile(args.genetrees, file_flag, "mapped", args.output);
+	print(core.spacedOut("Writing mapped trees to:", pad), output);
+	tree.mapTrees(filelist, tree_flag, args.genetrees, args.exact, output, args.procs);
+	sys.exit();
+# --mapnodes : takes an input species tree (Newick string or file) and gene trees (file) and labels each gene
+# tree node with the species tree node it maps to.
+
+if args.reconcile:
+	if file_flag == False and tree_flag == False:
+		sys.exit(core.errorOut(68, "--reconcile only works on an input FILE containing a tree or a TREE STRING."));
+	if not args.genetrees or not os.path.isfile(args.genetrees):
+		sys.exit(core.errorOut(69, "-genetrees must be a valid file name!"));
+	else:
+		args.genetrees = os.path.abspath(args.genetrees);
+	if args.procs < 1:
+		sys.exit(core.errorOut(70, "-p must be a positive integer."));
+	if args.delim == 'space':
+		args.delim = ' ';
+	# Check if the input options are valid.
+
+	if tree_flag:
+		filelist = [False, False, False, args.input];
+	print("=======================================================================");
+	print("\t\t\t" + core.getDateTime());
+	print("Reconciling gene trees with your species tree.");
+	print(core.spacedOut("Using gene trees in:", pad), args.genetrees);
+	print(core.spacedOut("Species from gene tip label field:", pad), str(args.species_field) + " (delimiter: '" + args.delim + "')");
+	output, outnum = core.defaultOutFile(args.genetrees, file_flag, "reconcile", args.output);
+	print(core.spacedOut("Writing gene tree counts to:", pad), output);
+	tree.reconcile(filelist, tree_flag, args.genetrees, args.delim, args.species_field, output, args.procs);
+	sys.exit();
+# --reconcile : takes an input rooted species tree (Newick string or file) and rooted gene trees (file) and counts
+# gene duplications and losses by LCA mapping.
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+########################################################################################
+# A script to time the main treec tree operations on random trees of different shapes
+# and sizes, writing the times to a JSON report that can be compared between commits.
+#
+# Dependencies: core
+########################################################################################
+
+import sys, os, random, argparse, json, time, platform, subprocess
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/lib/")
+import core, treec
+
+OPS = ["parse", "getClades", "LCA", "Prune", "Root", "addLabel"];
+# The operations timed on every tree, in the order they are run
+
+#############################################################################
+
+def cladeSize(tree):
+# The total number of tips in all clades of a tree, which is the size of the output of getClades. This is
+# quadratic in the number of tips for unbalanced trees, so large ones are skipped.
+
+	num_tips = {};
+	for node in tree.nodes:
+		num_tips[node] = 1 if tree.type[node] == "tip" else sum(num_tips[d] for d in tree.desc[node]);
+	return sum(num_tips.values());
+
+#############################################################################
+
+def timeOps(tree_str, reps, num_queries, max_clade_size, seed):
+# Times each operation on a tree string, re-reading the tree on every rep so no cached index is kept between
+# reps. The random tips for each operation are picked with the seed, so every run times the same work.
+# Returns the fastest time for each operation in seconds, or None if it was skipped.
+
+	times = { op : [] for op in OPS };
+
+	for rep in range(reps):
+		rng = random.Random(seed);
+
+		start = time.perf_counter();
+		tree = treec.Tree(tree_str);
+		times['parse'].append(time.perf_counter() - start);
+
+		if cladeSize(tree) <= max_clade_size:
+			start = time.perf_counter();
+			tree.getClades();
+			times['getClades'].append(time.perf_counter() - start);
+		# All the clades of a caterpillar tree take too long and too much memory past a few thousand tips
+
+		pairs = [ rng.sample(tree.tips, 2) for i in range(num_queries) ];
+		start = time.perf_counter();
+		for pair in pairs:
+			tree.LCA(pair);
+		times['LCA'].append(time.perf_counter() - start);
+		# Includes building the LCA index on the first query
+
+		prune_tips = rng.sample(tree.tips, len(tree.tips) // 2);
+		start = time.perf_counter();
+		tree.Prune(prune_tips);
+		times['Prune'].append(time.perf_counter() - start);
+
+		outgroup = [rng.choice(tree.tips)];
+		start = time.perf_counter();
+		tree.Root(outgroup);
+		times['Root'].append(time.perf_counter() - start);
+
+		labels = { node : "_1" for node in tree.internals };
+		start = time.perf_counter();
+		tree.addLabel(labels);
+		times['addLabel'].append(time.perf_counter() - start);
+	## End rep loop
+
+	return { op : (round(min(op_times), 6) if op_times else None) for op, op_times in times.items() };
+
+#############################################################################
+
+def gitCommit():
+# The commit of the repository the script is in, or NA if it can't be found
+
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.realpath(__file__)), stderr=subprocess.DEVNULL).decode().strip();
+	except Exception:
+		return "NA";
+
+#############################################################################
+
+def compareReports(old_report, new_report, tolerance):
+# Prints the times in two reports side by side with their ratio, marking operations that got slower by more
+# than the tolerance. Returns the number of those.
+
+	num_slower = 0;
+	print("model\ttips\toperation\told\tnew\tratio");
+	for model, sizes in new_report['results'].items():
+		for size, ops in sizes.items():
+			for op, new_time in ops.items():
+				old_time = old_report['results'].get(model, {}).get(size, {}).get(op);
+				if old_time is None or new_time is None or old_time == 0:
+					continue;
+				ratio = new_time / old_time;
+				outline = [model, size, op, "%.6f" % old_time, "%.6f" % new_time, "%.2f" % ratio];
+				if ratio > 1 + tolerance:
+					outline.append("SLOWER");
+					num_slower += 1;
+				print("\t".join(outline));
+	return num_slower;
+
+#############################################################################
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description="Times treec tree operations on random trees and writes the times to a JSON report.");
+	parser.add_argument("-o", dest="output", help="The JSON file to write the report to. Default: treec-bench.json", default="treec-bench.json");
+	parser.add_argument("-sizes", dest="sizes", help="A comma separated list of the numbers of tips of the trees to time. Default: 10,100,1000,10000", default="10,100,1000,10000");
+	parser.add_argument("-models", dest="models", help="A comma separated list of the types of random trees to time: yule, coalescent, caterpillar. Default: all of them.", default=",".join(treec.TREE_MODELS));
+	parser.add_argument("-reps", dest="reps", help="The number of times to run each operation. The fastest time is reported. Default: 3.", type=int, default=3);
+	parser.add_argument("-queries", dest="num_queries", help="The number of random pairs of tips to find the LCA of. Default: 1000.", type=int, default=1000);
+	parser.add_argument("-maxclades", dest="max_clade_size", help="getClades is skipped for trees whose clades have more than this many tips in total, like large caterpillar trees. Default: 5000000.", type=int, default=5000000);
+	parser.add_argument("-seed", dest="seed", help="The seed for the random trees and the tips used by each operation. Default: 1.", type=int, default=1);
+	parser.add_argument("-compare", dest="compare", help="A JSON report from an earlier run to compare the new times with.", default=False);
+	parser.add_argument("-tolerance", dest="tolerance", help="With -compare, operations that take more than this fraction longer than before are marked as slower. Default: 0.25.", type=float, default=0.25);
+	args = parser.parse_args();
+	# Input option definitions.
+
+	try:
+		sizes = [ int(size) for size in args.sizes.split(",") ];
+	except ValueError:
+		sys.exit(core.errorOut(1, "-sizes must be a comma separated list of integers."));
+	if any(size < 2 for size in sizes):
+		sys.exit(core.errorOut(2, "Trees must have at least 2 tips (-sizes)."));
+	models = args.models.split(",");
+	if any(model not in treec.TREE_MODELS for model in models):
+		sys.exit(core.errorOut(3, "-models must be a comma separated list of: " + ", ".join(treec.TREE_MODELS)));
+	if args.reps < 1 or args.num_queries < 1:
+		sys.exit(core.errorOut(4, "-reps and -queries must be positive integers."));
+	if args.compare and not os.path.isfile(args.compare):
+		sys.exit(core.errorOut(5, "-compare must be a valid file name!"));
+	# Check if the input options are valid.
+
+	pad = 40;
+	print("=======================================================================");
+	print("\t\t\t" + core.getDateTime());
+	print("Timing treec operations on random trees.");
+	print(core.spacedOut("Tree models:", pad), ", ".join(models));
+	print(core.spacedOut("Numbers of tips:", pad), ", ".join(str(size) for size in sizes));
+	print(core.spacedOut("Reps:", pad), args.reps);
+	print(core.spacedOut("Seed:", pad), args.seed);
+	print(core.spacedOut("Writing report to:", pad), args.output);
+	print("-------------------------");
+
+	report = { 'commit' : gitCommit(), 'date' : core.getDateTime(), 'python' : platform.python_version(), 'platform' : platform.platform(),
+			   'seed' : args.seed, 'reps' : args.reps, 'lca_queries' : args.num_queries, 'results' : {} };
+
+	for model in models:
+		report['results'][model] = {};
+		for size in sizes:
+			tree_str = treec.randomTree(size, model, seed=args.seed);
+			op_times = timeOps(tree_str, args.reps, args.num_queries, args.max_clade_size, args.seed);
+			report['results'][model][str(size)] = op_times;
+			print("\t".join([model, str(size)] + [ op + ":" + ("%.6f" % op_time if op_time is not None else "skipped") for op, op_time in op_times.items() ]));
+	# Each model and size gets the same tree for the same seed, so runs on different commits time the same trees.
+
+	with open(args.output, "w") as outfile:
+		json.dump(report, outfile, indent=1, sort_keys=True);
+		outfile.write("\n");
+	# One time per line, so reports diff cleanly.
+
+	print("\n" + core.getTime() + " Done!");
+
+	if args.compare:
+		with open(args.compare, "r") as infile:
+			old_report = json.load(infile);
+		print("\n----Comparison with " + args.compare + " (commit " + old_report.get('commit', "NA") + ")----");
+		num_slower = compareReports(old_report, report, args.tolerance);
+		print(str(num_slower) + " operations were more than " + str(round(args.tolerance * 100)) + "% slower.");
+	print("=======================================================================");